@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, make_response, g, has_request_context, send_from_directory, abort, Response, stream_with_context
 import sqlite3
 import subprocess
 import os
@@ -8,19 +8,405 @@ from datetime import datetime, timedelta
 import logging
 import secrets
 import threading
+import functools
+import socket
+from collections import OrderedDict
+from collections.abc import Mapping
+import operator
+import sys
 import time
+import re
+import hashlib
+import difflib
+import bisect
+import csv
+import io
+import ipaddress
+import struct
+import json
+import hmac
+import argparse
+import concurrent.futures
+import urllib.request
+import urllib.error
+import cProfile
+import pstats
+import tracemalloc
+import logging.handlers
+import queue
+import atexit
+import copy
+import itertools
+import contextvars
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import tarfile
+import zlib
+import heapq
+import base64
+import xml.etree.ElementTree as ElementTree
+import ctypes
+import select
+import mmap
 
-# Konfigurasi logging
-logging.basicConfig(
-    filename='/var/log/nftables_manager.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-console = logging.StreamHandler()
-console.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+try:
+    import zstandard  # opsional: arsip backup .tar.zst
+except ImportError:
+    zstandard = None
+
+# Konfigurasi logging: record masuk antrean, thread listener yang menulis ke file (JSON) dan console
+LOG_FILE = '/var/log/nftables_manager.log'
+LOG_MAX_BYTES = 10 * 1024 * 1024  # rotasi file log setiap 10 MB
+LOG_BACKUP_COUNT = 5
+LOG_SAMPLE_INTERVAL = 60  # detik per jendela sampling log yang ramai
+LOG_SAMPLE_BURST = 5  # record per kunci sampling yang tetap ditulis dalam satu jendela
+
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+def new_request_id():
+    return secrets.token_hex(8)
+
+def ensure_request_id():
+    """Gunakan request id yang sedang aktif atau buat yang baru (mis. untuk thread latar belakang)"""
+    request_id = request_id_var.get()
+    if request_id is None:
+        request_id = new_request_id()
+        request_id_var.set(request_id)
+    return request_id
+
+class RequestIdFilter(logging.Filter):
+    """Tempelkan request id ke record di thread pemanggil, sebelum masuk antrean"""
+    
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Batasi record dengan extra={'sample': kunci} ke LOG_SAMPLE_BURST per LOG_SAMPLE_INTERVAL"""
+    
+    def __init__(self, interval=LOG_SAMPLE_INTERVAL, burst=LOG_SAMPLE_BURST):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.windows = {}
+        self.lock = threading.Lock()
+    
+    def filter(self, record):
+        key = getattr(record, 'sample', None)
+        if key is None or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self.windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+class JsonFormatter(logging.Formatter):
+    """Format record sebagai satu baris JSON"""
+    
+    FIELDS = ('request_id', 'rule_id', 'sample', 'suppressed')
+    
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class ConsoleFormatter(logging.Formatter):
+    def format(self, record):
+        message = super().format(record)
+        request_id = getattr(record, 'request_id', None)
+        return f"{message} [{request_id}]" if request_id else message
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler yang mempertahankan field terstruktur (request id, sampling) di record"""
+    
+    exception_formatter = logging.Formatter()
+    
+    def prepare(self, record):
+        # Format pesan di thread pemanggil; traceback disimpan terpisah agar tetap jadi field 'exc'
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def setup_logging():
+    file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES,
+                                                        backupCount=LOG_BACKUP_COUNT)
+    file_handler.setFormatter(JsonFormatter())
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.setFormatter(ConsoleFormatter('%(asctime)s - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(SamplingFilter())
+    root = logging.getLogger('')
+    root.setLevel(logging.INFO)
+    root.addHandler(queue_handler)
+    
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+
+# Log viewer: file log dibaca mundur per blok dari akhir file dan diikuti lewat inotify
+LOG_VIEW_BLOCK_SIZE = 64 * 1024
+LOG_VIEW_LIMIT = 200  # entri per halaman
+LOG_VIEW_SCAN_MAX = 32 * 1024 * 1024  # byte maksimum yang dibaca mundur per halaman saat memfilter
+LOG_FOLLOW_HEARTBEAT = 15  # detik antar komentar keep-alive SSE
+LOG_FOLLOW_MAX = 8  # jumlah follower SSE bersamaan
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+IN_MODIFY, IN_ATTRIB, IN_DELETE_SELF, IN_MOVE_SELF = 0x2, 0x4, 0x400, 0x800
+IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+log_follow_slots = threading.BoundedSemaphore(LOG_FOLLOW_MAX)
+
+def read_lines_reverse(path, end=None, block_size=LOG_VIEW_BLOCK_SIZE):
+    """Hasilkan (offset, baris) dari akhir file ke awal dengan seek mundur per blok
+
+    Hanya blok yang dibutuhkan yang dibaca, sehingga membuka file log sebesar apa pun tetap instan.
+    Baris yang belum diakhiri newline di ujung file (sedang ditulis) dilewati.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell() if end is None else min(end, f.tell())
+        remainder = b''
+        skip_partial = end is None
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + remainder).split(b'\n')
+            remainder = lines.pop(0)
+            offset = position + len(remainder) + 1
+            parsed = []
+            for line in lines:
+                parsed.append((offset, line))
+                offset += len(line) + 1
+            if skip_partial and parsed:
+                # Potongan terakhir tanpa newline belum selesai ditulis
+                parsed.pop()
+                skip_partial = False
+            for offset, line in reversed(parsed):
+                if line:
+                    yield offset, line
+        if remainder and not skip_partial:
+            yield 0, remainder
+
+def parse_log_line(line):
+    """Entri log dari satu baris JSON; baris non-JSON (format lama) menjadi pesan mentah"""
+    text = line.decode('utf-8', errors='replace')
+    try:
+        entry = json.loads(text)
+    except ValueError:
+        entry = None
+    if not isinstance(entry, dict):
+        match = re.match(r'(\S+ \S+) - (\w+) - (.*)', text)
+        entry = {'ts': match.group(1), 'level': match.group(2), 'msg': match.group(3)} if match else {'msg': text}
+    return entry
+
+def parse_log_filters(args):
+    """Filter log: level minimum, request id dan id aturan"""
+    filters = {}
+    level = (args.get('level') or '').upper()
+    if level:
+        if level not in LOG_LEVELS:
+            raise ValueError(f"Level must be one of: {', '.join(LOG_LEVELS)}")
+        filters['level'] = LOG_LEVELS.index(level)
+    request_id = (args.get('request_id') or '').strip()
+    if request_id:
+        filters['request_id'] = request_id
+    rule_id = (args.get('rule_id') or '').strip()
+    if rule_id:
+        if not rule_id.isdigit():
+            raise ValueError("Rule id must be a number")
+        filters['rule_id'] = int(rule_id)
+        # Record lama tanpa field rule_id dicocokkan dari teks pesannya
+        filters['rule_pattern'] = re.compile(rf'\b(?:ID:? |[Rr]ule #?){rule_id}\b')
+    return filters
+
+def log_entry_matches(entry, filters):
+    if 'level' in filters:
+        level = entry.get('level')
+        if level not in LOG_LEVELS or LOG_LEVELS.index(level) < filters['level']:
+            return False
+    if 'request_id' in filters and entry.get('request_id') != filters['request_id']:
+        return False
+    if 'rule_id' in filters and entry.get('rule_id') != filters['rule_id'] and \
+            not filters['rule_pattern'].search(entry.get('msg') or ''):
+        return False
+    return True
+
+def read_log(filters=None, before=None, limit=LOG_VIEW_LIMIT):
+    """Entri terbaru (baru ke lama) yang cocok dengan filter, mulai dari offset `before`
+
+    Mengembalikan dict berisi entri, offset untuk halaman berikutnya (lebih lama) dan ukuran file
+    sebagai titik awal follow. Pembacaan berhenti setelah LOG_VIEW_SCAN_MAX byte agar filter yang
+    jarang cocok tidak membaca seluruh file dalam satu request.
+    """
+    filters = filters or {}
+    try:
+        size = os.path.getsize(LOG_FILE)
+    except OSError:
+        return None
+    end = size if before is None else min(before, size)
+    entries = []
+    older = None
+    for offset, line in read_lines_reverse(LOG_FILE, None if before is None else end):
+        if end - offset > LOG_VIEW_SCAN_MAX or len(entries) >= limit:
+            older = offset + len(line) + 1
+            break
+        entry = parse_log_line(line)
+        if log_entry_matches(entry, filters):
+            entry['offset'] = offset
+            entries.append(entry)
+    return {'entries': entries, 'older': older, 'size': size, 'scanned': end - (older or 0)}
+
+class _Inotify:
+    """Pembungkus minimal inotify(7) lewat ctypes; tidak tersedia di luar Linux"""
+    
+    libc = None
+    
+    def __init__(self):
+        if _Inotify.libc is None:
+            _Inotify.libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watch = None
+    
+    def add_watch(self, path, mask):
+        if self.watch is not None:
+            self.libc.inotify_rm_watch(self.fd, self.watch)
+        self.watch = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if self.watch < 0:
+            self.watch = None
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+    
+    def wait(self, timeout):
+        """Tunggu event; True jika ada event (isinya dibuang, pemanggil memeriksa file sendiri)"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+    
+    def close(self):
+        os.close(self.fd)
+
+def _sleep_until_changed(offset, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(1)
+        try:
+            if os.path.getsize(LOG_FILE) != offset:
+                return True
+        except OSError:
+            pass
+    return False
+
+def follow_log(offset, filters=None, heartbeat=LOG_FOLLOW_HEARTBEAT):
+    """Hasilkan (offset, entri) untuk baris baru mulai dari `offset`; None sebagai tanda keep-alive
+
+    Hanya byte yang ditambahkan sejak offset terakhir yang dibaca. Menunggu memakai inotify
+    (fallback: cek ukuran file per detik); rotasi file terdeteksi dari inode yang berubah atau
+    ukuran yang mengecil, lalu file baru diikuti dari awal.
+    """
+    filters = filters or {}
+    try:
+        notifier = _Inotify()
+    except OSError:
+        notifier = None
+    f = None
+    pending = b''
+    try:
+        while True:
+            if f is None:
+                try:
+                    f = open(LOG_FILE, 'rb')
+                except OSError:
+                    f = None
+                else:
+                    if offset > os.fstat(f.fileno()).st_size:
+                        offset = 0
+                    # Offset di tengah baris (mis. ukuran file saat halaman dibuka): sisa baris itu dilewati
+                    discard = False
+                    if offset > 0:
+                        f.seek(offset - 1)
+                        discard = f.read(1) != b'\n'
+                    f.seek(offset)
+                    pending = b''
+                    if notifier:
+                        notifier.add_watch(LOG_FILE, IN_MODIFY | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF)
+            if f is not None:
+                data = f.read()
+                if data:
+                    lines = (pending + data).split(b'\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        line_offset = offset
+                        offset += len(line) + 1
+                        if discard:
+                            discard = False
+                        elif line:
+                            entry = parse_log_line(line)
+                            if log_entry_matches(entry, filters):
+                                entry['offset'] = line_offset
+                                yield offset, entry
+                    continue
+                try:
+                    current = os.stat(LOG_FILE)
+                    rotated = current.st_ino != os.fstat(f.fileno()).st_ino or current.st_size < offset
+                except OSError:
+                    rotated = True
+                if rotated:
+                    f.close()
+                    f = None
+                    offset = 0
+                    continue
+            if notifier is not None and f is not None:
+                woke = notifier.wait(heartbeat)
+            else:
+                woke = _sleep_until_changed(offset, heartbeat)
+            if not woke:
+                yield offset, None
+    finally:
+        if f is not None:
+            f.close()
+        if notifier:
+            notifier.close()
 
 app = Flask(__name__)
 app.secret_key = secrets.token_hex(32)
@@ -34,6 +420,12 @@ BACKUP_DIR = "/etc/nftables.d/backups"
 # Path ke executable
 SYSTEMCTL = "/usr/bin/systemctl"
 NFT = "/usr/sbin/nft"
+CONNTRACK = "/usr/sbin/conntrack"
+
+# Executor perintah sistem (nft, systemctl, cp); dapat diganti executor palsu untuk benchmark
+def run_command(args, **kwargs):
+    """Jalankan perintah sistem melalui subprocess.run"""
+    return subprocess.run(args, **kwargs)
 
 def adapt_datetime(ts):
     """Adapter untuk datetime ke SQLite"""
@@ -56,11 +448,426 @@ sqlite3.register_adapter(datetime, adapt_datetime)
 sqlite3.register_converter("timestamp", convert_datetime)
 sqlite3.register_converter("TIMESTAMP", convert_datetime)
 
+# Metrik gaya Prometheus: observasi hanya menambah counter, teks eksposisi dibuat saat di-scrape
+METRICS_TOKEN = os.environ.get('NFTM_METRICS_TOKEN')
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC_HELP = {
+    'nftm_apply_seconds': ('histogram', "Total duration of save_rules (generate, write and reload)"),
+    'nftm_apply_stage_seconds': ('histogram', "Duration of each apply pipeline stage"),
+    'nftm_apply_total': ('counter', "Number of apply runs by result"),
+    'nftm_http_request_duration_seconds': ('histogram', "HTTP request latency by route"),
+    'nftm_http_requests_total': ('counter', "HTTP requests by route, method and status"),
+    'nftm_sqlite_query_seconds': ('histogram', "SQLite statement execution time by operation"),
+    'nftm_backup_seconds': ('histogram', "Duration of backup and restore operations"),
+    'nftm_backup_total': ('counter', "Backup and restore operations by result"),
+    'nftm_expiry_run_seconds': ('histogram', "Duration of expired rule checks"),
+    'nftm_expired_rules_total': ('counter', "Rules disabled because they expired"),
+    'nftm_feed_update_seconds': ('histogram', "Duration of threat feed fetch, diff and apply"),
+    'nftm_feed_element_ops_total': ('counter', "Set elements added or deleted by threat feed updates"),
+    'nftm_geoip_resolve_seconds': ('histogram', "Duration of resolving country/ASN sets from a GeoIP database"),
+    'nftm_geoip_element_ops_total': ('counter', "Set elements added or deleted by GeoIP database updates"),
+    'nftm_conntrack_scan_seconds': ('histogram', "Duration of one streaming pass over the conntrack table"),
+    'nftm_rule_snapshot_seconds': ('histogram', "Duration of rebuilding the in-memory rule snapshot"),
+    'nftm_dynamic_queued_total': ('counter', "Dynamic list operations accepted into the write queue"),
+    'nftm_dynamic_batch_seconds': ('histogram', "Duration of one batched nft write for the dynamic lists"),
+}
+metrics_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+def _metric_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+def observe(name, seconds, **labels):
+    """Catat satu observasi histogram"""
+    index = bisect.bisect_left(METRIC_BUCKETS, seconds)
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        series = _histograms.get(key)
+        if series is None:
+            series = _histograms[key] = [[0] * (len(METRIC_BUCKETS) + 1), 0.0, 0]
+        series[0][index] += 1
+        series[1] += seconds
+        series[2] += 1
+
+def inc_counter(name, value=1, **labels):
+    """Tambah nilai counter"""
+    key = _metric_key(name, labels)
+    with metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+class metric_timer:
+    """Context manager untuk mengukur durasi blok kode ke histogram"""
+    
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+def timed_operation(name, counter=None, **labels):
+    """Decorator untuk fungsi yang mengembalikan (success, message): catat durasi dan hasilnya"""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            started = time.perf_counter()
+            result = f(*args, **kwargs)
+            observe(name, time.perf_counter() - started, **labels)
+            if counter:
+                ok = result[0] if isinstance(result, tuple) else True
+                inc_counter(counter, result='success' if ok else 'failure', **labels)
+            return result
+        return wrapped
+    return decorator
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+def render_metrics():
+    """Buat teks eksposisi Prometheus dari semua histogram dan counter"""
+    with metrics_lock:
+        histograms = {key: (list(series[0]), series[1], series[2]) for key, series in _histograms.items()}
+        counters = dict(_counters)
+    lines = []
+    for name, (kind, help_text) in METRIC_HELP.items():
+        source = histograms if kind == 'histogram' else counters
+        keys = sorted(key for key in source if key[0] == name)
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key in keys:
+            labels = key[1]
+            if kind == 'counter':
+                lines.append(f"{name}{_format_labels(labels)} {counters[key]}")
+                continue
+            buckets, total, count = histograms[key]
+            cumulative = 0
+            for bound, value in zip(METRIC_BUCKETS, buckets):
+                cumulative += value
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', repr(bound))])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor SQLite yang mencatat waktu eksekusi per jenis statement"""
+    
+    def execute(self, sql, *args):
+        with metric_timer('nftm_sqlite_query_seconds', operation=sql.split(None, 1)[0].lower()):
+            return super().execute(sql, *args)
+    
+    def executemany(self, sql, *args):
+        with metric_timer('nftm_sqlite_query_seconds', operation=sql.split(None, 1)[0].lower()):
+            return super().executemany(sql, *args)
+
+class TimedConnection(sqlite3.Connection):
+    """Koneksi SQLite dengan TimedCursor sebagai cursor default"""
+    
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+# Profiling opt-in untuk request tertentu dan siklus pengecekan expiry
+PROFILE_DIR = "/var/lib/nftables_manager/profiles"
+PROFILE_MAX_COUNT = 20  # profil terlama dihapus jika melebihi batas
+PROFILE_TARGETS = {
+    'dashboard': "Next dashboard request",
+    'apply_rules': "Next apply",
+    'restore_backup': "Next restore",
+    'expiry': "Next expired rules check",
+}
+PROFILE_STACK_DEPTH = 64
+profile_lock = threading.Lock()
+profiler_lock = threading.Lock()  # cProfile dan tracemalloc global per proses: satu profil dalam satu waktu
+profile_armed = set()  # target yang akan diprofil sekali pada pemanggilan berikutnya
+
+def arm_profile(target):
+    with profile_lock:
+        profile_armed.add(target)
+
+def consume_profile_flag(target):
+    """Ambil (dan hapus) flag profil untuk target; murah jika tidak ada yang di-arm"""
+    if not profile_armed:
+        return False
+    with profile_lock:
+        if target in profile_armed:
+            profile_armed.discard(target)
+            return True
+    return False
+
+def collapse_profile_stats(stats):
+    """Ubah statistik cProfile menjadi collapsed stack (format flamegraph.pl / speedscope)
+
+    cProfile hanya menyimpan relasi pemanggil-terpanggil, sehingga waktu setiap fungsi
+    dibagi ke jalur pemanggil secara proporsional terhadap waktu kumulatif tiap edge.
+    Cabang di bawah 0.1% dari total waktu tidak ditelusuri agar jumlah jalur tetap terbatas.
+    """
+    def frame_name(func):
+        filename, line, name = func
+        if filename == '~':
+            return name
+        return f"{name} ({os.path.basename(filename)}:{line})"
+    
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller in callers:
+            callees.setdefault(caller, []).append(func)
+    
+    lines = {}
+    min_time = sum(entry[2] for entry in stats.values()) * 0.001
+    
+    def walk(func, path, share):
+        path = path + [frame_name(func)]
+        _, _, self_time, cumulative, _ = stats[func]
+        weight = int(self_time * share * 1_000_000)
+        if weight:
+            key = ";".join(path)
+            lines[key] = lines.get(key, 0) + weight
+        if len(path) >= PROFILE_STACK_DEPTH:
+            return
+        for callee in callees.get(func, []):
+            if frame_name(callee) in path:
+                continue
+            callee_cumulative = stats[callee][3]
+            edge_cumulative = stats[callee][4][func][3]
+            if callee_cumulative and share * edge_cumulative >= min_time:
+                walk(callee, path, share * edge_cumulative / callee_cumulative)
+    
+    for func, (_, _, _, _, callers) in stats.items():
+        if not callers:
+            walk(func, [], 1.0)
+    return "\n".join(f"{path} {weight}" for path, weight in sorted(lines.items())) + "\n"
+
+def prune_profiles():
+    """Batasi jumlah profil di PROFILE_DIR"""
+    try:
+        names = sorted(name[:-7] for name in os.listdir(PROFILE_DIR) if name.endswith('.pstats'))
+    except OSError:
+        return
+    for name in names[:max(len(names) - PROFILE_MAX_COUNT, 0)]:
+        for suffix in ('.pstats', '.collapsed', '.txt', '.json'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name + suffix))
+            except OSError:
+                pass
+
+def run_profiled(label, func, *args, **kwargs):
+    """Jalankan func di bawah cProfile dan tracemalloc, lalu simpan hasilnya ke PROFILE_DIR
+
+    Jika profil lain sedang berjalan, func dijalankan tanpa profil dan nama profil None.
+    """
+    if not profiler_lock.acquire(blocking=False):
+        logging.info(f"Profiler busy; running {label} without profiling")
+        return func(*args, **kwargs), None
+    try:
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(16)
+        elif hasattr(tracemalloc, 'reset_peak'):
+            # reset_peak baru ada sejak Python 3.9; tanpa itu peak mencakup alokasi sebelum request
+            tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            duration = time.perf_counter() - started
+            try:
+                _, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+            finally:
+                if started_tracing:
+                    tracemalloc.stop()
+    finally:
+        profiler_lock.release()
+    try:
+        name = save_profile(label, profiler, snapshot, duration, peak)
+        logging.info(f"Saved profile {name} ({label}, {duration * 1000:.1f} ms)")
+    except Exception as e:
+        logging.error(f"Error saving profile for {label}: {e}")
+        name = None
+    return result, name
+
+def save_profile(label, profiler, snapshot, duration, peak):
+    """Tulis pstats, collapsed stack, ringkasan teks, dan metadata profil"""
+    os.makedirs(PROFILE_DIR, mode=0o750, exist_ok=True)
+    name = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{re.sub(r'[^A-Za-z0-9_-]', '_', label)}"
+    base = os.path.join(PROFILE_DIR, name)
+    profiler.dump_stats(base + '.pstats')
+    
+    summary = io.StringIO()
+    stats = pstats.Stats(profiler, stream=summary)
+    stats.sort_stats('cumulative').print_stats(40)
+    summary.write("\nTop allocations (tracemalloc):\n")
+    for stat in snapshot.statistics('lineno')[:20]:
+        summary.write(f"{stat}\n")
+    with open(base + '.txt', 'w') as f:
+        f.write(summary.getvalue())
+    with open(base + '.collapsed', 'w') as f:
+        f.write(collapse_profile_stats(stats.stats))
+    with open(base + '.json', 'w') as f:
+        json.dump({
+            'name': name,
+            'label': label,
+            'created': datetime.now().isoformat(),
+            'duration_ms': round(duration * 1000, 3),
+            'peak_memory_kb': round(peak / 1024, 1),
+            'user': session.get('username') if has_request_context() else None,
+        }, f)
+    prune_profiles()
+    return name
+
+def get_profile_list():
+    """Daftar profil terbaru (metadata dari file .json)"""
+    profiles = []
+    try:
+        names = [name for name in os.listdir(PROFILE_DIR) if name.endswith('.json')]
+    except OSError:
+        return profiles
+    for name in sorted(names, reverse=True):
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+def profiled(target):
+    """Decorator route: profil request jika header X-Profile dikirim atau target sedang di-arm"""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            if not request.headers.get('X-Profile') and not consume_profile_flag(target):
+                return f(*args, **kwargs)
+            result, name = run_profiled(target, f, *args, **kwargs)
+            response = make_response(result)
+            if name:
+                response.headers['X-Profile-Id'] = name
+            return response
+        return wrapped
+    return decorator
+
+# Generasi data untuk ETag dan cache fragmen halaman
+FRAGMENT_CACHE_SIZE = 64
+RULES_PER_PAGE = 200
+APP_INSTANCE_ID = secrets.token_hex(8)
+
+data_generation = {
+    'db': 0,
+    'rules': 0,
+    'backups': 0,
+    'ruleset': 0,
+    'monitor_active': False,
+    'next_expiry': None,
+}
+generation_lock = threading.Lock()
+_fragment_cache = OrderedDict()
+
+def bump_generation(kind):
+    """Naikkan generasi data setelah penulisan (db, rules, backups, atau ruleset)"""
+    with generation_lock:
+        data_generation[kind] += 1
+
+def db_token():
+    """Token versi database tanpa menyentuh SQLite (generasi + stat file)"""
+    try:
+        stat = os.stat(DB_FILE)
+        return (data_generation['db'], stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return (data_generation['db'], None, None)
+
+def backup_token():
+    """Token versi katalog backup"""
+    try:
+        stat = os.stat(BACKUP_DIR)
+        return (data_generation['backups'], stat.st_mtime_ns)
+    except OSError:
+        return (data_generation['backups'], None)
+
+def ruleset_token():
+    """Token versi ruleset kernel; None jika nft monitor tidak aktif"""
+    if not data_generation['monitor_active']:
+        return None
+    return data_generation['ruleset']
+
+def expiry_due():
+    """Cek apakah ada aturan yang seharusnya sudah expired sejak pembacaan terakhir"""
+    next_expiry = data_generation['next_expiry']
+    return next_expiry is not None and datetime.now() >= next_expiry
+
+def render_fragment(name, key, template, **context):
+    """Render template parsial dengan cache LRU berdasarkan kunci versi data"""
+    cache_key = (name, key)
+    with generation_lock:
+        if cache_key in _fragment_cache:
+            _fragment_cache.move_to_end(cache_key)
+            return _fragment_cache[cache_key]
+    html = render_template(template, **context)
+    with generation_lock:
+        _fragment_cache[cache_key] = html
+        while len(_fragment_cache) > FRAGMENT_CACHE_SIZE:
+            _fragment_cache.popitem(last=False)
+    return html
+
+def get_cached_fragment(name, key):
+    """Ambil fragmen dari cache tanpa render (None jika belum ada)"""
+    with generation_lock:
+        html = _fragment_cache.get((name, key))
+        if html is not None:
+            _fragment_cache.move_to_end((name, key))
+        return html
+
+def conditional_view(*sources):
+    """Decorator ETag: jawab If-None-Match dengan 304 tanpa query SQLite atau nft"""
+    token_sources = {
+        'db': lambda: None if expiry_due() else db_token(),
+        'backups': backup_token,
+        'ruleset': ruleset_token,
+    }
+    
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            # Halaman dengan flash message selalu dirender ulang
+            if session.get('_flashes'):
+                return f(*args, **kwargs)
+            parts = [APP_INSTANCE_ID, request.endpoint, request.full_path,
+                     session.get('user_id'), session.get('username')]
+            for source in sources:
+                token = token_sources[source]()
+                if token is None:
+                    return f(*args, **kwargs)
+                parts.append(token)
+            etag = hashlib.sha256(repr(parts).encode()).hexdigest()[:32]
+            if request.if_none_match.contains(etag):
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapped
+    return decorator
+
 # Fungsi untuk menonaktifkan aturan yang sudah expired
+@timed_operation('nftm_expiry_run_seconds')
 def check_expired_rules():
     """Memeriksa dan menonaktifkan aturan yang sudah melewati waktu expired"""
     try:
-        conn = sqlite3.connect(DB_FILE)
+        conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
         c = conn.cursor()
         
         # Dapatkan waktu saat ini
@@ -78,6 +885,7 @@ def check_expired_rules():
         
         if expired_rules:
             logging.info(f"Found {len(expired_rules)} expired rules to disable")
+            inc_counter('nftm_expired_rules_total', len(expired_rules))
             
             # Nonaktifkan aturan yang sudah expired
             for rule in expired_rules:
@@ -85,9 +893,10 @@ def check_expired_rules():
                     UPDATE rules SET enabled = 0, updated_at = CURRENT_TIMESTAMP 
                     WHERE id = ?
                 """, (rule[0],))
-                logging.info(f"Disabled expired rule: {rule[1]} (ID: {rule[0]})")
+                logging.info(f"Disabled expired rule: {rule[1]} (ID: {rule[0]})", extra={'rule_id': rule[0]})
             
             conn.commit()
+            bump_generation('db')
             
             # Simpan perubahan ke file konfigurasi
             save_rules()
@@ -101,8 +910,12 @@ def check_expired_rules():
 def expired_rules_checker():
     """Menjalankan pengecekan aturan expired setiap jam"""
     while True:
+        request_id_var.set(new_request_id())
         try:
-            check_expired_rules()
+            if consume_profile_flag('expiry'):
+                run_profiled('expiry', check_expired_rules)
+            else:
+                check_expired_rules()
             time.sleep(3600)  # 1 jam sebelum pengecekan lanjut kembali
         except Exception as e:
             logging.error(f"Error in expired rules checker: {e}")
@@ -122,6 +935,7 @@ def ensure_directory_exists(path):
     return True
 
 # Fungsi backup konfigurasi dan database
+@timed_operation('nftm_backup_seconds', counter='nftm_backup_total', operation='create')
 def backup_config():
     """Backup konfigurasi nftables dan database"""
     try:
@@ -172,7 +986,7 @@ def backup_config():
         if os.path.exists(DB_FILE):
             db_backup_file = os.path.join(backup_subdir, "firewall.db")
             try:
-                shutil.copy2(DB_FILE, db_backup_file)
+                snapshot_database(db_backup_file)
                 os.chmod(db_backup_file, 0o640)
                 logging.info(f"Backed up database to {db_backup_file}")
             except Exception as e:
@@ -209,6 +1023,7 @@ def backup_config():
         
         logging.info(f"Backup verification - nftables: {nft_exists}, db: {db_exists}, info: {info_exists}")
         
+        bump_generation('backups')
         if nft_exists and db_exists and info_exists:
             return True, f"Backup created: {backup_subdir}"
         else:
@@ -223,10 +1038,10 @@ def get_backup_list():
     """Mendapatkan daftar backup yang tersedia"""
     backups = []
     try:
-        logging.info(f"Checking for backups in: {BACKUP_DIR}")
+        logging.info(f"Checking for backups in: {BACKUP_DIR}", extra={'sample': 'backup_list'})
         
         if os.path.exists(BACKUP_DIR):
-            logging.info("Backup directory exists")
+            logging.info("Backup directory exists", extra={'sample': 'backup_list'})
             
             for item in os.listdir(BACKUP_DIR):
                 item_path = os.path.join(BACKUP_DIR, item)
@@ -257,12 +1072,13 @@ def get_backup_list():
                             'has_info': has_info,
                             'size': total_size
                         })
-                        logging.info(f"Found backup: {item} (nftables: {has_nftables}, db: {has_db}, info: {has_info})")
+                        logging.info(f"Found backup: {item} (nftables: {has_nftables}, db: {has_db}, info: {has_info})",
+                                     extra={'sample': 'backup_item'})
                     except Exception as e:
                         logging.error(f"Error processing backup {item}: {e}")
             
             backups.sort(key=lambda x: x['created'], reverse=True)
-            logging.info(f"Total backups found: {len(backups)}")
+            logging.info(f"Total backups found: {len(backups)}", extra={'sample': 'backup_list'})
         else:
             logging.warning("Backup directory does not exist")
             
@@ -287,6 +1103,7 @@ def delete_backup(backup_path):
         
         try:
             shutil.rmtree(backup_path)
+            bump_generation('backups')
             logging.info(f"Successfully deleted backup: {backup_path}")
             return True, f"Backup deleted: {os.path.basename(backup_path)}"
         except Exception as e:
@@ -298,6 +1115,7 @@ def delete_backup(backup_path):
         return False, f"Unexpected error: {e}"
 
 # Fungsi restore dari backup
+@timed_operation('nftm_backup_seconds', counter='nftm_backup_total', operation='restore')
 def restore_from_backup(backup_path):
     """Restore konfigurasi dan database dari backup"""
     try:
@@ -324,8 +1142,20 @@ def restore_from_backup(backup_path):
                 
                 shutil.copy2(db_backup_file, DB_FILE)
                 os.chmod(DB_FILE, 0o640)
+                bump_generation('db')
                 logging.info(f"Restored database from {db_backup_file}")
                 
+                # Backup dari versi lama dimigrasikan ke skema terbaru
+                conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+                try:
+                    migrate_db(conn)
+                finally:
+                    conn.close()
+                # Versi aturan di file backup bisa sama dengan versi sebelumnya; snapshot tetap dibangun ulang
+                bump_generation('rules')
+                load_flowtable_config()
+                load_dynamic_entries()
+                
             except Exception as e:
                 logging.error(f"Error restoring database: {e}")
                 return False, f"Error restoring database: {e}"
@@ -359,6 +1189,228 @@ def restore_from_backup(backup_path):
         logging.error(f"Error restoring from backup: {e}")
         return False, f"Error restoring from backup: {e}"
 
+def snapshot_database(path):
+    """Salin DB_FILE memakai online backup API SQLite (konsisten walau ada penulisan berjalan)"""
+    source = sqlite3.connect(DB_FILE)
+    target = sqlite3.connect(path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+# Arsip backup: tarball terkompresi yang di-stream langsung ke/dari HTTP tanpa file sementara
+BACKUP_ARCHIVE_FILES = ('nftables.conf', 'firewall.db', 'backup_info.txt')
+BACKUP_REQUIRED_FILES = ('firewall.db', 'nftables.conf')  # backup tanpa keduanya tidak bisa di-restore
+BACKUP_MANIFEST = 'manifest.json'
+BACKUP_ARCHIVE_VERSION = 1
+BACKUP_CHUNK_SIZE = 64 * 1024
+BACKUP_UPLOAD_MAX_SIZE = 512 * 1024 * 1024  # batas total isi arsip setelah dekompresi
+ARCHIVE_MAGIC = {'gz': b'\x1f\x8b', 'zst': b'\x28\xb5\x2f\xfd'}
+ARCHIVE_ERRORS = (tarfile.TarError, zlib.error, ValueError, OSError, sqlite3.Error) + \
+    ((zstandard.ZstdError,) if zstandard is not None else ())
+
+def archive_formats():
+    """Format kompresi yang tersedia (zst hanya jika modul zstandard terpasang)"""
+    return ('zst', 'gz') if zstandard is not None else ('gz',)
+
+def resolve_backup_path(backup_name):
+    """Path direktori backup dari namanya; None jika nama tidak valid atau tidak ada"""
+    if not backup_name or os.path.basename(backup_name) != backup_name or not backup_name.startswith("backup_"):
+        return None
+    path = os.path.join(BACKUP_DIR, backup_name)
+    return path if os.path.isdir(path) else None
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BACKUP_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def build_backup_manifest(backup_path):
+    """Manifest arsip: nama backup dan checksum SHA-256 tiap file"""
+    files = {}
+    for name in BACKUP_ARCHIVE_FILES:
+        path = os.path.join(backup_path, name)
+        if os.path.isfile(path):
+            files[name] = {'size': os.path.getsize(path), 'sha256': _file_sha256(path)}
+    return {
+        'version': BACKUP_ARCHIVE_VERSION,
+        'name': os.path.basename(backup_path),
+        'created': datetime.fromtimestamp(os.path.getctime(backup_path)).isoformat(),
+        'exported': datetime.now().isoformat(),
+        'files': files,
+    }
+
+def _tar_member(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o640
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+def _tar_padding(size):
+    return b'\0' * (-size % tarfile.BLOCKSIZE)
+
+def _tar_stream(backup_path, manifest):
+    """Blok tar mentah: manifest lebih dulu, lalu tiap file dibaca per chunk"""
+    data = json.dumps(manifest, indent=2, sort_keys=True).encode()
+    yield _tar_member(BACKUP_MANIFEST, len(data), time.time()) + data + _tar_padding(len(data))
+    for name, meta in manifest['files'].items():
+        path = os.path.join(backup_path, name)
+        with open(path, 'rb') as f:
+            yield _tar_member(name, meta['size'], os.fstat(f.fileno()).st_mtime)
+            remaining = meta['size']
+            while remaining:
+                chunk = f.read(min(BACKUP_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f"{name} changed while it was being archived")
+                remaining -= len(chunk)
+                yield chunk
+        yield _tar_padding(meta['size'])
+    yield b'\0' * (2 * tarfile.BLOCKSIZE)
+
+def stream_backup_archive(backup_path, compression='gz'):
+    """Generator arsip backup terkompresi (gzip atau zstd); memori konstan berapa pun ukurannya"""
+    if compression == 'zst':
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = container gzip
+    manifest = build_backup_manifest(backup_path)
+    for block in _tar_stream(backup_path, manifest):
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+class _DecompressingReader:
+    """File-like read() di atas stream terkompresi; output per read dibatasi dan total diawasi"""
+    
+    def __init__(self, stream, compression, limit):
+        if compression == 'zst':
+            self.reader = zstandard.ZstdDecompressor().stream_reader(stream, read_size=BACKUP_CHUNK_SIZE)
+        else:
+            self.reader = None
+            self.stream = stream
+            self.decompressor = zlib.decompressobj(31)  # wbits 31 = container gzip
+        self.limit = limit
+        self.total = 0
+    
+    def _inflate(self, size):
+        while not self.decompressor.eof:
+            source = self.decompressor.unconsumed_tail or self.stream.read(BACKUP_CHUNK_SIZE)
+            if not source:
+                return self.decompressor.flush()
+            # max_length menjaga arsip yang sangat terkompresi tidak mengembang di memori
+            data = self.decompressor.decompress(source, size)
+            if data:
+                return data
+        return b''
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = BACKUP_CHUNK_SIZE
+        data = self.reader.read(size) if self.reader is not None else self._inflate(size)
+        self.total += len(data)
+        if self.total > self.limit:
+            raise ValueError(f"Archive exceeds the maximum size of {self.limit // (1024 * 1024)} MB")
+        return data
+
+class _PrefixedStream:
+    """Kembalikan byte magic yang sudah dibaca ke depan stream"""
+    
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+    
+    def read(self, size=-1):
+        if self.prefix:
+            data, self.prefix = self.prefix, b''
+            return data
+        return self.stream.read(size)
+
+def import_backup_archive(stream):
+    """Ekstrak arsip backup dari stream, verifikasi checksum, lalu daftarkan sebagai backup baru
+
+    File ditulis per chunk ke direktori staging di BACKUP_DIR dan baru di-rename menjadi
+    backup_<timestamp> setelah manifest, checksum dan database lolos verifikasi.
+    Mengembalikan (sukses, pesan).
+    """
+    magic = stream.read(4)
+    compression = next((name for name, prefix in ARCHIVE_MAGIC.items() if magic.startswith(prefix)), None)
+    if compression is None:
+        return False, "Unsupported archive format (expected .tar.gz or .tar.zst)"
+    if compression not in archive_formats():
+        return False, "zstd archives require the zstandard module"
+    if not ensure_directory_exists(BACKUP_DIR):
+        return False, "Failed to create backup directory"
+    staging = os.path.join(BACKUP_DIR, f".upload_{secrets.token_hex(8)}")
+    os.makedirs(staging, mode=0o750)
+    try:
+        reader = _DecompressingReader(_PrefixedStream(magic, stream), compression, BACKUP_UPLOAD_MAX_SIZE)
+        manifest = None
+        digests = {}
+        sizes = {}
+        with tarfile.open(fileobj=reader, mode='r|') as archive:
+            for member in archive:
+                name = member.name
+                if not member.isfile() or name not in BACKUP_ARCHIVE_FILES + (BACKUP_MANIFEST,) or name in digests:
+                    return False, f"Unexpected archive member: {name}"
+                source = archive.extractfile(member)
+                if name == BACKUP_MANIFEST:
+                    if member.size > BACKUP_CHUNK_SIZE:
+                        return False, "Manifest is too large"
+                    manifest = json.loads(source.read().decode())
+                    digests[name] = None
+                    continue
+                digest = hashlib.sha256()
+                size = 0
+                path = os.path.join(staging, name)
+                with open(path, 'wb') as f:
+                    for chunk in iter(lambda: source.read(BACKUP_CHUNK_SIZE), b''):
+                        digest.update(chunk)
+                        size += len(chunk)
+                        f.write(chunk)
+                os.chmod(path, 0o640)
+                digests[name] = digest.hexdigest()
+                sizes[name] = size
+        if not isinstance(manifest, dict) or not isinstance(manifest.get('files'), dict):
+            return False, "Archive has no valid manifest"
+        if manifest.get('version') != BACKUP_ARCHIVE_VERSION:
+            return False, f"Unsupported archive version: {manifest.get('version')}"
+        expected = manifest['files']
+        received = {name: digest for name, digest in digests.items() if name != BACKUP_MANIFEST}
+        missing = [name for name in BACKUP_REQUIRED_FILES if name not in expected]
+        if missing:
+            return False, f"Archive is missing required files: {', '.join(missing)}"
+        if set(expected) != set(received):
+            return False, "Archive contents do not match the manifest"
+        for name, meta in expected.items():
+            if not isinstance(meta, dict) or meta.get('sha256') != received[name]:
+                return False, f"Checksum mismatch for {name}"
+            if type(meta.get('size')) is not int or meta['size'] != sizes[name]:
+                return False, f"Size mismatch for {name}"
+        conn = sqlite3.connect(f"file:{os.path.join(staging, 'firewall.db')}?mode=ro", uri=True)
+        try:
+            if conn.execute("PRAGMA quick_check").fetchone()[0] != 'ok':
+                return False, "Database in archive failed the integrity check"
+        finally:
+            conn.close()
+        name = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        while os.path.exists(os.path.join(BACKUP_DIR, name)):
+            name += "_1"
+        os.rename(staging, os.path.join(BACKUP_DIR, name))
+        bump_generation('backups')
+        logging.info(f"Imported backup archive {manifest.get('name')} as {name} ({len(received)} files)")
+        return True, f"Backup imported as {name}"
+    except ARCHIVE_ERRORS as e:
+        logging.error(f"Error importing backup archive: {e}")
+        return False, f"Invalid backup archive: {e}"
+    finally:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging, ignore_errors=True)
+
 # Fungsi untuk mengecek status nftables
 def check_nftables_status():
     """Mengecek status service nftables"""
@@ -372,7 +1424,7 @@ def check_nftables_status():
                 'message': 'systemctl not available'
             }
             
-        check_service = subprocess.run([SYSTEMCTL, 'is-enabled', 'nftables'], 
+        check_service = run_command([SYSTEMCTL, 'is-enabled', 'nftables'], 
                                      capture_output=True, text=True)
         
         if check_service.returncode != 0:
@@ -383,17 +1435,17 @@ def check_nftables_status():
                 'message': 'nftables service is not installed'
             }
         
-        status_result = subprocess.run([SYSTEMCTL, 'is-active', 'nftables'], 
+        status_result = run_command([SYSTEMCTL, 'is-active', 'nftables'], 
                                     capture_output=True, text=True)
         
         is_active = status_result.returncode == 0
         
-        enabled_result = subprocess.run([SYSTEMCTL, 'is-enabled', 'nftables'], 
+        enabled_result = run_command([SYSTEMCTL, 'is-enabled', 'nftables'], 
                                       capture_output=True, text=True)
         
         is_enabled = enabled_result.returncode == 0
         
-        status_detail = subprocess.run([SYSTEMCTL, 'status', 'nftables'], 
+        status_detail = run_command([SYSTEMCTL, 'status', 'nftables'], 
                                     capture_output=True, text=True)
         
         return {
@@ -414,7 +1466,7 @@ def check_nftables_status():
 # Fungsi untuk mengubah password user
 def change_password(user_id, current_password, new_password):
     """Mengubah password user"""
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
     c = conn.cursor()
     
     c.execute("SELECT password FROM users WHERE id=?", (user_id,))
@@ -444,10 +1496,8 @@ def change_password(user_id, current_password, new_password):
         return False, f"Error changing password: {e}"
 
 # Inisialisasi Database
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    
+# Migrasi skema berurutan; versi yang sudah diterapkan disimpan di PRAGMA user_version
+def _migration_base_schema(c):
     # Tabel untuk user login
     c.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -489,15 +1539,48 @@ def init_db():
         )
     """)
     
-    # Cek apakah kolom expired_at sudah ada
+    # Tabel untuk node fleet (agent yang menerima ruleset dari controller)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS nodes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            address TEXT NOT NULL,
+            port INTEGER DEFAULT 2108,
+            token TEXT NOT NULL,
+            canary BOOLEAN DEFAULT 0,
+            enabled BOOLEAN DEFAULT 1,
+            last_status TEXT,
+            last_message TEXT,
+            last_hash TEXT,
+            last_push_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    
+    # Database lama (sebelum migrasi berversi) bisa sudah memiliki sebagian kolom ini
     c.execute("PRAGMA table_info(rules)")
     columns = [column[1] for column in c.fetchall()]
     
     if 'expired_at' not in columns:
         logging.info("Adding expired_at column to rules table")
         c.execute("ALTER TABLE rules ADD COLUMN expired_at TIMESTAMP")
-        conn.commit()
     
+    # Kolom target tag untuk aturan, grup, dan node fleet
+    if 'target_tags' not in columns:
+        logging.info("Adding target_tags column to rules table")
+        c.execute("ALTER TABLE rules ADD COLUMN target_tags TEXT")
+    
+    c.execute("PRAGMA table_info(rule_groups)")
+    if 'target_tags' not in [column[1] for column in c.fetchall()]:
+        logging.info("Adding target_tags column to rule_groups table")
+        c.execute("ALTER TABLE rule_groups ADD COLUMN target_tags TEXT")
+    
+    c.execute("PRAGMA table_info(nodes)")
+    if 'tags' not in [column[1] for column in c.fetchall()]:
+        logging.info("Adding tags column to nodes table")
+        c.execute("ALTER TABLE nodes ADD COLUMN tags TEXT")
+
+def _migration_default_data(c):
     # Buat user default jika belum ada
     c.execute("SELECT * FROM users WHERE username = 'admin'")
     if not c.fetchone():
@@ -581,9 +1664,192 @@ def init_db():
             'Allow ICMP echo requests for monitoring and troubleshooting', True, None
         ))
         logging.info("Added default rule for ICMP (Ping)")
-    
-    conn.commit()
-    conn.close()
+
+def _migration_app_state(c):
+    # Status aplikasi (mis. hash ruleset yang terakhir diterapkan)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS app_state (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+def _migration_rule_types(c):
+    # Jenis aturan (static / ratelimit / connlimit) beserta nilai limitnya
+    c.execute("ALTER TABLE rules ADD COLUMN rule_type TEXT DEFAULT 'static'")
+    c.execute("ALTER TABLE rules ADD COLUMN limit_value TEXT")
+
+def _migration_feeds(c):
+    # Langganan threat feed; elemen versi terakhir disimpan untuk menghitung diff berikutnya
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS feeds (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            url TEXT NOT NULL,
+            chain TEXT NOT NULL DEFAULT 'input',
+            action TEXT NOT NULL DEFAULT 'drop',
+            interval INTEGER NOT NULL DEFAULT 3600,
+            enabled BOOLEAN DEFAULT 1,
+            etag TEXT,
+            last_modified TEXT,
+            last_checked TIMESTAMP,
+            last_changed TIMESTAMP,
+            last_status TEXT,
+            last_message TEXT,
+            element_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS feed_elements (
+            feed_id INTEGER NOT NULL,
+            element TEXT NOT NULL,
+            PRIMARY KEY (feed_id, element)
+        ) WITHOUT ROWID
+    """)
+
+def _migration_api_tokens(c):
+    # Token API untuk otomasi; hanya hash SHA-256 yang disimpan
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS api_tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            token_hash TEXT UNIQUE NOT NULL,
+            prefix TEXT NOT NULL,
+            user_id INTEGER,
+            revoked BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+
+def _migration_dynamic_lists(c):
+    # Isi daftar dinamis block/allow; expires_at berupa epoch detik (NULL = permanen)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS dynamic_entries (
+            list TEXT NOT NULL,
+            address TEXT NOT NULL,
+            expires_at REAL,
+            comment TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (list, address)
+        ) WITHOUT ROWID
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_dynamic_entries_expires ON dynamic_entries(expires_at)")
+
+def _migration_changesets(c):
+    # Changeset: operasi aturan/grup yang di-staging sebelum diterapkan sekaligus
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS changesets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'draft',
+            user_id INTEGER,
+            message TEXT,
+            snapshot TEXT,
+            confirm_deadline REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            committed_at TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS changeset_operations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            changeset_id INTEGER NOT NULL,
+            operation TEXT NOT NULL,
+            summary TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (changeset_id) REFERENCES changesets(id)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_changeset_operations ON changeset_operations(changeset_id, id)")
+
+def _migration_geoip(c):
+    # Match negara/ASN pada aturan; elemen set per kode disimpan untuk menghitung diff saat file GeoIP berubah
+    c.execute("ALTER TABLE rules ADD COLUMN geo TEXT")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS geo_sets (
+            name TEXT PRIMARY KEY,
+            code TEXT NOT NULL,
+            family TEXT NOT NULL,
+            source TEXT,
+            validator TEXT,
+            element_count INTEGER DEFAULT 0,
+            updated_at TIMESTAMP
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS geo_elements (
+            set_name TEXT NOT NULL,
+            element TEXT NOT NULL,
+            PRIMARY KEY (set_name, element)
+        ) WITHOUT ROWID
+    """)
+
+def _migration_rule_store_version(c):
+    # Versi aturan/grup dijaga trigger sehingga snapshot di memori hanya dibangun ulang jika kedua tabel
+    # ini berubah, bukan setiap kali tabel lain (token API, daftar dinamis, feed) ditulis
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS rule_store_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    """)
+    c.execute("INSERT OR IGNORE INTO rule_store_version (id, version) VALUES (1, 0)")
+    for table in ('rules', 'rule_groups'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_version AFTER {event} ON {table}
+                BEGIN
+                    UPDATE rule_store_version SET version = version + 1 WHERE id = 1;
+                END
+            """)
+
+SCHEMA_MIGRATIONS = [
+    (1, "Base schema", _migration_base_schema),
+    (2, "Default admin user, groups and rules", _migration_default_data),
+    (3, "Application state table", _migration_app_state),
+    (4, "Rate limit and connection limit rule types", _migration_rule_types),
+    (5, "Threat feed subscriptions", _migration_feeds),
+    (6, "API tokens", _migration_api_tokens),
+    (7, "Dynamic block/allow lists", _migration_dynamic_lists),
+    (8, "Staged changesets", _migration_changesets),
+    (9, "GeoIP country and ASN matches", _migration_geoip),
+    (10, "Rule and group version triggers", _migration_rule_store_version),
+]
+
+def migrate_db(conn):
+    """Terapkan migrasi yang belum dijalankan; tanpa query lain jika skema sudah terbaru"""
+    c = conn.cursor()
+    c.execute("PRAGMA user_version")
+    version = c.fetchone()[0]
+    for target, description, migration in SCHEMA_MIGRATIONS:
+        if target <= version:
+            continue
+        logging.info(f"Applying database migration {target}: {description}")
+        try:
+            c.execute("BEGIN")
+            migration(c)
+            c.execute(f"PRAGMA user_version = {int(target)}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        version = target
+        bump_generation('db')
+    return version
+
+def init_db():
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    try:
+        migrate_db(conn)
+    finally:
+        conn.close()
+    load_flowtable_config()
+    load_dynamic_entries()
     
     # Pastikan direktori untuk file konfigurasi ada
     logging.info("=== Initializing directories ===")
@@ -594,16 +1860,6 @@ def init_db():
     logging.info(f"NFT config path: {NFT_CONF}")
     logging.info(f"Backup directory: {BACKUP_DIR}")
     
-    if os.path.exists(BACKUP_DIR):
-        logging.info("Backup directory exists")
-        try:
-            files = os.listdir(BACKUP_DIR)
-            logging.info(f"Files in backup directory: {files}")
-        except Exception as e:
-            logging.error(f"Error listing backup directory: {e}")
-    else:
-        logging.warning("Backup directory does not exist")
-    
     if not os.path.exists(NFT_CONF):
         logging.warning(f"nftables config file {NFT_CONF} does not exist, creating empty file")
         try:
@@ -615,133 +1871,1321 @@ def init_db():
             logging.error(f"Error creating empty nftables config: {e}")
 
 # Fungsi Database
-def get_groups():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+def get_app_state(key):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
     c = conn.cursor()
-    c.execute("SELECT * FROM rule_groups ORDER BY name")
-    rows = c.fetchall()
+    c.execute("SELECT value FROM app_state WHERE key = ?", (key,))
+    row = c.fetchone()
     conn.close()
-    return rows
+    return row[0] if row else None
 
-def get_group(group_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+def set_app_state(key, value):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
     c = conn.cursor()
-    c.execute("SELECT * FROM rule_groups WHERE id=?", (group_id,))
-    row = c.fetchone()
+    c.execute("""
+        INSERT INTO app_state (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+    """, (key, value))
+    conn.commit()
     conn.close()
-    return row
 
-def get_rules(group_id=None):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+# Snapshot aturan dan grup di memori: pembacaan tanpa lock dan tanpa SQLite
+RULE_COLUMNS = ('id', 'name', 'group_id', 'chain', 'src', 'dst', 'dport', 'protocol', 'action', 'comment',
+                'enabled', 'expired_at', 'created_at', 'updated_at', 'target_tags', 'rule_type', 'limit_value', 'geo',
+                'group_name', 'group_color', 'group_target_tags')
+GROUP_COLUMNS = ('id', 'name', 'description', 'color', 'created_at', 'target_tags')
+# Kolom bernilai unik per aturan tidak di-intern saat snapshot dibangun
+RULE_UNIQUE_COLUMNS = ('id', 'name', 'comment')
+
+class _Record(Mapping):
+    """Record immutable berbasis __slots__ yang sekaligus berperilaku sebagai mapping read-only
+
+    Mendukung record['kolom'], record.get(), dict(record) dan akses atribut di template,
+    tanpa __dict__ per objek.
+    """
     
-    current_time = datetime.now()
+    __slots__ = ()
+    _fieldset = frozenset()
     
-    if group_id:
-        c.execute("""
-            SELECT r.*, g.name as group_name, g.color as group_color 
-            FROM rules r 
-            LEFT JOIN rule_groups g ON r.group_id = g.id 
-            WHERE r.group_id = ? 
-            ORDER BY r.name
-        """, (group_id,))
-    else:
-        c.execute("""
-            SELECT r.*, g.name as group_name, g.color as group_color 
-            FROM rules r 
-            LEFT JOIN rule_groups g ON r.group_id = g.id 
-            ORDER BY g.name, r.name
-        """)
+    def __init__(self, values):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
     
-    rows = c.fetchall()
-    conn.close()
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
     
-    rules = [dict(row) for row in rows]
+    def __getitem__(self, key):
+        if key in self._fieldset:
+            return getattr(self, key)
+        raise KeyError(key)
     
-    updated_rules = []
-    for rule in rules:
-        if rule['expired_at'] and rule['enabled']:
-            try:
-                try:
-                    expired_at = datetime.fromisoformat(rule['expired_at'])
-                except ValueError:
-                    expired_at = datetime.strptime(rule['expired_at'], '%Y-%m-%d %H:%M:%S')
-                
-                if expired_at <= current_time:
-                    conn = sqlite3.connect(DB_FILE)
-                    c = conn.cursor()
-                    c.execute("""
-                        UPDATE rules SET enabled = 0, updated_at = CURRENT_TIMESTAMP 
-                        WHERE id = ?
-                    """, (rule['id'],))
-                    conn.commit()
-                    conn.close()
-                    
-                    rule['enabled'] = 0
-                    logging.info(f"Disabled expired rule: {rule['name']} (ID: {rule['id']})")
-            except (ValueError, TypeError) as e:
-                logging.error(f"Error parsing expired_at for rule {rule['name']}: {e}")
-        
-        updated_rules.append(rule)
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._fieldset else default
+    
+    def __contains__(self, key):
+        return key in self._fieldset
     
-    return updated_rules
+    def __iter__(self):
+        return iter(self.__slots__)
+    
+    def __len__(self):
+        return len(self.__slots__)
+    
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
 
-def get_rule(rule_id):
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("""
-        SELECT r.*, g.name as group_name, g.color as group_color 
-        FROM rules r 
-        LEFT JOIN rule_groups g ON r.group_id = g.id 
-        WHERE r.id = ?
-    """, (rule_id,))
+class RuleRecord(_Record):
+    __slots__ = RULE_COLUMNS
+    _fieldset = frozenset(RULE_COLUMNS)
+    values = operator.attrgetter(*RULE_COLUMNS)
+
+class GroupRecord(_Record):
+    __slots__ = GROUP_COLUMNS
+    _fieldset = frozenset(GROUP_COLUMNS)
+    values = operator.attrgetter(*GROUP_COLUMNS)
+
+class RuleSnapshot:
+    """Snapshot immutable seluruh aturan dan grup beserta indeks per id, grup dan chain"""
+    
+    __slots__ = ('token', 'db_token', 'rules', 'by_id', 'by_group', 'by_chain', 'groups', 'groups_by_id',
+                 'next_expiry')
+    
+    def __init__(self, token, db_token, rules, groups, next_expiry):
+        self.token = token
+        self.db_token = db_token
+        self.rules = rules
+        self.groups = groups
+        self.next_expiry = next_expiry
+        self.by_id = {rule.id: rule for rule in rules}
+        self.groups_by_id = {group.id: group for group in groups}
+        by_group = {}
+        by_chain = {}
+        for rule in rules:
+            by_group.setdefault(rule.group_id, []).append(rule)
+            by_chain.setdefault(rule.chain, []).append(rule)
+        self.by_group = {key: tuple(items) for key, items in by_group.items()}
+        self.by_chain = {key: tuple(items) for key, items in by_chain.items()}
+
+_rule_snapshot = None
+_rule_snapshot_checked = None  # db_token() terakhir yang terbukti tidak mengubah versi aturan/grup
+rule_store_lock = threading.Lock()
+
+def rule_store_token(c):
+    """Versi aturan/grup: baris yang dijaga trigger, generasi restore, dan path database"""
+    c.execute("SELECT version FROM rule_store_version WHERE id = 1")
     row = c.fetchone()
-    conn.close()
+    return (data_generation['rules'], DB_FILE, row[0] if row else None)
+
+def current_rule_store_token():
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    try:
+        return rule_store_token(conn.cursor())
+    finally:
+        conn.close()
+
+def _parse_expiry(value):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+def _build_records(cls, rows, previous, unique=()):
+    """Record dari baris SQLite; record snapshot lama yang isinya sama dipakai ulang (copy-on-write)"""
+    pool = {}
+    shared = [index for index, name in enumerate(cls.__slots__) if name not in unique]
+    records = []
+    for row in rows:
+        old = previous.get(row[0]) if previous else None
+        if old is not None and old.values(old) == row:
+            records.append(old)
+            continue
+        row = list(row)
+        for index in shared:
+            value = row[index]
+            if isinstance(value, str):
+                row[index] = pool.setdefault(value, value)
+        records.append(cls(row))
+    return tuple(records)
+
+@timed_operation('nftm_rule_snapshot_seconds')
+def load_rule_snapshot(previous=None):
+    """Bangun snapshot baru dari SQLite; aturan yang sudah expired dinonaktifkan lebih dulu"""
+    while True:
+        # Token diambil sebelum SELECT: penulisan di antaranya membuat snapshot langsung usang
+        file_token = db_token()
+        conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+        try:
+            c = conn.cursor()
+            token = rule_store_token(c)
+            c.execute(f"SELECT {', '.join(GROUP_COLUMNS)} FROM rule_groups ORDER BY name")
+            group_rows = c.fetchall()
+            # Join dan ORDER BY dikerjakan di Python: jauh lebih murah daripada temp B-tree SQLite
+            c.execute(f"SELECT {', '.join(RULE_COLUMNS[:-3])} FROM rules")
+            rows = c.fetchall()
+        finally:
+            conn.close()
+        group_values = {row[0]: (row[1], row[3], row[5]) for row in group_rows}
+        missing = (None, None, None)
+        rows = [row + group_values.get(row[2], missing) for row in rows]
+        # Urutan sama dengan ORDER BY g.name, r.name (NULL lebih dulu)
+        name_index = len(RULE_COLUMNS) - 3
+        rows.sort(key=lambda row: (row[name_index] is not None, row[name_index] or '', row[1]))
+        
+        now = datetime.now()
+        next_expiry = None
+        expired = []
+        for row in rows:
+            if row[11] and row[10]:
+                try:
+                    expired_at = _parse_expiry(row[11])
+                except (ValueError, TypeError) as e:
+                    logging.error(f"Error parsing expired_at for rule {row[1]}: {e}", extra={'rule_id': row[0]})
+                    continue
+                if expired_at <= now:
+                    expired.append(row)
+                elif next_expiry is None or expired_at < next_expiry:
+                    next_expiry = expired_at
+        if not expired:
+            break
+        conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+        try:
+            conn.executemany("UPDATE rules SET enabled = 0, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                             [(row[0],) for row in expired])
+            conn.commit()
+        finally:
+            conn.close()
+        bump_generation('db')
+        for row in expired:
+            logging.info(f"Disabled expired rule: {row[1]} (ID: {row[0]})", extra={'rule_id': row[0]})
     
-    if row:
-        return dict(row)
-    return None
+    groups = _build_records(GroupRecord, group_rows, previous.groups_by_id if previous else None)
+    rules = _build_records(RuleRecord, rows, previous.by_id if previous else None, RULE_UNIQUE_COLUMNS)
+    # Catat waktu expiry terdekat agar snapshot dan ETag tidak menyembunyikan aturan yang baru expired
+    with generation_lock:
+        data_generation['next_expiry'] = next_expiry
+    return RuleSnapshot(token, file_token, rules, groups, next_expiry)
+
+def rule_snapshot():
+    """Snapshot aktif; dibangun ulang hanya jika aturan/grup berubah atau ada aturan yang jatuh tempo
+
+    Selama file database tidak berubah snapshot dipakai tanpa menyentuh SQLite. Jika berubah, satu
+    SELECT baris versi menentukan apakah perubahan itu menyentuh aturan/grup atau hanya tabel lain.
+    """
+    global _rule_snapshot, _rule_snapshot_checked
+    snapshot = _rule_snapshot
+    if snapshot is not None and _rule_snapshot_checked == db_token() and not expiry_due():
+        return snapshot
+    with rule_store_lock:
+        snapshot = _rule_snapshot
+        file_token = db_token()
+        if snapshot is not None and not expiry_due():
+            if _rule_snapshot_checked == file_token:
+                return snapshot
+            if snapshot.token == current_rule_store_token():
+                _rule_snapshot_checked = file_token
+                return snapshot
+        snapshot = load_rule_snapshot(snapshot)
+        # Penggantian referensi bersifat atomik; pembaca lama tetap memegang snapshot sebelumnya
+        _rule_snapshot = snapshot
+        _rule_snapshot_checked = snapshot.db_token
+    return snapshot
+
+def rule_store_stats(snapshot=None):
+    """Perkiraan memori snapshot: objek record plus nilai yang tidak dibagi dengan record lain"""
+    snapshot = snapshot or rule_snapshot()
+    seen = set()
+    record_bytes = value_bytes = 0
+    for record in snapshot.rules:
+        record_bytes += sys.getsizeof(record)
+        for value in record.values(record):
+            if value is not None and id(value) not in seen:
+                seen.add(id(value))
+                value_bytes += sys.getsizeof(value)
+    index_bytes = sum(sys.getsizeof(index) for index in (snapshot.rules, snapshot.by_id, snapshot.by_group,
+                                                         snapshot.by_chain))
+    index_bytes += sum(sys.getsizeof(items) for items in snapshot.by_group.values())
+    index_bytes += sum(sys.getsizeof(items) for items in snapshot.by_chain.values())
+    count = len(snapshot.rules)
+    total = record_bytes + value_bytes + index_bytes
+    return {
+        'rules': count,
+        'groups': len(snapshot.groups),
+        'record_bytes': record_bytes,
+        'value_bytes': value_bytes,
+        'index_bytes': index_bytes,
+        'total_bytes': total,
+        'bytes_per_rule': round(total / count, 1) if count else 0,
+    }
+
+def get_groups():
+    return list(rule_snapshot().groups)
+
+def get_group(group_id):
+    return rule_snapshot().groups_by_id.get(group_id)
+
+def get_rules(group_id=None):
+    snapshot = rule_snapshot()
+    if group_id:
+        return list(snapshot.by_group.get(group_id, ()))
+    return list(snapshot.rules)
 
-def add_rule_to_db(name, group_id, chain, src, dst, dport, protocol, action, comment, enabled=True, expired_at=None):
-    conn = sqlite3.connect(DB_FILE)
+def get_rules_by_chain(chain):
+    return list(rule_snapshot().by_chain.get(chain, ()))
+
+def get_rule(rule_id):
+    return rule_snapshot().by_id.get(rule_id)
+
+def add_rule_to_db(name, group_id, chain, src, dst, dport, protocol, action, comment, enabled=True, expired_at=None,
+                   target_tags=None, rule_type='static', limit_value=None, geo=None):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
     c = conn.cursor()
     c.execute("""
-        INSERT INTO rules (name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at))
+        INSERT INTO rules (name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at,
+                           target_tags, rule_type, limit_value, geo)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at,
+          normalize_tags(target_tags), rule_type, limit_value, geo))
     conn.commit()
+    bump_generation('db')
     rule_id = c.lastrowid
     conn.close()
     return rule_id
 
-def update_rule_in_db(rule_id, name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at=None):
-    conn = sqlite3.connect(DB_FILE)
+def update_rule_in_db(rule_id, name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at=None,
+                      target_tags=None, rule_type='static', limit_value=None, geo=None):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
     c = conn.cursor()
     c.execute("""
         UPDATE rules SET name=?, group_id=?, chain=?, src=?, dst=?, dport=?, protocol=?, 
-        action=?, comment=?, enabled=?, expired_at=?, updated_at=CURRENT_TIMESTAMP 
+        action=?, comment=?, enabled=?, expired_at=?, target_tags=?, rule_type=?, limit_value=?, geo=?,
+        updated_at=CURRENT_TIMESTAMP 
         WHERE id=?
-    """, (name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at, rule_id))
+    """, (name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at,
+          normalize_tags(target_tags), rule_type, limit_value, geo, rule_id))
     conn.commit()
+    bump_generation('db')
     conn.close()
 
 def delete_rule_from_db(rule_id):
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
     c = conn.cursor()
     c.execute("DELETE FROM rules WHERE id=?", (rule_id,))
     conn.commit()
+    bump_generation('db')
     conn.close()
 
 def toggle_rule_in_db(rule_id):
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
     c = conn.cursor()
     c.execute("UPDATE rules SET enabled = NOT enabled, updated_at=CURRENT_TIMESTAMP WHERE id=?", (rule_id,))
     conn.commit()
+    bump_generation('db')
+    conn.close()
+
+# Set kernel yang isinya diperbarui di luar apply penuh (threat feed, daftar dinamis)
+set_lock = threading.Lock()  # serialisasi perubahan elemen set dengan reload penuh
+set_versions = {}  # ('feed', id) / ('geo', nama) -> versi elemen tersimpan, naik setiap kali database berubah
+_set_version_counter = itertools.count(1)
+
+def bump_set_version(key):
+    """Tandai elemen set di database berubah; dipanggil setelah commit"""
+    set_versions[key] = next(_set_version_counter)
+
+def invalidate_set_sync(rendered_sets=None):
+    """Reload penuh memuat elemen dari file; sinkronkan ulang isi set pada siklus berikutnya
+
+    rendered_sets berisi versi elemen yang ditulis render_ruleset() ke file yang baru dimuat.
+    Set yang database-nya tidak berubah sejak render tetap sinkron sehingga tidak diisi ulang.
+    """
+    feed_synced.clear()
+    geo_synced.clear()
+    for (kind, key), version in (rendered_sets or {}).items():
+        if set_versions.get((kind, key)) == version:
+            (feed_synced if kind == 'feed' else geo_synced).add(key)
+    feed_wakeup.set()
+    geo_wakeup.set()
+    dynamic_state['resync'] = True
+    dynamic_queue.put(None)  # bangunkan writer daftar dinamis
+
+def invalidates_set_sync(func):
+    """Decorator untuk operasi yang memuat ulang seluruh ruleset kernel
+
+    Pemanggil dapat meneruskan rendered_sets dari render_ruleset(); hanya dipakai jika reload berhasil.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, rendered_sets=None, **kwargs):
+        with set_lock:
+            result = None
+            try:
+                result = func(*args, **kwargs)
+                return result
+            finally:
+                invalidate_set_sync(rendered_sets if result and result[0] else None)
+    return wrapper
+
+# Threat feed: daftar blokir eksternal dimuat ke set bernama dan diperbarui hanya dengan selisih elemennya
+FEED_CHECK_INTERVAL = 60  # detik antar pengecekan feed yang jatuh tempo
+FEED_DEFAULT_INTERVAL = 3600  # detik antar fetch per feed
+FEED_FETCH_TIMEOUT = 30
+FEED_BATCH_CHUNK = 1000  # elemen per perintah add/delete element
+FEED_ACTIONS = ('drop', 'reject', 'accept')
+feed_wakeup = threading.Event()
+feed_synced = set()  # feed yang isi set kernelnya sama dengan database sejak reload penuh terakhir
+
+def feed_set_name(feed_id, family='ip'):
+    """Set kernel feed: feed_<id> untuk IPv4, pasangan feed6_<id> untuk IPv6"""
+    return f"feed6_{feed_id}" if family == 'ip6' else f"feed_{feed_id}"
+
+def get_feeds(enabled_only=False):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    if enabled_only:
+        c.execute("SELECT * FROM feeds WHERE enabled = 1 ORDER BY name")
+    else:
+        c.execute("SELECT * FROM feeds ORDER BY name")
+    rows = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return rows
+
+def get_feed(feed_id):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("SELECT * FROM feeds WHERE id=?", (feed_id,))
+    row = c.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+def load_feed_elements(feed_id, family=None):
+    """Elemen feed tersimpan; dengan family 'ip'/'ip6' hanya elemen untuk set family tersebut"""
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    c.execute("SELECT element FROM feed_elements WHERE feed_id=?", (feed_id,))
+    elements = [row[0] for row in c.fetchall()]
+    conn.close()
+    if family is not None:
+        elements = [element for element in elements if (':' in element) == (family == 'ip6')]
+    return elements
+
+def feed_statement(feed, family='ip'):
+    # Feed di chain output memblokir tujuan, selain itu memblokir sumber
+    direction = 'daddr' if feed['chain'] == 'output' else 'saddr'
+    return f"{family} {direction} @{feed_set_name(feed['id'], family)} {feed['action']}"
+
+def feed_set_definition(feed, family='ip'):
+    return {
+        'name': feed_set_name(feed['id'], family),
+        'feed_id': feed['id'],
+        'family': family,
+        'type': 'ipv6_addr' if family == 'ip6' else 'ipv4_addr',
+        'flags': 'interval',
+        'timeout': None,
+        'size': None,
+    }
+
+def parse_feed_interval(token):
+    """Ubah alamat atau CIDR (IPv4/IPv6) menjadi (versi, awal, akhir); ValueError jika tidak valid"""
+    if '/' in token:
+        network = ipaddress.ip_network(token, strict=False)
+        return network.version, int(network.network_address), int(network.broadcast_address)
+    address = ipaddress.ip_address(token)
+    return address.version, int(address), int(address)
+
+def parse_feed_lines(lines):
+    """Parse feed baris per baris (satu alamat/CIDR per baris, komentar '#' atau ';')
+
+    Mengembalikan ({4: interval IPv4, 6: interval IPv6} berupa (awal, akhir), jumlah baris tidak valid).
+    """
+    intervals = {4: [], 6: []}
+    invalid = 0
+    for raw in lines:
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8', 'replace')
+        line = raw.split('#', 1)[0].split(';', 1)[0].strip()
+        if not line:
+            continue
+        token = line.split()[0].rstrip(',')
+        try:
+            version, start, end = parse_feed_interval(token)
+        except ValueError:
+            invalid += 1
+            continue
+        intervals[version].append((start, end))
+    return intervals, invalid
+
+def merge_intervals(intervals):
+    """Gabungkan interval yang overlap atau bersebelahan (set interval nft menolak elemen yang overlap)"""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+def format_interval(start, end, version=4):
+    """Elemen set: alamat tunggal, prefix jika sejajar, selain itu rentang awal-akhir"""
+    family, width = (socket.AF_INET, 4) if version == 4 else (socket.AF_INET6, 16)
+    first = socket.inet_ntop(family, start.to_bytes(width, 'big'))
+    if start == end:
+        return first
+    size = end - start + 1
+    if size & (size - 1) == 0 and start % size == 0:
+        return f"{first}/{width * 8 - size.bit_length() + 1}"
+    return f"{first}-{socket.inet_ntop(family, end.to_bytes(width, 'big'))}"
+
+def open_feed(feed):
+    """Buka sumber feed dengan request kondisional
+
+    Mengembalikan (stream, etag, last_modified); stream None jika sumber tidak berubah.
+    File lokal memakai mtime dan ukuran sebagai validator.
+    """
+    url = feed['url']
+    if url.startswith(('http://', 'https://')):
+        headers = {'User-Agent': 'nftables-manager', 'X-Request-ID': ensure_request_id()}
+        if feed['etag']:
+            headers['If-None-Match'] = feed['etag']
+        if feed['last_modified']:
+            headers['If-Modified-Since'] = feed['last_modified']
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                                              timeout=FEED_FETCH_TIMEOUT)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None, feed['etag'], feed['last_modified']
+            raise
+        return response, response.headers.get('ETag'), response.headers.get('Last-Modified')
+    path = url[len('file://'):] if url.startswith('file://') else url
+    stat = os.stat(path)
+    validator = f"{stat.st_mtime_ns}-{stat.st_size}"
+    if validator == feed['etag']:
+        return None, validator, None
+    return open(path, 'rb'), validator, None
+
+def build_feed_batch(name, added, removed, flush=False):
+    """Susun perintah nft untuk set feed: delete dulu agar interval baru tidak overlap dengan yang lama"""
+    commands = [f"flush set {NFT_TABLE} {name}"] if flush else []
+    for verb, elements in (('delete', removed), ('add', added)):
+        for start in range(0, len(elements), FEED_BATCH_CHUNK):
+            chunk = ", ".join(elements[start:start + FEED_BATCH_CHUNK])
+            commands.append(f"{verb} element {NFT_TABLE} {name} {{ {chunk} }}")
+    return commands
+
+def record_feed_status(feed_id, status, message, **fields):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    fields.update(last_status=status, last_message=message, last_checked=datetime.now())
+    assignments = ", ".join(f"{name}=?" for name in fields)
+    c.execute(f"UPDATE feeds SET {assignments} WHERE id=?", (*fields.values(), feed_id))
+    conn.commit()
+    conn.close()
+
+def store_feed_elements(feed_id, added, removed):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN")
+        c.executemany("DELETE FROM feed_elements WHERE feed_id=? AND element=?",
+                      ((feed_id, element) for element in removed))
+        c.executemany("INSERT INTO feed_elements (feed_id, element) VALUES (?, ?)",
+                      ((feed_id, element) for element in added))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    bump_set_version(('feed', feed_id))
+
+def update_feed(feed_id, force=False):
+    """Fetch satu feed lalu terapkan hanya add/delete element untuk elemen yang berubah"""
+    feed = get_feed(feed_id)
+    if not feed:
+        return False, "Feed not found"
+    try:
+        with metric_timer('nftm_feed_update_seconds', feed=feed['name']):
+            source, etag, last_modified = open_feed(dict(feed, etag=None, last_modified=None) if force else feed)
+            new = invalid = None
+            if source is not None:
+                with source:
+                    intervals, invalid = parse_feed_lines(source)
+                new = {format_interval(start, end, version)
+                       for version, family in intervals.items() for start, end in merge_intervals(family)}
+            kernel = bool(feed['enabled']) and os.path.exists(NFT)
+            with set_lock:
+                full = kernel and feed_id not in feed_synced
+                if new is None and not full:
+                    record_feed_status(feed_id, 'unchanged', "Feed not modified since last fetch")
+                    return True, f"Feed {feed['name']} not modified"
+                old = set(load_feed_elements(feed_id))
+                if new is None:
+                    new = old
+                added, removed = sorted(new - old), sorted(old - new)
+                commands = []
+                for family in ADDRESS_FAMILIES.values():
+                    name = feed_set_name(feed_id, family)
+                    ipv6 = family == 'ip6'
+                    elements = [[element for element in group if (':' in element) == ipv6]
+                                for group in (sorted(new), added, removed)]
+                    # Setelah reload penuh isi set kernel berasal dari file, jadi ganti seluruh isinya sekali
+                    commands += build_feed_batch(name, elements[0], [], flush=True) if full \
+                        else build_feed_batch(name, elements[1], elements[2])
+                applied = kernel and bool(commands)
+                if applied:
+                    result = run_command([NFT, '-f', '-'], input="\n".join(commands) + "\n",
+                                         capture_output=True, text=True)
+                    if result.returncode != 0:
+                        logging.error(f"Error updating feed sets of {feed['name']}: {result.stderr}")
+                        record_feed_status(feed_id, 'failed', f"nft error: {result.stderr.strip()}")
+                        return False, f"Error updating feed {feed['name']}: {result.stderr}"
+                store_feed_elements(feed_id, added, removed)
+                if kernel:
+                    feed_synced.add(feed_id)
+            inc_counter('nftm_feed_element_ops_total', len(added), op='add')
+            inc_counter('nftm_feed_element_ops_total', len(removed), op='delete')
+            message = f"{len(new)} elements, +{len(added)} / -{len(removed)}"
+            if full:
+                message += " (full set reload)"
+            if invalid:
+                message += f", {invalid} invalid lines skipped"
+            fields = {'element_count': len(new), 'etag': etag, 'last_modified': last_modified}
+            if added or removed:
+                fields['last_changed'] = datetime.now()
+            record_feed_status(feed_id, 'updated' if added or removed else 'unchanged', message, **fields)
+            logging.info(f"Feed {feed['name']}: {message}, {len(commands) if applied else 0} nft commands")
+            return True, f"Feed {feed['name']}: {message}"
+    except (OSError, ValueError, urllib.error.URLError, sqlite3.Error) as e:
+        logging.error(f"Error updating feed {feed['name']}: {e}")
+        record_feed_status(feed_id, 'failed', str(e))
+        return False, f"Error updating feed {feed['name']}: {e}"
+
+def feed_due(feed):
+    if feed['id'] not in feed_synced and feed['last_status'] != 'failed' and os.path.exists(NFT):
+        return True
+    if not feed['last_checked']:
+        return True
+    try:
+        last_checked = datetime.fromisoformat(str(feed['last_checked']))
+    except ValueError:
+        return True
+    return datetime.now() - last_checked >= timedelta(seconds=feed['interval'])
+
+def feed_updater():
+    """Periksa feed yang jatuh tempo secara berkala (dibangunkan lebih awal setelah reload penuh)"""
+    while True:
+        request_id_var.set(new_request_id())
+        try:
+            for feed in get_feeds(enabled_only=True):
+                if feed_due(feed):
+                    update_feed(feed['id'])
+        except Exception as e:
+            logging.error(f"Error in feed updater: {e}")
+        feed_wakeup.wait(FEED_CHECK_INTERVAL)
+        feed_wakeup.clear()
+
+# GeoIP: match negara/ASN dikompilasi menjadi set interval per kode dari database lokal yang di-mmap
+GEOIP_COUNTRY_DB = os.environ.get('NFTM_GEOIP_COUNTRY_DB', '/var/lib/GeoIP/GeoLite2-Country.mmdb')
+GEOIP_ASN_DB = os.environ.get('NFTM_GEOIP_ASN_DB', '/var/lib/GeoIP/GeoLite2-ASN.mmdb')
+GEOIP_CHECK_INTERVAL = 300  # detik antar pengecekan perubahan file GeoIP
+GEOIP_MAX_CODES = 32  # kode negara/ASN maksimum per aturan
+GEOIP_FAMILIES = {'ip': 4, 'ip6': 6}
+MMDB_METADATA_MARKER = b"\xab\xcd\xefMaxMind.com"
+MMDB_METADATA_MAX = 128 * 1024  # metadata MaxMind DB selalu berada di 128 KiB terakhir file
+_MMDB_POINTER_BASE = (0, 2048, 526336, 0)
+_MMDB_SIZE_BASE = {29: 29, 30: 285, 31: 65821}
+_GEO_CSV_ADDRESS = rb'[0-9A-Fa-f]*[.:][0-9A-Fa-f.:]*'
+geo_wakeup = threading.Event()
+geo_synced = set()  # set geo yang isi kernelnya sama dengan database sejak reload penuh terakhir
+geo_resolve_lock = threading.Lock()
+
+def normalize_geo(value):
+    """Normalisasi daftar kode ('cn, ru', 'as13335') menjadi 'CN,RU'; ValueError jika ada kode tidak valid"""
+    codes = []
+    for token in re.split(r'[\s,]+', (value or '').strip().upper()):
+        if not token:
+            continue
+        if not re.fullmatch(r'[A-Z]{2}|AS\d{1,10}', token):
+            raise ValueError(f"Invalid country or ASN code: {token} (use ISO codes like CN or ASNs like AS13335)")
+        if token not in codes:
+            codes.append(token)
+    if len(codes) > GEOIP_MAX_CODES:
+        raise ValueError(f"At most {GEOIP_MAX_CODES} country or ASN codes per rule")
+    return ",".join(codes) or None
+
+def geo_codes(rule):
+    return rule['geo'].split(',') if rule.get('geo') else []
+
+def geo_address_field(rule):
+    # Seperti feed: di chain output yang dicocokkan alamat tujuan, selain itu alamat sumber
+    return 'dst' if (rule['chain'] or '').lower() == 'output' else 'src'
+
+def geo_database(code):
+    return GEOIP_ASN_DB if code.startswith('AS') and code[2:].isdigit() else GEOIP_COUNTRY_DB
+
+def geo_set_name(code, family):
+    family_suffix = '6' if family == 'ip6' else ''
+    return f"geo{family_suffix}_{code.lower()}"
+
+def geo_set_definition(code, family):
+    return {
+        'name': geo_set_name(code, family),
+        'geo': code,
+        'family': family,
+        'type': 'ipv6_addr' if family == 'ip6' else 'ipv4_addr',
+        'flags': 'interval',
+        'timeout': None,
+        'size': None,
+    }
+
+def validate_rule_geo(geo, chain, src, dst):
+    """Normalisasi kode geo aturan; kembalikan (nilai ternormalisasi, pesan error)"""
+    try:
+        geo = normalize_geo(geo)
+    except ValueError as e:
+        return None, str(e)
+    field = geo_address_field({'chain': chain})
+    if geo and (src if field == 'src' else dst):
+        label = 'Source' if field == 'src' else 'Destination'
+        return None, f'Country/ASN rules match the {label.lower()} address; leave {label} Address empty!'
+    return geo, None
+
+def geo_variants(rule):
+    """Pecah aturan geo per family dan kode; kembalikan daftar (family, src, dst, definisi set)
+
+    Setiap kode memiliki set interval sendiri per family sehingga satu set dipakai bersama oleh
+    semua aturan yang menyebut negara/ASN yang sama.
+    """
+    field = geo_address_field(rule)
+    protocol = (rule['protocol'] or '').lower()
+    variants = []
+    for family, src, dst in split_address_families(dict(rule, **{field: None})):
+        # Tanpa alamat lain aturan berlaku di kedua family, kecuali protokol ICMP yang terikat family
+        families = [family] if family else [name for name in GEOIP_FAMILIES
+                                            if ICMP_PROTOCOLS.get(protocol, name) == name]
+        for name in families:
+            for code in geo_codes(rule):
+                definition = geo_set_definition(code, name)
+                addresses = {'src': src, 'dst': dst, field: f"@{definition['name']}"}
+                variants.append((name, addresses['src'], addresses['dst'], definition))
+    return variants
+
+class MmdbReader:
+    """Pembaca MaxMind DB di atas mmap
+
+    Pohon pencarian dan section data dibaca langsung dari halaman file yang di-mmap; hanya
+    record data yang benar-benar dirujuk yang didekode menjadi objek Python.
+    """
+    
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            marker = self.map.rfind(MMDB_METADATA_MARKER, max(0, len(self.map) - MMDB_METADATA_MAX))
+            if marker < 0:
+                raise ValueError(f"{path} is not a MaxMind DB file")
+            self.data_base = 0
+            metadata, _ = self._decode(marker + len(MMDB_METADATA_MARKER))
+            self.node_count = metadata['node_count']
+            self.record_size = metadata['record_size']
+            self.ip_version = metadata['ip_version']
+            self.database_type = metadata.get('database_type')
+            if self.record_size not in (24, 28, 32):
+                raise ValueError(f"Unsupported MaxMind DB record size {self.record_size}")
+            self.node_bytes = self.record_size // 4
+            self.data_base = self.node_count * self.node_bytes + 16
+        except Exception:
+            self.map.close()
+            raise
+    
+    def close(self):
+        self.map.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def _decode(self, offset):
+        """Dekode satu nilai section data di offset absolut; kembalikan (nilai, offset berikutnya)"""
+        buf = self.map
+        ctrl = buf[offset]
+        offset += 1
+        kind = ctrl >> 5
+        if kind == 1:
+            size = (ctrl >> 3) & 0x3
+            if size == 3:
+                pointer = int.from_bytes(buf[offset:offset + 4], 'big')
+            else:
+                pointer = ((ctrl & 0x7) << (8 * (size + 1))) | int.from_bytes(buf[offset:offset + size + 1], 'big')
+                pointer += _MMDB_POINTER_BASE[size]
+            value, _ = self._decode(self.data_base + pointer)
+            return value, offset + size + 1
+        if kind == 0:
+            kind = 7 + buf[offset]
+            offset += 1
+        size = ctrl & 0x1f
+        if size >= 29:
+            width = size - 28
+            size = _MMDB_SIZE_BASE[size] + int.from_bytes(buf[offset:offset + width], 'big')
+            offset += width
+        if kind == 7:
+            result = {}
+            for _ in range(size):
+                key, offset = self._decode(offset)
+                result[key], offset = self._decode(offset)
+            return result, offset
+        if kind == 11:
+            result = []
+            for _ in range(size):
+                value, offset = self._decode(offset)
+                result.append(value)
+            return result, offset
+        if kind == 14:
+            return bool(size), offset
+        end = offset + size
+        if kind == 2:
+            return buf[offset:end].decode('utf-8'), end
+        if kind in (5, 6, 9, 10):
+            return int.from_bytes(buf[offset:end], 'big'), end
+        if kind == 8:
+            return int.from_bytes(buf[offset:end].rjust(4, b'\0'), 'big', signed=True), end
+        if kind == 3:
+            return struct.unpack('>d', buf[offset:end])[0], end
+        if kind == 15:
+            return struct.unpack('>f', buf[offset:end])[0], end
+        if kind == 4:
+            return bytes(buf[offset:end]), end
+        raise ValueError(f"Unsupported MaxMind DB data type {kind}")
+    
+    def record(self, pointer):
+        return self._decode(self.data_base + pointer)[0]
+    
+    def _children(self, node):
+        offset = node * self.node_bytes
+        raw = self.map[offset:offset + self.node_bytes]
+        if self.record_size == 28:
+            middle = raw[3]
+            return (((middle & 0xF0) << 20) | int.from_bytes(raw[:3], 'big'),
+                    ((middle & 0x0F) << 24) | int.from_bytes(raw[4:], 'big'))
+        half = self.node_bytes // 2
+        return int.from_bytes(raw[:half], 'big'), int.from_bytes(raw[half:], 'big')
+    
+    def _ipv4_root(self):
+        # Pada database IPv6, ruang IPv4 berada di ::/96 (96 bit nol pertama)
+        node = 0
+        for _ in range(96):
+            if node >= self.node_count:
+                break
+            node = self._children(node)[0]
+        return node
+    
+    def networks(self, version):
+        """Hasilkan (awal, akhir, pointer data) untuk seluruh jaringan satu versi IP, berurutan naik"""
+        bits = 32 if version == 4 else 128
+        if self.ip_version == 4:
+            if version == 6:
+                return
+            root = ipv4_root = 0
+        else:
+            ipv4_root = self._ipv4_root()
+            root = ipv4_root if version == 4 else 0
+        node_count = self.node_count
+        stack = [(root, 0, 0)]
+        while stack:
+            node, depth, prefix = stack.pop()
+            if node >= node_count:
+                if node > node_count:
+                    host_bits = bits - depth
+                    start = prefix << host_bits
+                    yield start, start + (1 << host_bits) - 1, node - node_count - 16
+                continue
+            # Subtree IPv4 (beserta alias ::ffff:0:0/96 dan 2002::/16) sudah dihitung sebagai IPv4
+            if version == 6 and node == ipv4_root and depth:
+                continue
+            left, right = self._children(node)
+            stack.append((right, depth + 1, (prefix << 1) | 1))
+            stack.append((left, depth + 1, prefix << 1))
+
+def _mmdb_code(record):
+    """Kode negara (ISO) atau ASN ('AS13335') dari record data MaxMind DB"""
+    if not isinstance(record, dict):
+        return None
+    if 'autonomous_system_number' in record:
+        return f"AS{record['autonomous_system_number']}"
+    for key in ('country', 'registered_country'):
+        code = (record.get(key) or {}).get('iso_code')
+        if code:
+            return code.upper()
+    return None
+
+def read_mmdb_intervals(path, codes):
+    """Interval (awal, akhir) per kode dan versi IP dengan satu penelusuran pohon MaxMind DB"""
+    wanted = set(codes)
+    result = {code: {4: [], 6: []} for code in codes}
+    with MmdbReader(path) as reader:
+        # Ribuan jaringan merujuk record data yang sama; kode cukup didekode sekali per pointer
+        code_by_pointer = {}
+        for version in (4, 6):
+            for start, end, pointer in reader.networks(version):
+                code = code_by_pointer.get(pointer, False)
+                if code is False:
+                    code = code_by_pointer[pointer] = _mmdb_code(reader.record(pointer))
+                if code not in wanted:
+                    continue
+                intervals = result[code][version]
+                # Jaringan dihasilkan berurutan, jadi yang bersebelahan langsung digabung
+                if intervals and intervals[-1][1] + 1 == start:
+                    intervals[-1][1] = end
+                else:
+                    intervals.append([start, end])
+    return result
+
+def read_csv_intervals(path, codes):
+    """Interval per kode dari CSV 'network,kode' atau 'awal,akhir,kode' (koma atau tab)
+
+    File di-mmap dan dipindai dengan regex yang hanya cocok dengan baris berkode yang diminta,
+    sehingga baris lain tidak pernah menjadi objek Python.
+    """
+    result = {code: {4: [], 6: []} for code in codes}
+    values = [code[2:] if code.startswith('AS') and code[2:].isdigit() else code for code in codes]
+    pattern = re.compile(
+        rb'^"?(' + _GEO_CSV_ADDRESS + rb'(?:/\d{1,3})?)"?[,\t](?:"?(' + _GEO_CSV_ADDRESS + rb')"?[,\t])?'
+        rb'"?(?:AS)?(' + b'|'.join(re.escape(value.encode()) for value in values) + rb')"?[ \t]*(?=[,\t\r\n]|\Z)',
+        re.M)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return result
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for match in pattern.finditer(data):
+                first, last, value = match.groups()
+                code = value.decode()
+                if code.isdigit():
+                    code = f"AS{code}"
+                try:
+                    if b'/' in first:
+                        network = ipaddress.ip_network(first.decode(), strict=False)
+                        version, start, end = network.version, int(network.network_address), \
+                            int(network.broadcast_address)
+                    else:
+                        version, start = _parse_ip(first.decode())
+                        end = _parse_ip(last.decode())[1] if last else start
+                except ValueError:
+                    continue
+                if code in result and start <= end:
+                    result[code][version].append((start, end))
+    for families in result.values():
+        for version, intervals in families.items():
+            families[version] = merge_intervals(intervals)
+    return result
+
+def read_geo_intervals(path, codes):
+    if path.endswith('.mmdb'):
+        return read_mmdb_intervals(path, codes)
+    return read_csv_intervals(path, codes)
+
+def geo_source_validator(path):
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+def get_geo_sets():
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("SELECT * FROM geo_sets ORDER BY name")
+    rows = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return rows
+
+def load_geo_elements(set_name):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    c.execute("SELECT element FROM geo_elements WHERE set_name=?", (set_name,))
+    elements = [row[0] for row in c.fetchall()]
+    conn.close()
+    return elements
+
+def store_geo_set(definition, source, validator, added, removed, count):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN")
+        c.executemany("DELETE FROM geo_elements WHERE set_name=? AND element=?",
+                      ((definition['name'], element) for element in removed))
+        c.executemany("INSERT INTO geo_elements (set_name, element) VALUES (?, ?)",
+                      ((definition['name'], element) for element in added))
+        c.execute("""
+            INSERT OR REPLACE INTO geo_sets (name, code, family, source, validator, element_count, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (definition['name'], definition['geo'], definition['family'], source, validator, count, datetime.now()))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    bump_set_version(('geo', definition['name']))
+    bump_generation('db')
+
+def _resolve_geo_sets(definitions, stored):
+    """Resolve ulang set yang sumbernya berubah atau belum pernah di-resolve
+
+    Mengembalikan {nama set: (path, validator, elemen baru)}; satu penelusuran file per sumber.
+    """
+    by_source = {}
+    for definition in definitions:
+        by_source.setdefault(geo_database(definition['geo']), []).append(definition)
+    resolved = {}
+    for path, group in by_source.items():
+        try:
+            validator = geo_source_validator(path)
+        except OSError:
+            if any(definition['name'] not in stored for definition in group):
+                logging.warning(f"GeoIP database {path} not found; country/ASN sets stay empty")
+            continue
+        stale = [definition for definition in group
+                 if (stored.get(definition['name']) or {}).get('validator') != validator
+                 or stored[definition['name']]['source'] != path]
+        if not stale:
+            continue
+        codes = sorted({definition['geo'] for definition in stale})
+        with metric_timer('nftm_geoip_resolve_seconds', source=os.path.basename(path)):
+            intervals = read_geo_intervals(path, codes)
+        for definition in stale:
+            version = GEOIP_FAMILIES[definition['family']]
+            elements = {format_interval(start, end, version) for start, end in intervals[definition['geo']][version]}
+            resolved[definition['name']] = (path, validator, elements)
+    return resolved
+
+def _apply_geo_sets(definitions, resolved, kernel):
+    """Simpan selisih elemen ke database dan (opsional) terapkan ke set kernel sebagai add/delete element"""
+    changes = []
+    for definition in definitions:
+        name = definition['name']
+        full = kernel and name not in geo_synced
+        if name not in resolved and not full:
+            continue
+        old = set(load_geo_elements(name))
+        new = resolved[name][2] if name in resolved else old
+        added, removed = sorted(new - old), sorted(old - new)
+        if kernel:
+            # Setelah reload penuh isi set kernel berasal dari file, jadi ganti seluruh isinya sekali
+            commands = build_feed_batch(name, sorted(new), [], flush=True) if full \
+                else build_feed_batch(name, added, removed)
+            if commands:
+                result = run_command([NFT, '-f', '-'], input="\n".join(commands) + "\n",
+                                     capture_output=True, text=True)
+                if result.returncode != 0:
+                    logging.error(f"Error updating GeoIP set {name}: {result.stderr}")
+                    continue
+            geo_synced.add(name)
+        elif added or removed:
+            # Kernel belum menerima perubahan ini; set diisi ulang pada sinkronisasi berikutnya
+            geo_synced.discard(name)
+        if name in resolved:
+            path, validator, _ = resolved[name]
+            store_geo_set(definition, path, validator, added, removed, len(new))
+        inc_counter('nftm_geoip_element_ops_total', len(added), op='add')
+        inc_counter('nftm_geoip_element_ops_total', len(removed), op='delete')
+        changes.append({'set': name, 'elements': len(new), 'added': len(added), 'removed': len(removed),
+                        'full': full})
+    if any(change['added'] or change['removed'] for change in changes):
+        # Ruleset fleet memuat elemen set geo sehingga hasil kompilasi lama tidak berlaku lagi
+        with _compile_cache_lock:
+            _compile_cache.clear()
+    return changes
+
+def refresh_geo_sets(definitions, kernel=False):
+    """Samakan set geo di database (dan kernel jika kernel=True) dengan file GeoIP saat ini"""
+    if not definitions:
+        return []
+    with geo_resolve_lock:
+        resolved = _resolve_geo_sets(definitions, {row['name']: row for row in get_geo_sets()})
+        if kernel and os.path.exists(NFT):
+            with set_lock:
+                return _apply_geo_sets(definitions, resolved, True)
+        return _apply_geo_sets(definitions, resolved, False)
+
+def active_geo_sets(rules=None, node_tags=None):
+    """Definisi set geo yang dipakai aturan aktif di node lokal (atau profil tag), sama dengan yang dibuat compile_ruleset"""
+    if node_tags is None:
+        node_tags = local_node_tags()
+    chains = dict(BASE_CHAINS)
+    definitions = {}
+    for rule in get_rules() if rules is None else rules:
+        if not rule['enabled'] or not rule.get('geo') or (rule['chain'] or '').lower() not in chains \
+                or not rule_applies_to(rule, node_tags):
+            continue
+        for *_, definition in geo_variants(rule):
+            definitions.setdefault(definition['name'], definition)
+    return list(definitions.values())
+
+def geo_networks(definition):
+    """Jaringan (ip_network) yang dicakup satu set geo menurut elemen tersimpan, untuk simulator kebijakan"""
+    networks = []
+    for element in load_geo_elements(definition['name']):
+        first, _, last = element.partition('-')
+        if last:
+            networks.extend(ipaddress.summarize_address_range(ipaddress.ip_address(first),
+                                                              ipaddress.ip_address(last)))
+        else:
+            networks.append(ipaddress.ip_network(first, strict=False))
+    return networks
+
+def sync_geo_sets():
+    """Terapkan perubahan file GeoIP ke set kernel hanya sebagai selisih elemen"""
+    changes = refresh_geo_sets(active_geo_sets(), kernel=True)
+    for change in changes:
+        if change['added'] or change['removed'] or change['full']:
+            reload_note = " (full set reload)" if change['full'] else ""
+            logging.info(f"GeoIP set {change['set']}: {change['elements']} elements, "
+                         f"+{change['added']} / -{change['removed']}{reload_note}")
+    return changes
+
+def geoip_updater():
+    """Periksa perubahan file GeoIP secara berkala (dibangunkan lebih awal setelah reload penuh)"""
+    while True:
+        request_id_var.set(new_request_id())
+        try:
+            sync_geo_sets()
+        except Exception as e:
+            logging.error(f"Error in GeoIP updater: {e}")
+        geo_wakeup.wait(GEOIP_CHECK_INTERVAL)
+        geo_wakeup.clear()
+
+# Daftar dinamis block/allow: ditulis langsung ke set kernel lewat antrean, dipersist ke SQLite secara bulk
+DYNAMIC_LISTS = {
+    'block': {'set': 'dyn_block', 'set6': 'dyn6_block', 'action': 'drop'},
+    'allow': {'set': 'dyn_allow', 'set6': 'dyn6_allow', 'action': 'accept'},
+}
+DYNAMIC_LIST_CHAINS = ('input', 'forward')
+DYNAMIC_LIST_SIZE = 262144  # elemen maksimum per set
+DYNAMIC_BATCH_WINDOW = 0.005  # detik pengumpulan operasi sebelum satu batch nft
+DYNAMIC_BATCH_MAX = 10000  # operasi maksimum per batch nft
+DYNAMIC_PERSIST_INTERVAL = 1.0  # detik antar penulisan bulk ke SQLite
+DYNAMIC_EXPIRY_MARGIN = 1.0  # elemen yang hampir habis dianggap sudah dihapus kernel
+DYNAMIC_MAX_TIMEOUT = 365 * 86400
+dynamic_queue = queue.Queue()
+dynamic_lock = threading.Lock()
+dynamic_entries = {name: {} for name in DYNAMIC_LISTS}  # alamat -> epoch kedaluwarsa (None = permanen)
+dynamic_pending = {}  # (list, alamat) -> (epoch kedaluwarsa, komentar) atau None untuk hapus
+dynamic_state = {'resync': True, 'batches': 0, 'operations': 0, 'last_error': None}
+
+def normalize_dynamic_address(value):
+    """Validasi satu alamat IPv4/IPv6 untuk daftar dinamis; ValueError jika tidak valid"""
+    return str(ipaddress.ip_address(str(value).strip()))
+
+def dynamic_set_name(list_name, address):
+    """Set kernel untuk alamat: ipv4_addr atau pasangan ipv6_addr-nya"""
+    config = DYNAMIC_LISTS[list_name]
+    return config['set6'] if ':' in address else config['set']
+
+def enqueue_dynamic(list_name, addresses, remove=False, timeout=None, comment=None):
+    """Masukkan operasi ke antrean writer; mengembalikan jumlah alamat yang diantrekan"""
+    if list_name not in DYNAMIC_LISTS:
+        raise ValueError(f"Unknown list: {list_name}")
+    # bool adalah subclass int; JSON true tidak boleh lolos sebagai timeout 1 detik
+    if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, int)
+                                or not 0 < timeout <= DYNAMIC_MAX_TIMEOUT):
+        raise ValueError(f"timeout must be a number of seconds between 1 and {DYNAMIC_MAX_TIMEOUT}")
+    normalized = [normalize_dynamic_address(address) for address in addresses]
+    for address in normalized:
+        dynamic_queue.put((list_name, address, remove, timeout, comment))
+    inc_counter('nftm_dynamic_queued_total', len(normalized), list=list_name, op='delete' if remove else 'add')
+    return len(normalized)
+
+def load_dynamic_entries():
+    """Muat daftar dinamis dari database ke memori saat startup"""
+    now = time.time()
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    c.execute("SELECT list, address, expires_at FROM dynamic_entries WHERE expires_at IS NULL OR expires_at > ?",
+              (now,))
+    rows = c.fetchall()
     conn.close()
+    with dynamic_lock:
+        for entries in dynamic_entries.values():
+            entries.clear()
+        for list_name, address, expires_at in rows:
+            if list_name in dynamic_entries:
+                dynamic_entries[list_name][address] = expires_at
+        dynamic_state['resync'] = True
+    return len(rows)
+
+def dynamic_list_elements(list_name, family):
+    """Elemen set family 'ip' atau 'ip6' untuk dirender ke file, dengan sisa timeout masing-masing"""
+    now = time.time()
+    ipv6 = family == 'ip6'
+    with dynamic_lock:
+        entries = [(address, expires_at) for address, expires_at in dynamic_entries[list_name].items()
+                   if (':' in address) == ipv6]
+    return [_dynamic_element(address, expires_at, now) for address, expires_at in sorted(entries)
+            if expires_at is None or expires_at > now + DYNAMIC_EXPIRY_MARGIN]
+
+def _dynamic_element(address, expires_at, now):
+    return address if expires_at is None else f"{address} timeout {max(int(expires_at - now), 1)}s"
+
+def dynamic_set_definition(list_name, family):
+    return {
+        'name': DYNAMIC_LISTS[list_name]['set6' if family == 'ip6' else 'set'],
+        'dynamic_list': list_name,
+        'family': family,
+        'type': 'ipv6_addr' if family == 'ip6' else 'ipv4_addr',
+        'flags': 'timeout',
+        'timeout': None,
+        'size': DYNAMIC_LIST_SIZE,
+    }
+
+def build_dynamic_batch(ops, now):
+    """Terapkan operasi ke isi daftar di memori lalu susun perintah nft delete/add element
+
+    Mengembalikan (perintah, perubahan untuk dipersist). Operasi terakhir per alamat menang.
+    """
+    latest = {}
+    for list_name, address, remove, timeout, comment in ops:
+        latest[(list_name, address)] = (remove, timeout, comment)
+    # Perintah dikelompokkan per set kernel (ipv4_addr/ipv6_addr)
+    deletes = {}
+    adds = {}
+    changes = {}
+    with dynamic_lock:
+        for (list_name, address), (remove, timeout, comment) in latest.items():
+            current = dynamic_entries[list_name]
+            set_name = dynamic_set_name(list_name, address)
+            # Elemen yang sudah (hampir) kedaluwarsa sudah dihapus kernel; delete untuknya akan gagal
+            expires_at = current.get(address, 0)
+            if expires_at is None or expires_at > now + DYNAMIC_EXPIRY_MARGIN:
+                deletes.setdefault(set_name, []).append(address)
+            if remove:
+                current.pop(address, None)
+                changes[(list_name, address)] = None
+                continue
+            expires_at = now + timeout if timeout else None
+            current[address] = expires_at
+            adds.setdefault(set_name, []).append(_dynamic_element(address, expires_at, now))
+            changes[(list_name, address)] = (expires_at, comment)
+    commands = []
+    for verb, by_set in (('delete', deletes), ('add', adds)):
+        for set_name, elements in sorted(by_set.items()):
+            for start in range(0, len(elements), FEED_BATCH_CHUNK):
+                chunk = ", ".join(elements[start:start + FEED_BATCH_CHUNK])
+                commands.append(f"{verb} element {NFT_TABLE} {set_name} {{ {chunk} }}")
+    return commands, changes
+
+def build_dynamic_resync(now):
+    """Ganti seluruh isi set dinamis dengan isi memori (setelah reload penuh atau batch gagal)"""
+    commands = []
+    for list_name in DYNAMIC_LISTS:
+        for family in ADDRESS_FAMILIES.values():
+            set_name = dynamic_set_definition(list_name, family)['name']
+            commands.append(f"flush set {NFT_TABLE} {set_name}")
+            elements = dynamic_list_elements(list_name, family)
+            for start in range(0, len(elements), FEED_BATCH_CHUNK):
+                chunk = ", ".join(elements[start:start + FEED_BATCH_CHUNK])
+                commands.append(f"add element {NFT_TABLE} {set_name} {{ {chunk} }}")
+    return commands
+
+def flush_dynamic_ops(ops):
+    """Terapkan satu batch operasi antrean ke kernel lalu serahkan perubahannya ke persister"""
+    now = time.time()
+    with set_lock:
+        commands, changes = build_dynamic_batch(ops, now)
+        if dynamic_state['resync']:
+            commands = build_dynamic_resync(now)
+        if commands and os.path.exists(NFT):
+            with metric_timer('nftm_dynamic_batch_seconds'):
+                result = run_command([NFT, '-f', '-'], input="\n".join(commands) + "\n",
+                                     capture_output=True, text=True)
+            if result.returncode != 0:
+                # Isi memori tetap diperbarui; seluruh set disinkronkan ulang pada batch berikutnya
+                logging.error(f"Error applying dynamic list batch: {result.stderr}", extra={'sample': 'dynamic_batch'})
+                dynamic_state['last_error'] = result.stderr.strip()
+                dynamic_state['resync'] = True
+            else:
+                dynamic_state['resync'] = False
+        with dynamic_lock:
+            dynamic_pending.update(changes)
+            if ops:
+                dynamic_state['batches'] += 1
+                dynamic_state['operations'] += len(ops)
+    return len(commands)
+
+def dynamic_list_writer():
+    """Kumpulkan operasi antrean selama beberapa milidetik lalu terapkan sebagai satu batch nft"""
+    while True:
+        ops = []
+        try:
+            first = dynamic_queue.get(timeout=DYNAMIC_PERSIST_INTERVAL)
+            time.sleep(DYNAMIC_BATCH_WINDOW)
+            if first is not None:
+                ops.append(first)
+            while len(ops) < DYNAMIC_BATCH_MAX:
+                op = dynamic_queue.get_nowait()
+                if op is not None:
+                    ops.append(op)
+        except queue.Empty:
+            pass
+        if ops or (dynamic_state['resync'] and os.path.exists(NFT)):
+            try:
+                flush_dynamic_ops(ops)
+            except Exception as e:
+                logging.error(f"Error in dynamic list writer: {e}")
+
+def persist_dynamic_entries():
+    """Tulis perubahan daftar dinamis yang tertunda ke SQLite dalam satu transaksi"""
+    with dynamic_lock:
+        pending = dict(dynamic_pending)
+        dynamic_pending.clear()
+        now = time.time()
+        # Buang elemen kedaluwarsa dari memori
+        for entries in dynamic_entries.values():
+            expired = [address for address, expires_at in entries.items()
+                       if expires_at is not None and expires_at <= now]
+            for address in expired:
+                del entries[address]
+    upserts = [(list_name, address, value[0], value[1]) for (list_name, address), value in pending.items() if value]
+    deletes = [key for key, value in pending.items() if value is None]
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN")
+        c.executemany("DELETE FROM dynamic_entries WHERE list=? AND address=?", deletes)
+        c.executemany("""
+            INSERT INTO dynamic_entries (list, address, expires_at, comment) VALUES (?, ?, ?, ?)
+            ON CONFLICT(list, address) DO UPDATE SET expires_at = excluded.expires_at, comment = excluded.comment
+        """, upserts)
+        c.execute("DELETE FROM dynamic_entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        # Kembalikan perubahan agar dicoba lagi, kecuali yang sudah ditimpa operasi yang lebih baru
+        with dynamic_lock:
+            for key, value in pending.items():
+                dynamic_pending.setdefault(key, value)
+        raise
+    finally:
+        conn.close()
+    return len(upserts) + len(deletes)
+
+def dynamic_list_persister():
+    """Persist daftar dinamis secara asinkron agar writer kernel tidak menunggu SQLite"""
+    while True:
+        time.sleep(DYNAMIC_PERSIST_INTERVAL)
+        try:
+            persist_dynamic_entries()
+        except Exception as e:
+            logging.error(f"Error persisting dynamic lists: {e}")
+
+def get_dynamic_list(list_name, limit=1000, offset=0):
+    now = time.time()
+    with dynamic_lock:
+        entries = [(address, expires_at) for address, expires_at in dynamic_entries[list_name].items()
+                   if expires_at is None or expires_at > now]
+    entries.sort()
+    return len(entries), [{'address': address, 'expires_in': int(expires_at - now) if expires_at else None}
+                          for address, expires_at in entries[offset:offset + limit]]
 
 def is_docker_installed():
     """Periksa apakah Docker service terinstal"""
@@ -752,7 +3196,7 @@ def is_docker_installed():
             return False
             
         # Cek apakah docker.service ada di sistem
-        result = subprocess.run([SYSTEMCTL, 'list-unit-files'], 
+        result = run_command([SYSTEMCTL, 'list-unit-files'], 
                               capture_output=True, text=True)
         return 'docker.service' in result.stdout
     except Exception as e:
@@ -767,7 +3211,7 @@ def restart_docker_service():
     
     try:
         # Periksa status Docker
-        status_result = subprocess.run([SYSTEMCTL, 'is-active', 'docker'], 
+        status_result = run_command([SYSTEMCTL, 'is-active', 'docker'], 
                                     capture_output=True, text=True)
         
         if status_result.returncode != 0:
@@ -775,7 +3219,7 @@ def restart_docker_service():
             return True, "Docker service not active, skipping restart"
         
         logging.info("Restarting Docker service...")
-        result = subprocess.run([SYSTEMCTL, "restart", "docker"], 
+        result = run_command([SYSTEMCTL, "restart", "docker"], 
                               capture_output=True, text=True)
         if result.returncode != 0:
             logging.error(f"Error restarting Docker: {result.stderr}")
@@ -786,6 +3230,7 @@ def restart_docker_service():
         logging.error(f"Error restarting Docker service: {e}")
         return False, f"Error restarting Docker service: {e}"
 
+@invalidates_set_sync
 def reload_nft():
     """Reload konfigurasi nftables dan restart Docker service jika tersedia"""
     try:
@@ -793,8 +3238,10 @@ def reload_nft():
         
         logging.info(f"Copying {RULES_FILE} to {NFT_CONF}")
         try:
-            subprocess.run(["/usr/bin/cp", RULES_FILE, NFT_CONF], check=True)
+            with metric_timer('nftm_apply_stage_seconds', stage='copy'):
+                run_command(["/usr/bin/cp", RULES_FILE, NFT_CONF], check=True)
             logging.info("File copy successful")
+            bump_generation('ruleset')
         except subprocess.CalledProcessError as e:
             logging.error(f"Error copying file: {e}")
             return False, f"Error copying file: {e}"
@@ -803,15 +3250,17 @@ def reload_nft():
         if os.path.exists(SYSTEMCTL):
             logging.info("Restarting nftables service...")
             try:
-                result = subprocess.run([SYSTEMCTL, "restart", "nftables"], 
-                                      capture_output=True, text=True)
+                with metric_timer('nftm_apply_stage_seconds', stage='nftables_restart'):
+                    result = run_command([SYSTEMCTL, "restart", "nftables"], 
+                                          capture_output=True, text=True)
                 if result.returncode != 0:
                     logging.error(f"Error restarting nftables: {result.stderr}")
                     return False, f"Error restarting nftables: {result.stderr}"
                 logging.info("nftables reloaded successfully")
                 
                 # Restart Docker service jika tersedia
-                docker_success, docker_message = restart_docker_service()
+                with metric_timer('nftm_apply_stage_seconds', stage='docker_restart'):
+                    docker_success, docker_message = restart_docker_service()
                 if not docker_success:
                     logging.warning(f"Failed to restart Docker: {docker_message}")
                     # Tetap lanjutkan meskipun Docker gagal di-restart
@@ -829,8 +3278,9 @@ def reload_nft():
             # Jika systemctl tidak tersedia, coba reload nftables langsung
             logging.warning("systemctl not available, trying to reload nftables directly")
             try:
-                result = subprocess.run([NFT, "-f", NFT_CONF], 
-                                      capture_output=True, text=True)
+                with metric_timer('nftm_apply_stage_seconds', stage='nft_load'):
+                    result = run_command([NFT, "-f", NFT_CONF], 
+                                          capture_output=True, text=True)
                 if result.returncode != 0:
                     logging.error(f"Error reloading nftables: {result.stderr}")
                     return False, f"Error reloading nftables: {result.stderr}"
@@ -844,118 +3294,2785 @@ def reload_nft():
         logging.error(f"Unexpected error in reload_nft: {e}")
         return False, f"Unexpected error: {e}"
 
-def save_rules():
-    """Simpan aturan ke file dan reload nftables"""
-    try:
-        logging.info("=== Starting save_rules process ===")
-        if not ensure_directory_exists(RULES_FILE):
-            logging.error("Failed to create configuration directory")
-            return False, "Failed to create configuration directory"
-        rules = get_rules()
-        logging.info(f"Found {len(rules)} rules in database")
-        
-        # Pertama cek apakah tabel sudah ada
-        try:
-            result = subprocess.run([NFT, 'list', 'tables'], 
-                                  capture_output=True, text=True)
-            table_exists = 'inet tableku' in result.stdout
-            logging.info(f"Table 'tableku' exists: {table_exists}")
-        except Exception as e:
-            logging.error(f"Error checking table existence: {e}")
-            table_exists = False
-        
-        config = """#!/usr/sbin/nft -f
-"""
-        
-        # Hanya hapus tabel jika sudah ada
-        if table_exists:
-            config += """# Hapus tabel yang sudah ada
-flush ruleset
-"""
-        
-        config += """# Tabel baru
-table inet tableku {
-    chain input {
-        type filter hook input priority 0; policy drop;
-        # Allow loopback
-        iifname lo accept
-        # Allow established connections
-        ct state established,related accept
-"""
-        # buffer aturan tiap chain
-        chain_rules = {
-            "input": "",
-            "forward": "",
-            "output": "",
-        }
-        enabled_rules = 0
-        for rule in rules:
-            if not rule['enabled']:
-                continue
-            enabled_rules += 1
-            rule_str = "        "
-            # Tambahkan komentar nama rule
-            if rule['name']:
-                group_name = rule['group_name'] if rule['group_name'] else "Ungrouped"
-                rule_str += f"# {rule['name']} [{group_name}]\n        "
-            # Sumber / tujuan
-            if rule['src']:
-                rule_str += f"ip saddr {rule['src']} "
-            if rule['dst']:
-                rule_str += f"ip daddr {rule['dst']} "
-            # Protokol & port
-            if rule['protocol'] and rule['protocol'].lower() == 'icmp':
-                rule_str += "icmp type echo-request accept"
-            elif rule['dport']:
-                protocol = rule['protocol'] if rule['protocol'] else 'tcp'
-                rule_str += f"{protocol} dport {rule['dport']} "
-            elif rule['protocol']:
-                rule_str += f"{rule['protocol']} "
-            # Aksi (kecuali ICMP echo-request sudah fixed)
-            if not (rule['protocol'] and rule['protocol'].lower() == 'icmp'):
-                rule_str += rule['action']
-            # Komentar tambahan
-            if rule['comment']:
-                rule_str += f" # {rule['comment']}"
-            rule_str += "\n"
-            # Masukkan rule ke chain sesuai rule['chain']
-            chain_name = rule['chain'].lower()
-            if chain_name in chain_rules:
-                chain_rules[chain_name] += rule_str
-            else:
-                logging.warning(f"Unknown chain: {rule['chain']}")
-        # susun ulang config
-        config += chain_rules["input"]
-        config += """    }
-    chain forward {
-        type filter hook forward priority 0; policy drop;
-"""
-        config += chain_rules["forward"]
-        config += """    }
-    chain output {
-        type filter hook output priority 0; policy accept;
-"""
-        config += chain_rules["output"]
-        config += """    }
+# Rantai dasar di tabel tableku beserta kebijakan default-nya
+NFT_TABLE = "inet tableku"
+BASE_CHAINS = [
+    ('input', 'drop'),
+    ('forward', 'drop'),
+    ('output', 'accept'),
+]
+
+# Tag node lokal untuk targeting aturan (dipisah koma, mis. "dmz,edge")
+NODE_TAGS = os.environ.get('NFTM_NODE_TAGS', '')
+COMPILE_CACHE_SIZE = 32
+
+_compile_cache = OrderedDict()
+_compile_cache_lock = threading.Lock()
+compile_stats = {'compiled': 0, 'cache_hits': 0}
+
+def parse_tags(value):
+    """Ubah string tag dipisah koma menjadi frozenset huruf kecil"""
+    if not value:
+        return frozenset()
+    return frozenset(tag.strip().lower() for tag in value.split(',') if tag.strip())
+
+def normalize_tags(value):
+    """Normalisasi tag untuk disimpan di database (None jika kosong)"""
+    tags = parse_tags(value)
+    return ",".join(sorted(tags)) if tags else None
+
+def node_tag_set(name, tags):
+    """Tag efektif node: tag yang dikonfigurasi ditambah tag host:<nama>"""
+    return parse_tags(tags) | {f"host:{name.lower()}"}
+
+def local_node_tags():
+    """Tag efektif instance lokal"""
+    return node_tag_set(socket.gethostname(), NODE_TAGS)
+
+def rule_applies_to(rule, tags):
+    """Aturan berlaku jika target tag aturan dan grupnya kosong atau beririsan dengan tag node"""
+    for key in ('target_tags', 'group_target_tags'):
+        targets = parse_tags(rule.get(key))
+        if targets and not targets & tags:
+            return False
+    return True
+
+def referenced_tags(rules):
+    """Semua tag yang dipakai oleh aturan atau grup"""
+    tags = set()
+    for rule in rules:
+        tags |= parse_tags(rule.get('target_tags'))
+        tags |= parse_tags(rule.get('group_target_tags'))
+    return frozenset(tags)
+
+def rules_fingerprint(rules):
+    """Hash isi aturan untuk kunci cache kompilasi"""
+    digest = hashlib.sha256()
+    for rule in rules:
+        digest.update(repr(sorted(rule.items())).encode())
+    return digest.hexdigest()
+
+def compile_profile(rules, profile, fingerprint=None):
+    """Kompilasi ruleset untuk satu profil tag dengan cache berbasis hash konten"""
+    key = (fingerprint or rules_fingerprint(rules), profile)
+    with _compile_cache_lock:
+        if key in _compile_cache:
+            _compile_cache.move_to_end(key)
+            compile_stats['cache_hits'] += 1
+            return _compile_cache[key]
+    # Flowtable, threat feed dan daftar dinamis bergantung pada node lokal sehingga tidak ikut dikirim ke node fleet
+    config = render_ruleset(compile_ruleset(rules, profile, flowtable=False, feeds=(), dynamic_lists=False), flush=True)
+    result = (config, hashlib.sha256(config.encode()).hexdigest())
+    with _compile_cache_lock:
+        compile_stats['compiled'] += 1
+        _compile_cache[key] = result
+        while len(_compile_cache) > COMPILE_CACHE_SIZE:
+            _compile_cache.popitem(last=False)
+    return result
+
+# Jenis aturan: static (match biasa) atau limit per sumber berbasis set dinamis (meter) di kernel
+RULE_TYPES = {
+    'static': 'Static',
+    'ratelimit': 'Rate limit per source',
+    'connlimit': 'Connection limit per source',
 }
-"""
-        logging.info(f"Generated config with {enabled_rules} enabled rules")
-        # Simpan ke file & reload nft
+LIMIT_ACTIONS = ('drop', 'reject')  # aksi yang berlaku untuk sumber yang melewati limit
+LIMIT_SET_PREFIX = {'ratelimit': 'rl', 'connlimit': 'cl'}
+LIMIT_SET_SIZE = 65535  # jumlah sumber maksimum per meter
+RATELIMIT_TIMEOUT = '1m'  # sumber yang diam dihapus dari meter setelah timeout
+RATE_UNITS = {'s': 'second', 'sec': 'second', 'second': 'second', 'm': 'minute', 'min': 'minute',
+              'minute': 'minute', 'h': 'hour', 'hour': 'hour', 'd': 'day', 'day': 'day'}
+
+def rule_type_of(rule):
+    return rule.get('rule_type') or 'static'
+
+def normalize_limit_value(rule_type, value):
+    """Validasi dan normalisasi nilai limit; ValueError jika tidak valid"""
+    value = (value or '').strip().lower()
+    if rule_type == 'ratelimit':
+        match = re.fullmatch(r'(\d+)\s*/\s*([a-z]+)(?:\s+burst\s+(\d+))?', value)
+        if not match or match.group(2) not in RATE_UNITS or int(match.group(1)) < 1:
+            raise ValueError("Rate limit must look like 20/second, 100/minute or 20/second burst 40")
+        rate = f"{int(match.group(1))}/{RATE_UNITS[match.group(2)]}"
+        return f"{rate} burst {int(match.group(3))} packets" if match.group(3) else rate
+    if rule_type == 'connlimit':
+        if not value.isdigit() or int(value) < 1:
+            raise ValueError("Connection limit must be a positive number of connections")
+        return str(int(value))
+    if rule_type == 'static':
+        return None
+    raise ValueError(f"Unknown rule type: {rule_type}")
+
+def validate_rule_limit(rule_type, limit_value, action, protocol):
+    """Periksa kombinasi jenis aturan, limit dan aksi; kembalikan (nilai ternormalisasi, pesan error)"""
+    try:
+        limit_value = normalize_limit_value(rule_type, limit_value)
+    except ValueError as e:
+        return None, str(e)
+    if rule_type != 'static' and action not in LIMIT_ACTIONS:
+        return None, 'Limit rules must use the drop or reject action!'
+    if rule_type == 'connlimit' and protocol and protocol.lower() in ('icmp', 'icmpv6'):
+        return None, 'Connection limits require TCP or UDP traffic!'
+    return limit_value, None
+
+def limit_set_name(rule):
+    family_suffix = '6' if rule.get('family') == 'ip6' else ''
+    return f"{LIMIT_SET_PREFIX[rule_type_of(rule)]}{family_suffix}_{rule['id']}"
+
+def limit_set_definition(rule):
+    """Definisi set dinamis (meter) untuk aturan limit pada satu family"""
+    rule_type = rule_type_of(rule)
+    family = rule.get('family') or 'ip'
+    return {
+        'name': limit_set_name(rule),
+        'rule_id': rule['id'],
+        'rule_type': rule_type,
+        'limit': rule['limit_value'],
+        'family': family,
+        'type': 'ipv6_addr' if family == 'ip6' else 'ipv4_addr',
+        'flags': 'dynamic',
+        # Meter connlimit tidak boleh memakai timeout: entri dilepas saat hitungan koneksi kembali nol
+        'timeout': RATELIMIT_TIMEOUT if rule_type == 'ratelimit' else None,
+        'size': LIMIT_SET_SIZE,
+    }
+
+def build_limit_statement(rule):
+    """Statement meter: sumber baru dimasukkan ke set dinamis dengan limit rate atau ct count"""
+    name = limit_set_name(rule)
+    family = rule.get('family') or 'ip'
+    if rule_type_of(rule) == 'ratelimit':
+        return f"ct state new update @{name} {{ {family} saddr limit rate over {rule['limit_value']} }}"
+    return f"ct state new add @{name} {{ {family} saddr ct count over {rule['limit_value']} }}"
+
+# Dual-stack: alamat src/dst diklasifikasi per versi IP dan dikelompokkan per family nftables
+ADDRESS_FAMILIES = {4: 'ip', 6: 'ip6'}
+ICMP_PROTOCOLS = {'icmp': 'ip', 'icmpv6': 'ip6'}
+ICMPV6_ND_STATEMENT = ("icmpv6 type { nd-neighbor-solicit, nd-neighbor-advert, nd-router-solicit, "
+                       "nd-router-advert } accept")
+
+def split_address_families(rule):
+    """Pecah src/dst aturan per family; kembalikan daftar (family, src, dst)
+
+    Setiap family mendapat satu set alamat (interval) per field, sehingga satu aturan menjadi
+    paling banyak dua statement (ip dan ip6) berapa pun jumlah alamatnya. Daftar kosong berarti
+    aturan tidak pernah cocok, mis. src hanya IPv4 sementara dst hanya IPv6.
+    """
+    protocol = (rule['protocol'] or '').lower()
+    versions = {6} if protocol == 'icmpv6' else {4, 6}
+    grouped = {}
+    for field in ('src', 'dst'):
+        if not rule[field]:
+            continue
+        networks = _address_networks(rule[field])
+        if networks is None:
+            # Nilai yang tidak dapat di-parse tetap diperlakukan sebagai match IPv4 seperti sebelumnya
+            grouped[field] = {4: rule[field]}
+        else:
+            by_version = {}
+            for network in networks:
+                by_version.setdefault(network.version, []).append(network)
+            grouped[field] = {version: format_address_set(collapse_networks(nets))
+                              for version, nets in by_version.items()}
+        versions &= set(grouped[field])
+    if not grouped:
+        if rule_type_of(rule) == 'static':
+            # Tanpa alamat, match protokol/port di tabel inet berlaku untuk kedua family
+            return [(None, None, None)]
+        # Meter membutuhkan tipe alamat sehingga aturan limit dipecah per family
+        if protocol == 'icmp':
+            versions = {4}
+    return [(ADDRESS_FAMILIES[version], grouped.get('src', {}).get(version), grouped.get('dst', {}).get(version))
+            for version in sorted(versions)]
+
+def validate_rule_families(src, dst, protocol):
+    """Pesan error jika kombinasi alamat dan protokol tidak memiliki family yang sama"""
+    rule = {'src': src, 'dst': dst, 'protocol': protocol, 'rule_type': 'static'}
+    if not split_address_families(rule):
+        return 'Source, destination and protocol must share an address family (IPv4 or IPv6)!'
+    return None
+
+def build_rule_statement(rule):
+    """Menyusun statement nftables untuk satu aturan (satu family)"""
+    parts = []
+    family = rule.get('family') or 'ip'
+    # Sumber / tujuan
+    if rule['src']:
+        parts.append(f"{family} saddr {rule['src']}")
+    if rule['dst']:
+        parts.append(f"{family} daddr {rule['dst']}")
+    # Protokol & port (ICMP echo-request selalu accept kecuali untuk aturan limit)
+    protocol = rule['protocol']
+    limited = rule_type_of(rule) != 'static'
+    if protocol and protocol.lower() in ICMP_PROTOCOLS:
+        icmp = 'icmpv6' if protocol.lower() == 'icmpv6' or family == 'ip6' else 'icmp'
+        if not limited:
+            parts.append(f"{icmp} type echo-request accept")
+            return " ".join(parts)
+        parts.append(f"{icmp} type echo-request")
+    elif rule['dport']:
+        parts.append(f"{protocol if protocol else 'tcp'} dport {rule['dport']}")
+    elif protocol:
+        parts.append(f"meta l4proto {protocol}" if limited else protocol)
+    if limited:
+        parts.append(build_limit_statement(rule))
+    parts.append(rule['action'])
+    return " ".join(parts)
+
+# Kompaksi: aturan dengan match/aksi identik digabung menjadi satu entri dengan set anonim
+# (port digabung menjadi rentang, alamat src/dst di-collapse menjadi prefix minimal)
+COMPACT_RULES = os.environ.get('NFTM_COMPACT_RULES', '1') != '0'
+COMPACT_WINDOW = 64  # jarak maksimum (dalam entri) antara aturan yang digabung
+COMPACT_FIELDS = ('src', 'dst', 'ports')  # urutan pass kompaksi
+
+@functools.lru_cache(maxsize=4096)
+def _address_networks(value):
+    try:
+        return tuple(parse_address_spec(value))
+    except ValueError:
+        return None
+
+def collapse_networks(networks):
+    """Gabungkan prefix yang bersebelahan/bersarang menjadi prefix minimal (per versi IP)"""
+    if len(networks) == 1:
+        return tuple(networks)
+    collapsed = []
+    for version in (4, 6):
+        collapsed.extend(ipaddress.collapse_addresses(n for n in networks if n.version == version))
+    return tuple(collapsed)
+
+def format_address_set(networks):
+    elements = [str(n.network_address) if n.prefixlen == n.max_prefixlen else str(n) for n in networks]
+    return elements[0] if len(elements) == 1 else "{ " + ", ".join(elements) + " }"
+
+@functools.lru_cache(maxsize=16384)
+def normalize_address_spec(value):
+    """Normalisasi src/dst dengan ipaddress; nilai yang tidak dapat di-parse dikembalikan apa adanya"""
+    if not value:
+        return None, None
+    networks = _address_networks(value)
+    if networks is None:
+        return value, None
+    networks = collapse_networks(networks)
+    return format_address_set(networks), networks
+
+def rule_match(rule):
+    """Ringkasan match aturan untuk kompaksi; None jika tidak dapat dianalisis"""
+    if rule_type_of(rule) != 'static' or rule.get('geo'):
+        # Aturan limit memiliki meter sendiri dan aturan geo merujuk set bernama, keduanya tidak pernah digabung
+        return None
+    src, src_nets = normalize_address_spec(rule['src'])
+    dst, dst_nets = normalize_address_spec(rule['dst'])
+    family = rule.get('family')
+    protocol = rule['protocol'].lower() if rule['protocol'] else None
+    match = {'src': src, 'dst': dst, 'src_nets': src_nets, 'dst_nets': dst_nets, 'family': family,
+             'protocol': protocol, 'ports': None, 'action': rule['action']}
+    if protocol in ICMP_PROTOCOLS:
+        # Protokol efektif mengikuti family statement (icmp pada alamat IPv6 menjadi icmpv6)
+        match['protocol'] = 'icmpv6' if family == 'ip6' else protocol
+        match['action'] = 'accept'
+        return match
+    try:
+        match['ports'] = parse_port_spec(rule['dport']) if rule['dport'] else None
+    except ValueError:
+        return None
+    if match['ports']:
+        match['protocol'] = protocol or 'tcp'
+    return match
+
+def _addresses_overlap(a, b, field):
+    if a[field] == b[field]:
+        return True
+    networks_a, networks_b = a[field + '_nets'], b[field + '_nets']
+    if networks_a is None or networks_b is None:
+        return True
+    return any(x.version == y.version and x.overlaps(y) for x in networks_a for y in networks_b)
+
+def _ranges_overlap(a, b):
+    return any(low_a <= high_b and low_b <= high_a for low_a, high_a in a for low_b, high_b in b)
+
+def matches_may_overlap(a, b):
+    """Apakah ada paket yang mungkin cocok dengan kedua match (konservatif)"""
+    if a['protocol'] and b['protocol'] and a['protocol'] != b['protocol']:
+        return False
+    if a['ports'] and b['ports'] and not _ranges_overlap(a['ports'], b['ports']):
+        return False
+    for field in ('src', 'dst'):
+        if a[field] and b[field] and not _addresses_overlap(a, b, field):
+            return False
+    return True
+
+def merge_port_ranges(ranges):
+    """Urutkan dan gabungkan rentang port yang tumpang tindih atau bersebelahan"""
+    merged = []
+    for low, high in sorted(ranges):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], high)
+        else:
+            merged.append([low, high])
+    return [tuple(item) for item in merged]
+
+def format_port_set(ranges):
+    elements = [str(low) if low == high else f"{low}-{high}" for low, high in ranges]
+    return elements[0] if len(elements) == 1 else "{ " + ", ".join(elements) + " }"
+
+def _can_move(entries, start, match):
+    """Entri di antara dua aturan yang digabung tidak boleh memberi verdict berbeda untuk paket yang sama"""
+    action = match['action']
+    for k in range(start, len(entries)):
+        other = entries[k].get('match')
+        if other is None or (other['action'] != action and matches_may_overlap(other, match)):
+            return False
+    return True
+
+def _compaction_key(match, field):
+    ports = tuple(match['ports']) if match['ports'] else None
+    key = {'src': match['src'], 'dst': match['dst'], 'ports': ports}
+    key[field] = None
+    return (match['family'], key['src'], key['dst'], key['ports'], match['protocol'], match['action'])
+
+def _source_label(source, fields):
+    details = []
+    for field, name in (('src', 'saddr'), ('dst', 'daddr'), ('dport', 'dport')):
+        if (field in fields or (field == 'dport' and 'ports' in fields)) and source[field]:
+            details.append(f"{name} {source[field]}")
+    label = source['label'] + (f" ({', '.join(details)})" if details else "")
+    return label + (f" - {source['comment']}" if source['comment'] else "")
+
+def compact_entries(entries, field):
+    """Gabungkan entri yang hanya berbeda pada `field` ('ports', 'src', atau 'dst')
+
+    Aturan yang lebih akhir hanya dipindah ke posisi grupnya jika tidak ada entri di antaranya
+    yang dapat memberi verdict berbeda untuk paket yang sama, sehingga semantik first-match tetap.
+    """
+    values = field if field == 'ports' else field + '_nets'
+    result = []
+    groups = {}
+    owned = set()  # posisi entri yang sudah disalin dan boleh dimodifikasi
+    for entry in entries:
+        match = entry.get('match')
+        if match is None or not match[values]:
+            result.append(entry)
+            continue
+        key = _compaction_key(match, field)
+        position = groups.get(key)
+        if (position is not None and len(result) - position <= COMPACT_WINDOW
+                and _can_move(result, position + 1, match)):
+            if position not in owned:
+                group = result[position]
+                result[position] = dict(group, match=dict(group['match']), rule_ids=list(group['rule_ids']),
+                                        sources=list(group['sources']),
+                                        merged_fields=set(group.get('merged_fields', set())))
+                owned.add(position)
+            group = result[position]
+            group['rule_ids'].extend(entry['rule_ids'])
+            group['sources'].extend(entry['sources'])
+            group['merged_fields'] = group['merged_fields'] | entry.get('merged_fields', set()) | {field}
+            group['match'][values] = tuple(group['match'][values]) + tuple(match[values])
+            continue
+        groups[key] = len(result)
+        result.append(entry)
+    for position in owned:
+        entry = result[position]
+        match = entry['match']
+        if field == 'ports':
+            match['ports'] = merge_port_ranges(match['ports'])
+        else:
+            match[values] = collapse_networks(match[values])
+            match[field] = format_address_set(match[values])
+        entry['statement'] = build_rule_statement({
+            'family': match['family'], 'src': match['src'], 'dst': match['dst'], 'protocol': match['protocol'],
+            'dport': format_port_set(match['ports']) if match['ports'] else None, 'action': match['action'],
+        })
+        entry['labels'] = [_source_label(source, entry['merged_fields']) for source in entry['sources']]
+        entry['comment'] = None
+    return result
+
+# Flowtable: flow TCP/UDP yang sudah established di chain forward dipindah ke fast path software
+FLOWTABLE_NAME = "ft"
+FLOWTABLE_STATEMENT = f"ct state established meta l4proto {{ tcp, udp }} flow add @{FLOWTABLE_NAME}"
+CONNTRACK_PROC = "/proc/net/nf_conntrack"
+SYS_NET_DIR = "/sys/class/net"
+flowtable_config = {'enabled': False, 'devices': []}  # dimuat dari app_state oleh init_db
+
+def load_flowtable_config():
+    """Muat konfigurasi flowtable dari tabel app_state"""
+    try:
+        value = get_app_state('flowtable')
+        config = json.loads(value) if value else {}
+    except (sqlite3.Error, ValueError) as e:
+        logging.error(f"Error loading flowtable config: {e}")
+        config = {}
+    flowtable_config['enabled'] = bool(config.get('enabled'))
+    flowtable_config['devices'] = list(config.get('devices', []))
+    return flowtable_config
+
+def save_flowtable_config(enabled, devices):
+    set_app_state('flowtable', json.dumps({'enabled': bool(enabled), 'devices': sorted(devices)}))
+    bump_generation('db')
+    return load_flowtable_config()
+
+def list_network_interfaces():
+    """Daftar interface jaringan (kecuali loopback) dari sysfs"""
+    try:
+        return sorted(name for name in os.listdir(SYS_NET_DIR) if name != 'lo')
+    except OSError:
+        return []
+
+def _nft_device(name):
+    return name if re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', name) else f'"{name}"'
+
+def active_flowtable():
+    """Flowtable yang akan dirender untuk node lokal; None jika nonaktif atau tanpa interface"""
+    if not flowtable_config['enabled'] or not flowtable_config['devices']:
+        return None
+    return {'name': FLOWTABLE_NAME, 'devices': list(flowtable_config['devices'])}
+
+def count_offloaded_flows():
+    """Hitung entri conntrack total dan yang di-offload ke flowtable; None jika tidak tersedia"""
+    try:
+        total = offloaded = 0
+        with open(CONNTRACK_PROC) as f:
+            for line in f:
+                total += 1
+                if 'OFFLOAD]' in line:
+                    offloaded += 1
+        return {'total': total, 'offloaded': offloaded}
+    except OSError:
+        return None
+
+# Browser conntrack: entri di-stream dari kernel lalu dipaginasi dengan keyset tanpa memuat seluruh tabel
+CONNTRACK_PAGE_SIZE = 100
+CONNTRACK_PAGE_MAX = 1000
+FIB_TRIE_PROC = "/proc/net/fib_trie"
+IF_INET6_PROC = "/proc/net/if_inet6"
+CONNTRACK_TUPLE_KEYS = ('src', 'dst', 'sport', 'dport', 'type', 'code', 'id')
+CONNTRACK_CURSOR_TYPES = (int, str, int, int, int, int, int)  # versi, protokol, src, dst, sport, dport, zone
+
+def _conntrack_entry(family, protocol, timeout, state, tuples, meta, flags):
+    original, reply = tuples
+    entry = {
+        'family': family,
+        'protocol': protocol,
+        'timeout': timeout,
+        'state': state,
+        'src': original.get('src'),
+        'dst': original.get('dst'),
+        'sport': int(original['sport']) if 'sport' in original else None,
+        'dport': int(original['dport']) if 'dport' in original else None,
+        'icmp_id': int(original['id']) if 'id' in original else None,
+        'reply_src': reply.get('src'),
+        'reply_dst': reply.get('dst'),
+        'flags': flags,
+        'mark': int(meta.get('mark', 0)),
+        'zone': int(meta.get('zone', 0)),
+    }
+    if not entry['src'] or not entry['dst']:
+        return None
+    return entry
+
+def parse_conntrack_line(line):
+    """Parse satu baris /proc/net/nf_conntrack; None jika formatnya tidak dikenal"""
+    tokens = line.split()
+    if len(tokens) < 6 or not tokens[4].isdigit():
+        return None
+    tuples = ({}, {})
+    index = 0
+    meta = {}
+    flags = []
+    state = None
+    for token in tokens[5:]:
+        if token.startswith('['):
+            flags.append(token.strip('[]'))
+        elif '=' in token:
+            key, value = token.split('=', 1)
+            if key in CONNTRACK_TUPLE_KEYS:
+                # Kemunculan kedua src/dst/port adalah tuple arah balik (reply)
+                if key in tuples[index] and index == 0:
+                    index = 1
+                tuples[index][key] = value
+            else:
+                meta[key] = value
+        elif index == 0 and not tuples[0]:
+            state = token
+    return _conntrack_entry(tokens[0], tokens[2], int(tokens[4]), state, tuples, meta, flags)
+
+def read_conntrack_proc():
+    with open(CONNTRACK_PROC) as f:
+        for line in f:
+            entry = parse_conntrack_line(line)
+            if entry:
+                yield entry
+
+def read_conntrack_xml():
+    """Stream 'conntrack -L -o xml'; setiap elemen flow dibuang setelah diparse"""
+    process = subprocess.Popen([CONNTRACK, '-L', '-o', 'xml'], stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    try:
+        for event, element in ElementTree.iterparse(process.stdout, events=('end',)):
+            if element.tag != 'flow':
+                continue
+            tuples = ({}, {})
+            meta = {}
+            flags = []
+            family = protocol = state = None
+            timeout = 0
+            for part in element.findall('meta'):
+                direction = part.get('direction')
+                if direction in ('original', 'reply'):
+                    target = tuples[0 if direction == 'original' else 1]
+                    layer3 = part.find('layer3')
+                    layer4 = part.find('layer4')
+                    if layer3 is not None:
+                        family = family or layer3.get('protoname')
+                        target.update((child.tag, child.text) for child in layer3)
+                    if layer4 is not None:
+                        protocol = protocol or layer4.get('protoname')
+                        target.update((child.tag, child.text) for child in layer4)
+                else:
+                    for child in part:
+                        if child.tag == 'state':
+                            state = child.text
+                        elif child.tag == 'timeout':
+                            timeout = int(child.text or 0)
+                        elif child.tag in ('mark', 'zone'):
+                            meta[child.tag] = child.text or 0
+                        elif not (child.text or '').strip():
+                            flags.append(child.tag.upper())
+            element.clear()
+            entry = _conntrack_entry(family, protocol, timeout, state, tuples, meta, flags)
+            if entry:
+                yield entry
+    except ElementTree.ParseError as e:
+        logging.error(f"Error parsing conntrack output: {e}")
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.terminate()
+        process.wait()
+
+def conntrack_source():
+    """Sumber entri conntrack yang tersedia: (nama, fungsi generator) atau (None, None)"""
+    if os.path.exists(CONNTRACK_PROC):
+        return 'procfs', read_conntrack_proc
+    if os.path.exists(CONNTRACK):
+        return 'conntrack', read_conntrack_xml
+    return None, None
+
+def local_addresses():
+    """Alamat lokal host (versi, integer) dari fib_trie dan if_inet6 untuk menentukan chain flow"""
+    addresses = set()
+    try:
+        with open(FIB_TRIE_PROC) as f:
+            previous = None
+            for line in f:
+                line = line.strip()
+                if line.startswith('|--'):
+                    previous = line[3:].strip()
+                elif line == '/32 host LOCAL' and previous:
+                    addresses.add(_parse_ip(previous))
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(IF_INET6_PROC) as f:
+            for line in f:
+                fields = line.split()
+                if fields:
+                    addresses.add((6, int(fields[0], 16)))
+    except (OSError, ValueError):
+        pass
+    return addresses
+
+def conntrack_chain(entry, local):
+    if _parse_ip(entry['dst']) in local:
+        return 'input'
+    if _parse_ip(entry['src']) in local:
+        return 'output'
+    return 'forward'
+
+def conntrack_key(entry):
+    """Kunci urut keyset: tuple asli flow, unik per entri conntrack"""
+    version, src = _parse_ip(entry['src'])
+    _, dst = _parse_ip(entry['dst'])
+    sport = entry['sport'] if entry['sport'] is not None else entry['icmp_id']
+    return (version, entry['protocol'] or '', src, dst, sport if sport is not None else -1,
+            entry['dport'] if entry['dport'] is not None else -1, entry['zone'])
+
+def encode_conntrack_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def decode_conntrack_cursor(cursor):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    # Tipe tiap elemen harus sama dengan conntrack_key() agar perbandingan key > after tidak gagal
+    if not isinstance(key, list) or len(key) != len(CONNTRACK_CURSOR_TYPES) or not all(
+            type(value) is expected for value, expected in zip(key, CONNTRACK_CURSOR_TYPES)):
+        raise ValueError("Invalid cursor")
+    return tuple(key)
+
+def parse_conntrack_filters(args):
+    """Filter sisi server: src/dst (alamat atau CIDR), port, state, protocol, rule (id aturan)"""
+    filters = {}
+    for field in ('src', 'dst'):
+        value = (args.get(field) or '').strip()
+        if value:
+            try:
+                network = ipaddress.ip_network(value, strict=False)
+            except ValueError:
+                raise ValueError(f"Invalid {field} address: {value}")
+            filters[field] = (network.version, int(network.network_address), int(network.netmask))
+    port = (args.get('port') or '').strip()
+    if port:
+        if not port.isdigit() or not 0 < int(port) < 65536:
+            raise ValueError(f"Invalid port: {port}")
+        filters['port'] = int(port)
+    for field in ('state', 'protocol'):
+        value = (args.get(field) or '').strip()
+        if value:
+            filters[field] = value.upper() if field == 'state' else value.lower()
+    rule = (args.get('rule') or '').strip()
+    if rule:
+        filters['rule'] = None if rule == 'none' else int(rule) if rule.isdigit() else rule
+    return filters
+
+def _address_in(value, spec):
+    version, network, mask = spec
+    parsed_version, parsed = _parse_ip(value)
+    return parsed_version == version and parsed & mask == network
+
+def conntrack_entry_matches(entry, filters):
+    if 'protocol' in filters and entry['protocol'] != filters['protocol']:
+        return False
+    if 'state' in filters and (entry['state'] or '') != filters['state']:
+        return False
+    if 'port' in filters and filters['port'] not in (entry['sport'], entry['dport']):
+        return False
+    for field in ('src', 'dst'):
+        if field in filters and not _address_in(entry[field], filters[field]):
+            return False
+    return True
+
+@timed_operation('nftm_conntrack_scan_seconds')
+def scan_conntrack(filters=None, after=None, limit=CONNTRACK_PAGE_SIZE):
+    """Satu lintasan streaming atas tabel conntrack: satu halaman keyset dan jumlah per aturan
+
+    Hanya `limit` entri dengan kunci terkecil setelah `after` yang disimpan (heap terbatas), sehingga
+    memori tetap O(limit) berapa pun ukuran tabel. Setiap entri yang lolos filter dievaluasi dengan
+    simulator untuk mengetahui aturan yang mengizinkan paket pertama flow tersebut.
+    """
+    filters = filters or {}
+    source, reader = conntrack_source()
+    if reader is None:
+        return None
+    simulator = get_simulator()
+    local = local_addresses()
+    stats = {'scanned': 0, 'matched': 0, 'after': 0, 'rule_counts': {}}
+    
+    def candidates():
+        for entry in reader():
+            stats['scanned'] += 1
+            if not conntrack_entry_matches(entry, filters):
+                continue
+            try:
+                entry['chain'] = conntrack_chain(entry, local)
+                result = simulator.evaluate(entry['chain'], entry['src'], entry['dst'], entry['protocol'],
+                                            entry['dport'])
+                entry['verdict'], entry['rule_id'] = result['verdict'], result['rule_id']
+                key = conntrack_key(entry)
+            except ValueError:
+                continue
+            if 'rule' in filters and entry['rule_id'] != filters['rule']:
+                continue
+            stats['matched'] += 1
+            counts = stats['rule_counts']
+            counts[entry['rule_id']] = counts.get(entry['rule_id'], 0) + 1
+            if after is None or key > after:
+                stats['after'] += 1
+                yield key, entry
+    
+    page = heapq.nsmallest(limit, candidates(), key=lambda item: item[0])
+    return {
+        'source': source,
+        'entries': [entry for _, entry in page],
+        'next_cursor': encode_conntrack_cursor(page[-1][0]) if stats['after'] > len(page) else None,
+        'scanned': stats['scanned'],
+        'matched': stats['matched'],
+        'rule_counts': stats['rule_counts'],
+    }
+
+METER_DISPLAY_LIMIT = 500  # elemen meter maksimum yang ditampilkan per set
+
+def _meter_value(value):
+    return value if isinstance(value, str) else json.dumps(value, sort_keys=True)
+
+def read_meter(name):
+    """Baca isi set dinamis dari kernel (nft -j); None jika set tidak ada atau gagal dibaca"""
+    if not os.path.exists(NFT):
+        return None
+    result = run_command([NFT, '-j', 'list', 'set'] + NFT_TABLE.split() + [name],
+                         capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    try:
+        data = json.loads(result.stdout)
+    except ValueError as e:
+        logging.error(f"Error parsing meter {name}: {e}")
+        return None
+    for item in data.get('nftables', []):
+        if 'set' not in item:
+            continue
+        elements = []
+        for element in item['set'].get('elem', []):
+            details = element.get('elem', {}) if isinstance(element, dict) and 'elem' in element else {'val': element}
+            elements.append({
+                'address': _meter_value(details.get('val')),
+                'expires': details.get('expires'),
+                'timeout': details.get('timeout'),
+            })
+        return elements
+    return []
+
+def get_meters(rules=None):
+    """Meter per aturan limit aktif (satu per family) beserta isi kernelnya"""
+    meters = []
+    for rule in rules if rules is not None else get_rules():
+        if rule_type_of(rule) == 'static' or not rule['enabled']:
+            continue
+        for family, _, _ in split_address_families(rule):
+            meter = limit_set_definition(dict(rule, family=family))
+            elements = read_meter(meter['name'])
+            meter['rule'] = rule
+            meter['loaded'] = elements is not None
+            meter['count'] = len(elements or [])
+            meter['elements'] = sorted(elements or [], key=lambda e: e['address'])[:METER_DISPLAY_LIMIT]
+            meters.append(meter)
+    return meters
+
+def compile_ruleset(rules, node_tags=None, compact=None, flowtable=None, feeds=None, dynamic_lists=True):
+    """Mengompilasi aturan aktif menjadi daftar entri per chain untuk tag node tertentu"""
+    if node_tags is None:
+        node_tags = local_node_tags()
+    if compact is None:
+        compact = COMPACT_RULES
+    if flowtable is None:
+        flowtable = active_flowtable()
+    if feeds is None:
+        feeds = get_feeds(enabled_only=True)
+    chains = {name: [] for name, _ in BASE_CHAINS}
+    chains['input'].append({
+        'statement': 'iifname lo accept',
+        'labels': ['Allow loopback'],
+        'comment': None,
+        'rule_ids': [],
+    })
+    chains['input'].append({
+        'statement': 'ct state established,related accept',
+        'labels': ['Allow established connections'],
+        'comment': None,
+        'rule_ids': [],
+    })
+    # Neighbor discovery wajib diizinkan agar IPv6 tetap berfungsi dengan policy drop
+    chains['input'].append({
+        'statement': ICMPV6_ND_STATEMENT,
+        'labels': ['Allow IPv6 neighbor discovery'],
+        'comment': None,
+        'rule_ids': [],
+    })
+    if flowtable:
+        chains['forward'].append({
+            'statement': FLOWTABLE_STATEMENT,
+            'labels': [f"Offload established flows to flowtable {flowtable['name']}"],
+            'comment': None,
+            'rule_ids': [],
+        })
+    sets = []
+    # Daftar dinamis allow/block dari API diperiksa sebelum feed dan aturan biasa
+    if dynamic_lists:
+        for list_name, config in sorted(DYNAMIC_LISTS.items()):
+            for family in ADDRESS_FAMILIES.values():
+                definition = dynamic_set_definition(list_name, family)
+                sets.append(definition)
+                for chain_name in DYNAMIC_LIST_CHAINS:
+                    chains[chain_name].append({
+                        'statement': f"{family} saddr @{definition['name']} {config['action']}",
+                        'labels': [f"Dynamic {list_name} list"],
+                        'comment': None,
+                        'rule_ids': [],
+                    })
+    # Feed ditempatkan sebelum aturan biasa agar daftar blokir selalu berlaku
+    for feed in feeds:
+        if feed['chain'] not in chains:
+            continue
+        for family in ADDRESS_FAMILIES.values():
+            sets.append(feed_set_definition(feed, family))
+            chains[feed['chain']].append({
+                'statement': feed_statement(feed, family),
+                'labels': [f"Threat feed {feed['name']}"],
+                'comment': None,
+                'rule_ids': [],
+            })
+    set_names = {definition['name'] for definition in sets}
+    enabled_rules = 0
+    addresses_before = 0
+    for rule in rules:
+        if not rule['enabled'] or not rule_applies_to(rule, node_tags):
+            continue
+        enabled_rules += 1
+        chain_name = rule['chain'].lower()
+        if chain_name not in chains:
+            logging.warning(f"Unknown chain: {rule['chain']}")
+            continue
+        labels = []
+        if rule['name']:
+            group_name = rule['group_name'] if rule['group_name'] else "Ungrouped"
+            labels.append(f"{rule['name']} [{group_name}]")
+        if rule.get('geo'):
+            variants = geo_variants(rule)
+        else:
+            variants = [variant + (None,) for variant in split_address_families(rule)]
+        if not variants:
+            logging.warning(f"Rule {rule['id']} never matches: source, destination and protocol "
+                            f"have no address family in common", extra={'rule_id': rule['id']})
+            continue
+        # Satu statement per family (dan per kode geo); src/dst sudah dikelompokkan menjadi satu set per family
+        for position, (family, src, dst, geo_set) in enumerate(variants):
+            family_rule = dict(rule, family=family, src=src, dst=dst)
+            definitions = [geo_set] if geo_set else []
+            if rule_type_of(rule) != 'static':
+                definitions.append(limit_set_definition(family_rule))
+            for definition in definitions:
+                # Set geo dipakai bersama antar aturan, meter dipakai bersama antar kode geo satu aturan
+                if definition['name'] not in set_names:
+                    set_names.add(definition['name'])
+                    sets.append(definition)
+            match = rule_match(family_rule)
+            if match and position == 0:
+                addresses_before += sum(len(_address_networks(rule[field]) or ()) for field in ('src', 'dst')
+                                        if rule[field])
+            chains[chain_name].append({
+                'statement': build_rule_statement(family_rule),
+                'labels': labels,
+                'comment': rule['comment'],
+                'rule_ids': [rule['id']],
+                'match': match,
+                'family': family,
+                'geo_set': geo_set,
+                'sources': [{
+                    'rule_id': rule['id'],
+                    'label': labels[0] if labels else f"Rule #{rule['id']}",
+                    'src': src,
+                    'dst': dst,
+                    'dport': rule['dport'],
+                    'comment': rule['comment'],
+                }],
+            })
+    entries_before = sum(len(entries) for entries in chains.values())
+    if compact:
+        for field in COMPACT_FIELDS:
+            chains = {name: compact_entries(entries, field) for name, entries in chains.items()}
+    entries_after = sum(len(entries) for entries in chains.values())
+    addresses_after = sum(len(entry['match']['src_nets'] or ()) + len(entry['match']['dst_nets'] or ())
+                          for entries in chains.values() for entry in entries if entry.get('match'))
+    # Peta atribusi: aturan -> chain dan posisi entri hasil kompilasi
+    attribution = {}
+    for chain_name, entries in chains.items():
+        for position, entry in enumerate(entries):
+            for source in entry.get('sources', []):
+                # Aturan dual-stack diatribusikan ke entri family pertamanya
+                if source['rule_id'] in attribution:
+                    continue
+                attribution[source['rule_id']] = dict(source, chain=chain_name, position=position,
+                                                      merged=len(entry['rule_ids']) > 1)
+    return {
+        'chains': chains,
+        'enabled_rules': enabled_rules,
+        'flowtable': flowtable or None,
+        'sets': sets,
+        'attribution': attribution,
+        'compaction': {
+            'entries_before': entries_before,
+            'entries_after': entries_after,
+            'removed': entries_before - entries_after,
+            'addresses_before': addresses_before,
+            'addresses_after': addresses_after,
+        },
+    }
+
+def render_ruleset(compiled, flush=True, rendered_sets=None):
+    """Menghasilkan teks konfigurasi nftables dari hasil kompilasi
+
+    Jika rendered_sets diberikan, versi elemen feed dan set geo yang ditulis dicatat di dalamnya.
+    """
+    config = "#!/usr/sbin/nft -f\n"
+    # Hanya hapus tabel jika sudah ada
+    if flush:
+        config += "# Hapus tabel yang sudah ada\nflush ruleset\n"
+    config += f"# Tabel baru\ntable {NFT_TABLE} {{\n"
+    flowtable = compiled.get('flowtable')
+    if flowtable:
+        devices = ", ".join(_nft_device(name) for name in flowtable['devices'])
+        config += f"    flowtable {flowtable['name']} {{\n"
+        config += "        hook ingress priority 0;\n"
+        config += f"        devices = {{ {devices} }};\n"
+        config += "    }\n"
+    for definition in compiled.get('sets', []):
+        config += f"    set {definition['name']} {{\n"
+        config += f"        type {definition['type']}; flags {definition['flags']};"
+        if definition['timeout']:
+            config += f" timeout {definition['timeout']};"
+        if definition['size']:
+            config += f" size {definition['size']};"
+        config += "\n"
+        # Elemen feed, daftar dinamis dan set geo ikut ditulis agar set terisi kembali saat boot
+        key = ('feed', definition['feed_id']) if definition.get('feed_id') else \
+            ('geo', definition['name']) if definition.get('geo') else None
+        if key is not None and rendered_sets is not None:
+            # Versi dibaca sebelum elemen: penulisan di antaranya membuat set dimuat ulang penuh
+            rendered_sets[key] = set_versions.get(key)
+        if definition.get('feed_id'):
+            elements = load_feed_elements(definition['feed_id'], definition['family'])
+        elif definition.get('dynamic_list'):
+            elements = dynamic_list_elements(definition['dynamic_list'], definition['family'])
+        elif definition.get('geo'):
+            # Hanya elemen tersimpan; resolve dari file GeoIP dilakukan jalur apply dan sync_geo_sets
+            elements = load_geo_elements(definition['name'])
+        else:
+            elements = None
+        if elements:
+            lines = [", ".join(elements[i:i + 8]) for i in range(0, len(elements), 8)]
+            config += "        elements = { " + ",\n                     ".join(lines) + " }\n"
+        config += "    }\n"
+    for chain_name, policy in BASE_CHAINS:
+        config += f"    chain {chain_name} {{\n"
+        config += f"        type filter hook {chain_name} priority 0; policy {policy};\n"
+        for entry in compiled['chains'][chain_name]:
+            for label in entry['labels']:
+                config += f"        # {label}\n"
+            config += f"        {entry['statement']}"
+            if entry['comment']:
+                config += f" # {entry['comment']}"
+            config += "\n"
+        config += "    }\n"
+    config += "}\n"
+    return config
+
+def nft_table_exists():
+    """Cek apakah tabel tableku sudah ada di kernel"""
+    try:
+        result = run_command([NFT, 'list', 'tables'], 
+                              capture_output=True, text=True)
+        table_exists = NFT_TABLE in result.stdout
+        logging.info(f"Table 'tableku' exists: {table_exists}")
+        return table_exists
+    except Exception as e:
+        logging.error(f"Error checking table existence: {e}")
+        return False
+
+@timed_operation('nftm_apply_seconds', counter='nftm_apply_total')
+def save_rules():
+    """Simpan aturan ke file dan reload nftables"""
+    try:
+        ensure_request_id()
+        logging.info("=== Starting save_rules process ===")
+        if not ensure_directory_exists(RULES_FILE):
+            logging.error("Failed to create configuration directory")
+            return False, "Failed to create configuration directory"
+        with metric_timer('nftm_apply_stage_seconds', stage='get_rules'):
+            rules = get_rules()
+        logging.info(f"Found {len(rules)} rules in database")
+        with metric_timer('nftm_apply_stage_seconds', stage='geoip'):
+            refresh_geo_sets(active_geo_sets(rules))
+        
+        with metric_timer('nftm_apply_stage_seconds', stage='generate'):
+            compiled = compile_ruleset(rules)
+            rendered_sets = {}
+            config = render_ruleset(compiled, flush=nft_table_exists(), rendered_sets=rendered_sets)
+        logging.info(f"Generated config with {compiled['enabled_rules']} enabled rules")
+        compaction = compiled['compaction']
+        if compaction['removed'] or compaction['addresses_after'] != compaction['addresses_before']:
+            logging.info(f"Compaction merged rules into {compaction['entries_after']} chain entries "
+                         f"({compaction['removed']} removed), address elements "
+                         f"{compaction['addresses_before']} -> {compaction['addresses_after']}")
+        # Simpan ke file & reload nft
+        try:
+            with metric_timer('nftm_apply_stage_seconds', stage='write_file'):
+                with open(RULES_FILE, "w") as f:
+                    f.write(config)
+                os.chmod(RULES_FILE, 0o640)
+            logging.info(f"Rules saved to {RULES_FILE}")
+            success, message = reload_nft(rendered_sets=rendered_sets)
+            if not success:
+                return False, message
+            set_app_state('applied_hash', hash_ruleset(normalize_compiled(compiled)))
+            return True, "Rules saved successfully"
+        except Exception as e:
+            logging.error(f"Error saving rules: {e}")
+            return False, f"Error saving rules: {e}"
+    except Exception as e:
+        logging.error(f"Unexpected error in save_rules: {e}")
+        return False, f"Unexpected error: {e}"
+
+def startup_apply_needed():
+    """Cek apakah ruleset perlu diterapkan saat startup
+
+    Apply dilewati jika hash ruleset yang terakhir diterapkan sama dengan hash dari database
+    saat ini dan sama dengan file aturan serta tabel yang sedang aktif di kernel.
+    """
+    try:
+        _, expected = get_expected_ruleset()
+        expected_hash = hash_ruleset(expected)
+        applied_hash = get_app_state('applied_hash')
+        if applied_hash != expected_hash:
+            return True, "Database changed since last apply"
+        for path in (RULES_FILE, NFT_CONF):
+            parsed = _read_file_layer(path)
+            if parsed is None or hash_ruleset(parsed) != expected_hash:
+                return True, f"{path} does not match the last applied ruleset"
+        kernel = read_kernel_ruleset()
+        if kernel is None or hash_ruleset(kernel) != expected_hash:
+            return True, "Kernel ruleset does not match the last applied ruleset"
+        return False, f"Live ruleset matches last applied hash {expected_hash[:16]}"
+    except Exception as e:
+        logging.error(f"Error checking startup ruleset state: {e}")
+        return True, f"Startup check failed: {e}"
+
+# Deteksi drift antara database, file aturan, dan ruleset kernel
+DRIFT_CHECK_INTERVAL = 300  # detik antar pengecekan berkala
+DRIFT_DEBOUNCE = 2  # detik tunda setelah event nft monitor
+DRIFT_LAYERS = [
+    ('rules_file', 'Rules File'),
+    ('nft_conf', 'nftables Config'),
+    ('kernel', 'Kernel Ruleset'),
+]
+
+drift_state = {
+    'checked_at': None,
+    'expected_hash': None,
+    'layers': {},
+    'in_sync': None,
+}
+drift_lock = threading.Lock()
+_drift_timer = None
+_file_hash_cache = {}
+
+def _strip_nft_comment(line):
+    """Hapus komentar '#' di luar tanda kutip"""
+    in_quote = False
+    for i, ch in enumerate(line):
+        if ch == '"':
+            in_quote = not in_quote
+        elif ch == '#' and not in_quote:
+            return line[:i].rstrip()
+    return line
+
+def _normalize_set_literal(match):
+    elements = [e.strip() for e in match.group(1).split(',') if e.strip()]
+    return "{ " + ", ".join(sorted(elements)) + " }"
+
+def normalize_statement(statement):
+    """Normalisasi statement nftables agar output kernel dan file dapat dibandingkan"""
+    stmt = re.sub(r'\bcomment\s+"[^"]*"', '', statement)
+    stmt = re.sub(r'\bcounter(\s+packets\s+\d+\s+bytes\s+\d+)?', '', stmt)
+    stmt = stmt.replace('"', '')
+    stmt = re.sub(r'/(32|128)\b', '', stmt)
+    stmt = re.sub(r'\{([^{}]*)\}', _normalize_set_literal, stmt)
+    return " ".join(stmt.split())
+
+def parse_ruleset(text):
+    """Parse teks ruleset tableku menjadi struktur ternormalisasi per chain"""
+    parsed = {'chains': {}, 'policies': {}, 'handles': {}, 'raw': {}}
+    table_header = f"table {NFT_TABLE}"
+    depth = 0
+    table_depth = None
+    current_chain = None
+    pending = ""
+    for raw_line in text.splitlines():
+        handle_match = re.search(r'#\s*handle\s+(\d+)\s*$', raw_line)
+        line = _strip_nft_comment(raw_line.strip())
+        if not line:
+            continue
+        # Gabungkan statement multi-baris (mis. anonymous set panjang dari kernel)
+        if pending or (current_chain and depth == table_depth + 1 and line.count('{') > line.count('}')
+                       and not line.startswith('chain ')):
+            pending = f"{pending} {line}".strip()
+            if pending.count('{') > pending.count('}'):
+                continue
+            line, pending = pending, ""
+        opens = line.count('{')
+        closes = line.count('}')
+        if table_depth is None:
+            if " ".join(line.rstrip('{').split()) == table_header:
+                table_depth = depth + 1
+            depth += opens - closes
+            continue
+        if depth == table_depth and line.startswith('chain '):
+            current_chain = line.split()[1]
+            parsed['chains'][current_chain] = []
+            parsed['handles'][current_chain] = []
+            parsed['raw'][current_chain] = []
+            parsed['policies'][current_chain] = None
+        elif current_chain and depth == table_depth + 1 and opens == closes:
+            if line.startswith('type '):
+                policy_match = re.search(r'policy\s+(\w+)', line)
+                parsed['policies'][current_chain] = policy_match.group(1) if policy_match else None
+            else:
+                parsed['chains'][current_chain].append(normalize_statement(line))
+                parsed['handles'][current_chain].append(int(handle_match.group(1)) if handle_match else None)
+                parsed['raw'][current_chain].append(line)
+        depth += opens - closes
+        if current_chain and depth <= table_depth:
+            current_chain = None
+        if depth < table_depth:
+            table_depth = None
+    return parsed
+
+def normalize_compiled(compiled):
+    """Konversi hasil kompilasi ke struktur yang sama dengan parse_ruleset"""
+    normalized = {'chains': {}, 'policies': {}, 'handles': {}, 'raw': {}, 'rule_ids': {}}
+    for chain_name, policy in BASE_CHAINS:
+        entries = compiled['chains'][chain_name]
+        normalized['chains'][chain_name] = [normalize_statement(e['statement']) for e in entries]
+        normalized['raw'][chain_name] = [e['statement'] for e in entries]
+        normalized['rule_ids'][chain_name] = [e['rule_ids'] for e in entries]
+        normalized['handles'][chain_name] = [None] * len(entries)
+        normalized['policies'][chain_name] = policy
+    return normalized
+
+def hash_ruleset(parsed):
+    """Hitung hash SHA-256 dari ruleset ternormalisasi"""
+    digest = hashlib.sha256()
+    for chain_name in sorted(parsed['chains']):
+        digest.update(f"chain {chain_name} policy {parsed['policies'].get(chain_name)}\n".encode())
+        for statement in parsed['chains'][chain_name]:
+            digest.update(statement.encode() + b"\n")
+    return digest.hexdigest()
+
+def _read_file_layer(path):
+    """Baca dan parse file ruleset, memakai cache berdasarkan mtime/ukuran"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _file_hash_cache.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    with open(path) as f:
+        parsed = parse_ruleset(f.read())
+    _file_hash_cache[path] = (key, parsed)
+    return parsed
+
+def read_kernel_ruleset():
+    """Baca tabel tableku dari kernel beserta handle setiap rule"""
+    if not os.path.exists(NFT):
+        return None
+    try:
+        # -t: isi set (feed, meter) tidak ikut dibaca karena drift hanya membandingkan chain
+        result = run_command([NFT, '-a', '-t', 'list', 'table'] + NFT_TABLE.split(),
+                              capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        return parse_ruleset(result.stdout)
+    except Exception as e:
+        logging.error(f"Error reading kernel ruleset: {e}")
+        return None
+
+def diff_rulesets(expected, actual):
+    """Diff struktural: aturan yang hilang, berlebih, atau berubah per chain"""
+    diff = {'missing': [], 'extra': [], 'modified': [], 'policy': []}
+    for chain_name in list(expected['chains']) + [c for c in actual['chains'] if c not in expected['chains']]:
+        exp_stmts = expected['chains'].get(chain_name, [])
+        act_stmts = actual['chains'].get(chain_name)
+        exp_policy = expected['policies'].get(chain_name)
+        act_policy = actual['policies'].get(chain_name)
+        if act_stmts is None or exp_policy != act_policy:
+            diff['policy'].append({'chain': chain_name, 'expected': exp_policy,
+                                   'actual': act_policy if act_stmts is not None else 'missing chain'})
+        act_stmts = act_stmts or []
+        exp_ids = expected.get('rule_ids', {}).get(chain_name, [[]] * len(exp_stmts))
+        act_handles = actual['handles'].get(chain_name, [])
+        matcher = difflib.SequenceMatcher(None, exp_stmts, act_stmts, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                continue
+            paired = min(i2 - i1, j2 - j1) if tag == 'replace' else 0
+            for k in range(paired):
+                diff['modified'].append({'chain': chain_name, 'expected': exp_stmts[i1 + k],
+                                         'actual': act_stmts[j1 + k], 'rule_ids': exp_ids[i1 + k],
+                                         'handle': act_handles[j1 + k] if act_handles else None})
+            for i in range(i1 + paired, i2):
+                diff['missing'].append({'chain': chain_name, 'statement': exp_stmts[i],
+                                        'rule_ids': exp_ids[i]})
+            for j in range(j1 + paired, j2):
+                diff['extra'].append({'chain': chain_name, 'statement': act_stmts[j],
+                                      'handle': act_handles[j] if act_handles else None})
+    return diff
+
+def build_kernel_resync_batch(expected, actual):
+    """Susun batch nft untuk menyamakan kernel dengan database tanpa reload penuh"""
+    table = NFT_TABLE
+    commands = []
+    for chain_name in expected['chains']:
+        if chain_name not in actual['chains'] or \
+                expected['policies'][chain_name] != actual['policies'][chain_name]:
+            return None
+        exp_stmts = expected['chains'][chain_name]
+        exp_raw = expected['raw'][chain_name]
+        act_stmts = actual['chains'][chain_name]
+        act_handles = actual['handles'][chain_name]
+        if any(h is None for h in act_handles):
+            return None
+        prev_handle = None
+        matcher = difflib.SequenceMatcher(None, exp_stmts, act_stmts, autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                prev_handle = act_handles[j2 - 1]
+                continue
+            for j in range(j1, j2):
+                commands.append(f"delete rule {table} {chain_name} handle {act_handles[j]}")
+            # Sisipkan terbalik agar urutan akhir sama dengan database
+            for i in reversed(range(i1, i2)):
+                if prev_handle is None:
+                    commands.append(f"insert rule {table} {chain_name} {exp_raw[i]}")
+                else:
+                    commands.append(f"add rule {table} {chain_name} position {prev_handle} {exp_raw[i]}")
+    return commands
+
+def get_expected_ruleset():
+    """Kompilasi ruleset yang diharapkan dari database"""
+    compiled = compile_ruleset(get_rules())
+    return compiled, normalize_compiled(compiled)
+
+def check_drift():
+    """Bandingkan hash tiap lapisan dan lakukan diff struktural bila berbeda"""
+    try:
+        compiled, expected = get_expected_ruleset()
+        expected_hash = hash_ruleset(expected)
+        layers = {
+            'rules_file': _read_file_layer(RULES_FILE),
+            'nft_conf': _read_file_layer(NFT_CONF),
+            'kernel': read_kernel_ruleset(),
+        }
+        report = {}
+        for name, label in DRIFT_LAYERS:
+            parsed = layers[name]
+            if parsed is None:
+                report[name] = {'label': label, 'available': False, 'hash': None,
+                                'in_sync': False, 'diff': None}
+                continue
+            layer_hash = hash_ruleset(parsed)
+            in_sync = layer_hash == expected_hash
+            report[name] = {
+                'label': label,
+                'available': True,
+                'hash': layer_hash,
+                'in_sync': in_sync,
+                # Diff struktural hanya dihitung jika hash berbeda
+                'diff': None if in_sync else diff_rulesets(expected, parsed),
+            }
+        in_sync = all(layer['in_sync'] for layer in report.values())
+        with drift_lock:
+            drift_state['checked_at'] = datetime.now()
+            drift_state['expected_hash'] = expected_hash
+            drift_state['layers'] = report
+            drift_state['in_sync'] = in_sync
+        if not in_sync:
+            drifted = [name for name, layer in report.items() if not layer['in_sync']]
+            logging.warning(f"Ruleset drift detected in: {', '.join(drifted)}")
+        return drift_state
+    except Exception as e:
+        logging.error(f"Error checking ruleset drift: {e}")
+        return drift_state
+
+def resync_drift(layer):
+    """Sinkronisasi terarah untuk lapisan yang drift ('files' atau 'kernel')"""
+    try:
+        compiled, expected = get_expected_ruleset()
+        if layer == 'files':
+            config = render_ruleset(compiled, flush=nft_table_exists())
+            with open(RULES_FILE, "w") as f:
+                f.write(config)
+            os.chmod(RULES_FILE, 0o640)
+            shutil.copy2(RULES_FILE, NFT_CONF)
+            logging.info(f"Re-synced {RULES_FILE} and {NFT_CONF} from database")
+            check_drift()
+            return True, "Rules file and nftables config re-synced from database"
+        
+        if layer == 'kernel':
+            actual = read_kernel_ruleset()
+            commands = build_kernel_resync_batch(expected, actual) if actual else None
+            if commands is None:
+                # Struktur tabel berbeda: muat ulang tabel secara atomik tanpa restart service
+                logging.warning("Kernel table structure differs, loading rules file atomically")
+                with set_lock:
+                    result = run_command([NFT, '-f', RULES_FILE], capture_output=True, text=True)
+                    invalidate_set_sync()
+            elif not commands:
+                check_drift()
+                return True, "Kernel ruleset already in sync"
+            else:
+                logging.info(f"Applying {len(commands)} targeted nft commands")
+                result = run_command([NFT, '-f', '-'], input="\n".join(commands) + "\n",
+                                      capture_output=True, text=True)
+            bump_generation('ruleset')
+            if result.returncode != 0:
+                logging.error(f"Error re-syncing kernel ruleset: {result.stderr}")
+                return False, f"Error re-syncing kernel ruleset: {result.stderr}"
+            check_drift()
+            count = len(commands) if commands else 'full table'
+            return True, f"Kernel ruleset re-synced ({count} changes)"
+        
+        return False, f"Unknown layer: {layer}"
+    except Exception as e:
+        logging.error(f"Error re-syncing drift: {e}")
+        return False, f"Error re-syncing drift: {e}"
+
+def schedule_drift_check():
+    """Jadwalkan pengecekan drift dengan debounce (dipicu event nft monitor)"""
+    global _drift_timer
+    with drift_lock:
+        if _drift_timer is not None:
+            _drift_timer.cancel()
+        _drift_timer = threading.Timer(DRIFT_DEBOUNCE, check_drift)
+        _drift_timer.daemon = True
+        _drift_timer.start()
+
+# Fungsi untuk menjalankan pengecekan drift secara berkala
+def drift_checker():
+    """Menjalankan pengecekan drift setiap DRIFT_CHECK_INTERVAL detik"""
+    while True:
+        try:
+            check_drift()
+            time.sleep(DRIFT_CHECK_INTERVAL)
+        except Exception as e:
+            logging.error(f"Error in drift checker: {e}")
+            time.sleep(60)
+
+# Fungsi untuk memantau perubahan ruleset dari proses lain (Docker, fail2ban, admin)
+def nft_monitor_watcher():
+    """Mengikuti output 'nft monitor' dan memicu pengecekan drift saat ada perubahan"""
+    while True:
+        if not os.path.exists(NFT):
+            logging.warning("nft not available, monitor watcher stopped")
+            return
+        try:
+            process = subprocess.Popen([NFT, 'monitor'], stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, text=True)
+            data_generation['monitor_active'] = True
+            for line in process.stdout:
+                if line.strip():
+                    bump_generation('ruleset')
+                    schedule_drift_check()
+            process.wait()
+            data_generation['monitor_active'] = False
+            logging.warning(f"nft monitor exited with code {process.returncode}")
+        except Exception as e:
+            logging.error(f"Error in nft monitor watcher: {e}")
+        data_generation['monitor_active'] = False
+        time.sleep(30)
+
+# Mode fleet: controller mendorong ruleset terkompilasi ke agent di banyak node
+AGENT_PORT = 2108
+FLEET_MAX_WORKERS = 8  # jumlah push paralel maksimal
+FLEET_NODE_TIMEOUT = 15  # detik timeout per node
+
+fleet_state = {
+    'last_push': None,
+}
+fleet_lock = threading.Lock()
+
+def get_nodes(enabled_only=False):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    if enabled_only:
+        c.execute("SELECT * FROM nodes WHERE enabled = 1 ORDER BY canary DESC, name")
+    else:
+        c.execute("SELECT * FROM nodes ORDER BY canary DESC, name")
+    rows = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return rows
+
+def update_node_status(node_id, status, message, ruleset_hash=None):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    if ruleset_hash:
+        c.execute("""
+            UPDATE nodes SET last_status=?, last_message=?, last_hash=?, last_push_at=? 
+            WHERE id=?
+        """, (status, message, ruleset_hash, datetime.now(), node_id))
+    else:
+        c.execute("""
+            UPDATE nodes SET last_status=?, last_message=?, last_push_at=? 
+            WHERE id=?
+        """, (status, message, datetime.now(), node_id))
+    conn.commit()
+    conn.close()
+
+def _agent_request(node, path, payload=None):
+    """Kirim request JSON ke agent node dengan token dan timeout per node"""
+    url = f"http://{node['address']}:{node['port']}{path}"
+    data = json.dumps(payload).encode() if payload is not None else None
+    req = urllib.request.Request(url, data=data, method='POST' if data else 'GET', headers={
+        'Authorization': f"Bearer {node['token']}",
+        'Content-Type': 'application/json',
+        'X-Request-ID': ensure_request_id(),
+    })
+    try:
+        with urllib.request.urlopen(req, timeout=FLEET_NODE_TIMEOUT) as response:
+            return json.loads(response.read().decode() or '{}')
+    except urllib.error.HTTPError as e:
+        try:
+            body = json.loads(e.read().decode() or '{}')
+        except ValueError:
+            body = {}
+        return {'success': False, 'message': body.get('message', f"HTTP {e.code}")}
+
+def push_to_node(node, config, ruleset_hash, force=False):
+    """Push ruleset ke satu node dan catat statusnya"""
+    if not force and node['last_status'] in ('applied', 'unchanged') and node['last_hash'] == ruleset_hash:
+        update_node_status(node['id'], 'unchanged', 'Profile unchanged, push skipped', ruleset_hash)
+        return {'node': node['name'], 'status': 'unchanged',
+                'message': 'Profile unchanged, push skipped', 'duration': 0}
+    started = time.time()
+    try:
+        result = _agent_request(node, '/apply', {'ruleset': config, 'hash': ruleset_hash})
+        success = bool(result.get('success'))
+        message = result.get('message', '')
+    except Exception as e:
+        success = False
+        message = f"Unreachable: {e}"
+    duration = round(time.time() - started, 3)
+    status = 'applied' if success else 'failed'
+    update_node_status(node['id'], status, message, ruleset_hash if success else None)
+    if success:
+        logging.info(f"Pushed ruleset to node {node['name']} in {duration}s")
+    else:
+        logging.error(f"Failed to push ruleset to node {node['name']}: {message}")
+    return {'node': node['name'], 'status': status, 'message': message, 'duration': duration}
+
+def _push_wave(nodes, profiles, force=False):
+    """Push paralel ke sekumpulan node; hentikan sisa antrean saat ada kegagalan"""
+    results = []
+    failed = False
+    if not nodes:
+        return results, failed
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(FLEET_MAX_WORKERS, len(nodes))) as executor:
+        futures = {}
+        for node in nodes:
+            config, ruleset_hash = profiles[node['profile']]
+            context = contextvars.copy_context()
+            futures[executor.submit(context.run, push_to_node, node, config, ruleset_hash, force)] = node
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result() if not future.cancelled() else None
+            if result is None:
+                continue
+            results.append(result)
+            if result['status'] == 'failed' and not failed:
+                failed = True
+                for pending in futures:
+                    if pending.cancel():
+                        node = futures[pending]
+                        update_node_status(node['id'], 'cancelled', 'Rollout stopped after failure')
+                        results.append({'node': node['name'], 'status': 'cancelled',
+                                        'message': 'Rollout stopped after failure', 'duration': 0})
+    return results, failed
+
+def compile_fleet_profiles(nodes, rules=None, resolve_geo=False):
+    """Kelompokkan node per kombinasi tag relevan dan kompilasi sekali per profil
+
+    Set geo hanya di-resolve dari file GeoIP jika resolve_geo=True (jalur push); halaman fleet
+    cukup membaca elemen yang tersimpan.
+    """
+    if rules is None:
+        rules = get_rules()
+    relevant = referenced_tags(rules)
+    for node in nodes:
+        node['profile'] = node_tag_set(node['name'], node.get('tags')) & relevant
+    if resolve_geo:
+        definitions = {}
+        for profile in {node['profile'] for node in nodes}:
+            for definition in active_geo_sets(rules, profile):
+                definitions.setdefault(definition['name'], definition)
+        refresh_geo_sets(list(definitions.values()))
+    fingerprint = rules_fingerprint(rules)
+    profiles = {}
+    for node in nodes:
+        if node['profile'] not in profiles:
+            profiles[node['profile']] = compile_profile(rules, node['profile'], fingerprint)
+    return profiles
+
+def push_to_fleet(force=False):
+    """Rollout ruleset: node canary terlebih dahulu, lalu node lain secara paralel"""
+    try:
+        logging.info("=== Starting fleet push ===")
+        nodes = get_nodes(enabled_only=True)
+        if not nodes:
+            return False, "No enabled nodes registered", []
+        
+        profiles = compile_fleet_profiles(nodes, resolve_geo=True)
+        logging.info(f"Compiled {len(profiles)} distinct profiles for {len(nodes)} nodes")
+        
+        canaries = [node for node in nodes if node['canary']]
+        others = [node for node in nodes if not node['canary']]
+        
+        results, failed = _push_wave(canaries, profiles, force)
+        if failed:
+            for node in others:
+                update_node_status(node['id'], 'skipped', 'Canary rollout failed')
+                results.append({'node': node['name'], 'status': 'skipped',
+                                'message': 'Canary rollout failed', 'duration': 0})
+        else:
+            wave_results, failed = _push_wave(others, profiles, force)
+            results.extend(wave_results)
+        
+        applied = sum(1 for r in results if r['status'] in ('applied', 'unchanged'))
+        with fleet_lock:
+            fleet_state['last_push'] = {
+                'at': datetime.now(),
+                'profiles': len(profiles),
+                'results': results,
+                'success': not failed,
+            }
+        if failed:
+            logging.error(f"Fleet push stopped: {applied}/{len(nodes)} nodes applied")
+            return False, f"Rollout stopped after failure ({applied}/{len(nodes)} nodes applied)", results
+        logging.info(f"Fleet push completed: {applied}/{len(nodes)} nodes applied")
+        return True, f"Ruleset applied to {applied} nodes ({len(profiles)} profiles)", results
+    except Exception as e:
+        logging.error(f"Unexpected error in push_to_fleet: {e}")
+        return False, f"Unexpected error: {e}", []
+
+def poll_fleet_status():
+    """Ambil hash ruleset aktif dari setiap agent secara paralel"""
+    nodes = get_nodes(enabled_only=True)
+    statuses = {}
+    
+    def poll(node):
+        try:
+            return node['id'], _agent_request(node, '/status')
+        except Exception as e:
+            return node['id'], {'success': False, 'message': f"Unreachable: {e}"}
+    
+    if nodes:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(FLEET_MAX_WORKERS, len(nodes))) as executor:
+            for node_id, status in executor.map(poll, nodes):
+                statuses[node_id] = status
+    return statuses
+
+# Agent: menerima ruleset dari controller dan menerapkannya di node lokal
+def agent_apply_ruleset(config, dry_run=False):
+    """Validasi lalu terapkan ruleset yang diterima dari controller"""
+    if not ensure_directory_exists(RULES_FILE):
+        return False, "Failed to create configuration directory"
+    staged_file = f"{RULES_FILE}.new"
+    with open(staged_file, "w") as f:
+        f.write(config)
+    os.chmod(staged_file, 0o640)
+    if os.path.exists(NFT):
+        check = run_command([NFT, '-c', '-f', staged_file], capture_output=True, text=True)
+        if check.returncode != 0:
+            os.remove(staged_file)
+            logging.error(f"Agent rejected invalid ruleset: {check.stderr}")
+            return False, f"Invalid ruleset: {check.stderr}"
+    os.replace(staged_file, RULES_FILE)
+    if dry_run:
+        logging.info("Agent stored ruleset (dry run, not applied)")
+        return True, "Ruleset validated and stored (dry run)"
+    return reload_nft()
+
+class AgentRequestHandler(BaseHTTPRequestHandler):
+    """Handler HTTP untuk agent fleet"""
+    token = None
+    dry_run = False
+    state = {'hash': None, 'applied_at': None}
+    apply_lock = threading.Lock()
+    
+    def _send_json(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _authorized(self):
+        header = self.headers.get('Authorization', '')
+        return header.startswith('Bearer ') and hmac.compare_digest(header[7:], self.token)
+    
+    def do_GET(self):
+        if not self._authorized():
+            return self._send_json(401, {'success': False, 'message': 'Unauthorized'})
+        if self.path != '/status':
+            return self._send_json(404, {'success': False, 'message': 'Not found'})
+        self._send_json(200, {'success': True, 'hash': self.state['hash'],
+                              'applied_at': self.state['applied_at'], 'dry_run': self.dry_run})
+    
+    def do_POST(self):
+        request_id_var.set(self.headers.get('X-Request-ID') or new_request_id())
+        if not self._authorized():
+            return self._send_json(401, {'success': False, 'message': 'Unauthorized'})
+        if self.path != '/apply':
+            return self._send_json(404, {'success': False, 'message': 'Not found'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length).decode())
+            config = payload['ruleset']
+        except (ValueError, KeyError) as e:
+            return self._send_json(400, {'success': False, 'message': f"Invalid payload: {e}"})
+        ruleset_hash = hashlib.sha256(config.encode()).hexdigest()
+        if payload.get('hash') and payload['hash'] != ruleset_hash:
+            return self._send_json(400, {'success': False, 'message': 'Ruleset hash mismatch'})
+        with self.apply_lock:
+            if ruleset_hash == self.state['hash']:
+                return self._send_json(200, {'success': True, 'hash': ruleset_hash,
+                                             'message': 'Ruleset already applied'})
+            success, message = agent_apply_ruleset(config, self.dry_run)
+            if success:
+                self.state['hash'] = ruleset_hash
+                self.state['applied_at'] = datetime.now().isoformat()
+        self._send_json(200 if success else 500, {'success': success, 'message': message,
+                                                 'hash': ruleset_hash})
+    
+    def log_message(self, format, *args):
+        logging.info(f"Agent {self.address_string()} - {format % args}")
+
+def run_agent(host, port, token, dry_run=False):
+    """Menjalankan agent fleet ringan (tanpa database dan antarmuka web)"""
+    AgentRequestHandler.token = token
+    AgentRequestHandler.dry_run = dry_run
+    if os.path.exists(RULES_FILE):
+        with open(RULES_FILE) as f:
+            AgentRequestHandler.state['hash'] = hashlib.sha256(f.read().encode()).hexdigest()
+    server = ThreadingHTTPServer((host, port), AgentRequestHandler)
+    logging.info(f"=== Starting nftables Manager agent on {host}:{port} (dry run: {dry_run}) ===")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+# Simulasi kebijakan: evaluasi tuple paket secara offline terhadap ruleset terkompilasi
+SIMULATOR_MEMO_SIZE = 65536
+PROTOCOL_NUMBERS = {1: 'icmp', 6: 'tcp', 17: 'udp', 58: 'icmpv6'}
+
+_simulator_cache = {'token': None, 'simulator': None}
+
+def parse_port_spec(dport):
+    """Parse spesifikasi port ('22', '80,443', '8000-8009', '{ 80, 443 }') menjadi daftar rentang"""
+    ranges = []
+    for part in str(dport).strip().strip('{}').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            low, high = part.split('-', 1)
+            ranges.append((int(low), int(high)))
+        else:
+            ranges.append((int(part), int(part)))
+    return ranges
+
+def parse_address_spec(value):
+    """Parse alamat atau prefix (dipisah koma) menjadi daftar ip_network"""
+    return [ipaddress.ip_network(part.strip(), strict=False)
+            for part in str(value).strip().strip('{}').split(',') if part.strip()]
+
+class _PrefixIndex:
+    """Trie prefix terkompresi per panjang prefix: satu dict per level, nilai berupa bitmask aturan"""
+    
+    def __init__(self):
+        self.any_mask = 0
+        self.levels = {4: {}, 6: {}}
+    
+    def add(self, networks, bit):
+        if networks is None:
+            self.any_mask |= bit
+            return
+        for network in networks:
+            bits = 32 if network.version == 4 else 128
+            level = self.levels[network.version].setdefault(network.prefixlen, {})
+            key = int(network.network_address) >> (bits - network.prefixlen)
+            level[key] = level.get(key, 0) | bit
+    
+    def freeze(self):
+        self.frozen = {}
+        for version, levels in self.levels.items():
+            bits = 32 if version == 4 else 128
+            self.frozen[version] = [(bits - length, levels[length]) for length in sorted(levels)]
+    
+    def lookup(self, version, value):
+        mask = self.any_mask
+        if value is None:
+            return mask
+        for shift, table in self.frozen[version]:
+            found = table.get(value >> shift)
+            if found:
+                mask |= found
+        return mask
+
+class PolicySimulator:
+    """Evaluator offline dengan semantik chain dan kebijakan default yang sama dengan save_rules()"""
+    
+    def __init__(self, rules, node_tags=None):
+        # Feed, daftar dinamis dan flowtable tidak dievaluasi sehingga tidak perlu dibaca dari database
+        compiled = compile_ruleset(rules, node_tags, flowtable=False, feeds=(), dynamic_lists=False)
+        rules_by_id = {rule['id']: rule for rule in rules}
+        self.chains = {}
+        self.policies = dict(BASE_CHAINS)
+        self.invalid_rules = []
+        for chain_name, policy in BASE_CHAINS:
+            # Diindeks per entri hasil kompilasi, bukan per aturan: kompaksi dapat memindahkan entri ip6
+            # sebuah aturan dual-stack ke atas tanpa entri ip-nya
+            slots = []
+            for entry in compiled['chains'][chain_name]:
+                for source in entry.get('sources', ()):
+                    rule = rules_by_id[source['rule_id']]
+                    # Aturan limit hanya menjatuhkan sumber yang melewati limit; simulasi mengasumsikan trafik normal
+                    if rule_type_of(rule) == 'static':
+                        slots.append((rule, entry, source))
+            self.chains[chain_name] = self._build_chain(slots)
+        self._memo = {}
+    
+    def _build_chain(self, slots):
+        """Indeks bitmask untuk daftar (aturan, entri, sumber) berurutan; satu bit per sumber entri"""
+        index = {
+            'rules': [],
+            'matches': [],
+            'verdicts': [],
+            'family_masks': {4: 0, 6: 0},
+            'proto_masks': {},
+            'any_proto_mask': 0,
+            'port_bounds': [],
+            'port_masks': [],
+            'any_port_mask': 0,
+            'src': _PrefixIndex(),
+            'dst': _PrefixIndex(),
+        }
+        invalid = {item['rule_id'] for item in self.invalid_rules}
+        port_ranges = []
+        for rule, entry, source in slots:
+            family = entry.get('family')
+            try:
+                addresses = {}
+                for field in ('src', 'dst'):
+                    if entry.get('geo_set') and geo_address_field(rule) == field:
+                        # Alamat yang dicocokkan set geo diganti jaringan hasil resolve file GeoIP
+                        addresses[field] = geo_networks(entry['geo_set'])
+                    else:
+                        addresses[field] = parse_address_spec(source[field]) if source[field] else None
+                protocol = rule['protocol'].lower() if rule['protocol'] else None
+                ports = None
+                if protocol in ICMP_PROTOCOLS:
+                    # Statement icmp pada family ip6 dikompilasi menjadi icmpv6 echo-request
+                    if family == 'ip6':
+                        protocol = 'icmpv6'
+                    verdict = 'accept'
+                else:
+                    verdict = rule['action']
+                    if source['dport']:
+                        ports = parse_port_spec(source['dport'])
+                        protocol = protocol or 'tcp'
+            except ValueError as e:
+                if rule['id'] not in invalid:
+                    invalid.add(rule['id'])
+                    self.invalid_rules.append({'rule_id': rule['id'], 'error': str(e)})
+                continue
+            src, dst = addresses['src'], addresses['dst']
+            bit = 1 << len(index['rules'])
+            index['rules'].append(rule)
+            index['matches'].append({'family': family, 'src': src, 'dst': dst, 'protocol': protocol, 'ports': ports})
+            index['verdicts'].append(verdict)
+            for version, name in ADDRESS_FAMILIES.items():
+                if family in (None, name):
+                    index['family_masks'][version] |= bit
+            if protocol:
+                index['proto_masks'][protocol] = index['proto_masks'].get(protocol, 0) | bit
+            else:
+                index['any_proto_mask'] |= bit
+            if ports is None:
+                index['any_port_mask'] |= bit
+            else:
+                port_ranges.extend((low, high, bit) for low, high in ports)
+            index['src'].add(src, bit)
+            index['dst'].add(dst, bit)
+        # Rentang port dipecah menjadi segmen elementer untuk lookup bisect
+        bounds = sorted({low for low, _, _ in port_ranges} | {high + 1 for _, high, _ in port_ranges})
+        masks = [0] * len(bounds)
+        for low, high, bit in port_ranges:
+            for k in range(bisect.bisect_left(bounds, low), bisect.bisect_left(bounds, high + 1)):
+                masks[k] |= bit
+        index['port_bounds'] = bounds
+        index['port_masks'] = masks
+        index['src'].freeze()
+        index['dst'].freeze()
+        return index
+    
+    def _lookup(self, chain_name, src, dst, protocol, dport, iif, ct_state):
+        key = (chain_name, src, dst, protocol, dport, iif, ct_state)
+        result = self._memo.get(key)
+        if result is not None:
+            return result
+        index = self.chains[chain_name]
+        if chain_name == 'input' and (iif == 'lo' or ct_state in ('established', 'related')):
+            result = ('accept', None)
+        else:
+            mask = index['proto_masks'].get(protocol, 0) | index['any_proto_mask'] if protocol else index['any_proto_mask']
+            if mask and dport is not None and index['port_bounds']:
+                k = bisect.bisect_right(index['port_bounds'], dport) - 1
+                port_mask = index['port_masks'][k] if 0 <= k < len(index['port_masks']) else 0
+                mask &= index['any_port_mask'] | port_mask
+            else:
+                mask &= index['any_port_mask']
+            if mask and (src or dst):
+                # Entri ip/ip6 hanya cocok dengan paket dari family-nya sendiri
+                mask &= index['family_masks'][_parse_ip(src or dst)[0]]
+            if mask:
+                mask &= index['src'].lookup(*_parse_ip(src)) if src else index['src'].any_mask
+            if mask:
+                mask &= index['dst'].lookup(*_parse_ip(dst)) if dst else index['dst'].any_mask
+            if mask:
+                # Bit terendah = aturan pertama yang cocok (first match)
+                position = (mask & -mask).bit_length() - 1
+                result = (index['verdicts'][position], index['rules'][position]['id'])
+            else:
+                result = (self.policies[chain_name], None)
+        if len(self._memo) >= SIMULATOR_MEMO_SIZE:
+            self._memo.clear()
+        self._memo[key] = result
+        return result
+    
+    def evaluate(self, chain, src=None, dst=None, protocol=None, dport=None, iif=None, ct_state='new'):
+        """Evaluasi satu tuple paket; kembalikan verdict dan aturan yang cocok"""
+        chain_name = chain.lower()
+        if chain_name not in self.chains:
+            raise ValueError(f"Unknown chain: {chain}")
+        protocol = normalize_protocol(protocol)
+        dport = int(dport) if dport not in (None, '') else None
+        verdict, rule_id = self._lookup(chain_name, src or None, dst or None, protocol, dport, iif, ct_state)
+        return {'verdict': verdict, 'rule_id': rule_id, 'default_policy': rule_id is None and
+                not (chain_name == 'input' and (iif == 'lo' or ct_state in ('established', 'related')))}
+    
+    def evaluate_many(self, tuples):
+        """Evaluasi banyak tuple (chain, src, dst, protocol, dport); hasilkan (verdict, rule_id) per tuple"""
+        lookup = self._lookup
+        for chain, src, dst, protocol, dport in tuples:
+            yield lookup(chain, src, dst, protocol, dport, None, 'new')
+
+@functools.lru_cache(maxsize=SIMULATOR_MEMO_SIZE)
+def _parse_ip(value):
+    """Parse alamat IP menjadi (versi, integer) dengan cache"""
+    address = ipaddress.ip_address(value)
+    return address.version, int(address)
+
+def normalize_protocol(protocol):
+    """Normalisasi protokol dari nama atau nomor"""
+    if protocol in (None, ''):
+        return None
+    if isinstance(protocol, int) or str(protocol).isdigit():
+        return PROTOCOL_NUMBERS.get(int(protocol), str(protocol))
+    return str(protocol).lower()
+
+def get_simulator():
+    """Ambil simulator untuk ruleset saat ini, dibangun ulang hanya jika aturan atau data turunannya berubah"""
+    # Generasi 'db' menangkap penulisan eksplisit lain (mis. set geo) tanpa ikut berubah oleh last_used_at token
+    snapshot = rule_snapshot()
+    token = (snapshot.token, data_generation['db'])
+    if _simulator_cache['token'] != token:
+        _simulator_cache['simulator'] = PolicySimulator(list(snapshot.rules))
+        _simulator_cache['token'] = token
+    return _simulator_cache['simulator']
+
+def summarize_simulation(simulator, tuples):
+    """Hitung jumlah verdict dan hit per aturan untuk satu batch tuple"""
+    verdicts = {}
+    rule_hits = {}
+    total = 0
+    for verdict, rule_id in simulator.evaluate_many(tuples):
+        total += 1
+        verdicts[verdict] = verdicts.get(verdict, 0) + 1
+        rule_hits[rule_id] = rule_hits.get(rule_id, 0) + 1
+    return {'total': total, 'verdicts': verdicts, 'rule_hits': rule_hits}
+
+def read_csv_tuples(lines, default_chain='input'):
+    """Baca tuple dari CSV (chain,src,dst,protocol,dport); header opsional"""
+    for row in csv.reader(lines):
+        if not row or row[0].startswith('#') or row[0].strip().lower() == 'chain':
+            continue
+        row = [value.strip() for value in row] + [''] * (5 - len(row))
+        chain, src, dst, protocol, dport = row[:5]
+        yield (chain.lower() or default_chain, src or None, dst or None,
+               normalize_protocol(protocol), int(dport) if dport else None)
+
+def read_pcap_tuples(stream, chain='input'):
+    """Baca tuple dari file pcap klasik (Ethernet, raw IP, Linux SLL) tanpa dependensi eksternal"""
+    header = stream.read(24)
+    if len(header) < 24:
+        return
+    magic = header[:4]
+    if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+        endian = '<'
+    elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+        endian = '>'
+    else:
+        raise ValueError("Unsupported capture format (only classic pcap is supported)")
+    linktype = struct.unpack(endian + 'I', header[20:24])[0]
+    record = struct.Struct(endian + 'IIII')
+    while True:
+        record_header = stream.read(16)
+        if len(record_header) < 16:
+            return
+        _, _, captured, _ = record.unpack(record_header)
+        packet = stream.read(captured)
+        if linktype == 1:
+            offset, ethertype = 14, packet[12:14]
+            while ethertype in (b'\x81\x00', b'\x88\xa8') and len(packet) >= offset + 4:
+                ethertype = packet[offset + 2:offset + 4]
+                offset += 4
+        elif linktype == 113:
+            offset, ethertype = 16, packet[14:16]
+        elif linktype == 101:
+            offset = 0
+            ethertype = b'\x08\x00' if packet[:1] and packet[0] >> 4 == 4 else b'\x86\xdd'
+        else:
+            raise ValueError(f"Unsupported pcap link type: {linktype}")
+        if ethertype == b'\x08\x00' and len(packet) >= offset + 20:
+            ihl = (packet[offset] & 0x0f) * 4
+            proto = packet[offset + 9]
+            src = socket.inet_ntop(socket.AF_INET, packet[offset + 12:offset + 16])
+            dst = socket.inet_ntop(socket.AF_INET, packet[offset + 16:offset + 20])
+            l4 = offset + ihl
+        elif ethertype == b'\x86\xdd' and len(packet) >= offset + 40:
+            proto = packet[offset + 6]
+            src = socket.inet_ntop(socket.AF_INET6, packet[offset + 8:offset + 24])
+            dst = socket.inet_ntop(socket.AF_INET6, packet[offset + 24:offset + 40])
+            l4 = offset + 40
+        else:
+            continue
+        dport = None
+        if proto in (6, 17) and len(packet) >= l4 + 4:
+            dport = struct.unpack('!H', packet[l4 + 2:l4 + 4])[0]
+        yield (chain, src, dst, PROTOCOL_NUMBERS.get(proto, str(proto)), dport)
+
+# REST API /api/v1: token di-hash, operasi tulis dijalankan atomik dalam satu transaksi
+API_TOKEN_PREFIX = "nftm_"
+API_BATCH_MAX = 1000  # operasi maksimum per request batch
+RULE_ACTIONS = ('accept', 'drop', 'reject')
+RULE_PROTOCOLS = ('tcp', 'udp', 'icmp', 'icmpv6')
+RULE_FIELDS = ('name', 'group_id', 'chain', 'src', 'dst', 'dport', 'protocol', 'action', 'comment', 'enabled',
+               'expired_at', 'target_tags', 'rule_type', 'limit_value', 'geo')
+GROUP_FIELDS = ('name', 'description', 'color', 'target_tags')
+
+class ApiError(Exception):
+    """Kesalahan operasi API beserta status HTTP-nya"""
+    
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def hash_api_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def create_api_token(name, user_id):
+    """Buat token baru; nilai asli hanya dikembalikan sekali dan tidak disimpan"""
+    token = API_TOKEN_PREFIX + secrets.token_urlsafe(32)
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    c.execute("INSERT INTO api_tokens (name, token_hash, prefix, user_id) VALUES (?, ?, ?, ?)",
+              (name, hash_api_token(token), token[:len(API_TOKEN_PREFIX) + 6], user_id))
+    conn.commit()
+    conn.close()
+    return token
+
+def get_api_tokens():
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("""
+        SELECT t.id, t.name, t.prefix, t.revoked, t.created_at, t.last_used_at, u.username
+        FROM api_tokens t LEFT JOIN users u ON t.user_id = u.id
+        ORDER BY t.revoked, t.created_at DESC
+    """)
+    rows = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return rows
+
+def revoke_api_token(token_id):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    c.execute("UPDATE api_tokens SET revoked = 1 WHERE id=?", (token_id,))
+    conn.commit()
+    conn.close()
+
+def authenticate_api_token(header):
+    """Cari token aktif dari header Authorization: Bearer <token>; None jika tidak valid"""
+    if not header.startswith('Bearer '):
+        return None
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("SELECT id, name, user_id FROM api_tokens WHERE token_hash=? AND revoked=0",
+              (hash_api_token(header[len('Bearer '):].strip()),))
+    row = c.fetchone()
+    if row:
+        c.execute("UPDATE api_tokens SET last_used_at=? WHERE id=?", (datetime.now(), row['id']))
+        conn.commit()
+    conn.close()
+    return dict(row) if row else None
+
+def json_object_body():
+    """Body JSON request sebagai dict ({} jika kosong atau bukan JSON); None jika JSON tetapi bukan objek"""
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return {}
+    return payload if isinstance(payload, dict) else None
+
+JSON_OBJECT_REQUIRED = {'success': False, 'message': "Request body must be a JSON object"}
+
+def _clean(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+def validate_rule_payload(data, current=None):
+    """Gabungkan payload dengan aturan yang ada lalu validasi seperti form add/edit rule"""
+    if not isinstance(data, dict):
+        raise ApiError("Rule data must be an object")
+    unknown = set(data) - set(RULE_FIELDS)
+    if unknown:
+        raise ApiError(f"Unknown rule fields: {', '.join(sorted(unknown))}")
+    if current is None:
+        rule = dict.fromkeys(RULE_FIELDS)
+        rule.update(enabled=True, rule_type='static')
+    else:
+        rule = {field: current.get(field) for field in RULE_FIELDS}
+    rule.update(data)
+    for field in ('name', 'chain', 'src', 'dst', 'dport', 'protocol', 'action', 'comment', 'expired_at',
+                  'rule_type', 'limit_value', 'geo'):
+        rule[field] = _clean(rule[field])
+    if not rule['name']:
+        raise ApiError("Rule name is required")
+    rule['chain'] = (rule['chain'] or '').lower()
+    if rule['chain'] not in dict(BASE_CHAINS):
+        raise ApiError(f"Chain must be one of: {', '.join(name for name, _ in BASE_CHAINS)}")
+    rule['action'] = (rule['action'] or '').lower()
+    if rule['action'] not in RULE_ACTIONS:
+        raise ApiError(f"Action must be one of: {', '.join(RULE_ACTIONS)}")
+    rule['protocol'] = rule['protocol'].lower() if rule['protocol'] else None
+    if rule['protocol'] and rule['protocol'] not in RULE_PROTOCOLS:
+        raise ApiError(f"Protocol must be one of: {', '.join(RULE_PROTOCOLS)}")
+    if rule['dport'] and not rule['protocol']:
+        raise ApiError("Protocol is required when specifying a port")
+    error = validate_rule_families(rule['src'], rule['dst'], rule['protocol'])
+    if error:
+        raise ApiError(error)
+    rule['rule_type'] = rule['rule_type'] or 'static'
+    if rule['rule_type'] not in RULE_TYPES:
+        raise ApiError(f"Rule type must be one of: {', '.join(RULE_TYPES)}")
+    rule['limit_value'], error = validate_rule_limit(rule['rule_type'], rule['limit_value'], rule['action'],
+                                                     rule['protocol'])
+    if error:
+        raise ApiError(error)
+    rule['geo'], error = validate_rule_geo(rule['geo'], rule['chain'], rule['src'], rule['dst'])
+    if error:
+        raise ApiError(error)
+    if rule['expired_at']:
+        try:
+            rule['expired_at'] = datetime.fromisoformat(rule['expired_at'])
+        except ValueError:
+            raise ApiError("expired_at must be an ISO 8601 date/time")
+    if rule['group_id'] in ('', None):
+        rule['group_id'] = None
+    elif not str(rule['group_id']).isdigit():
+        raise ApiError("group_id must be an integer")
+    else:
+        rule['group_id'] = int(rule['group_id'])
+    rule['enabled'] = bool(rule['enabled'])
+    rule['target_tags'] = normalize_tags(rule['target_tags'])
+    return rule
+
+def validate_group_payload(data, current=None):
+    if not isinstance(data, dict):
+        raise ApiError("Group data must be an object")
+    unknown = set(data) - set(GROUP_FIELDS)
+    if unknown:
+        raise ApiError(f"Unknown group fields: {', '.join(sorted(unknown))}")
+    group = {field: (current or {}).get(field) for field in GROUP_FIELDS}
+    group.update(data)
+    group['name'] = _clean(group['name'])
+    if not group['name']:
+        raise ApiError("Group name is required")
+    group['description'] = _clean(group['description']) or ''
+    group['color'] = _clean(group['color']) or '#6c757d'
+    if not re.fullmatch(r'#[0-9a-fA-F]{6}', group['color']):
+        raise ApiError("Color must be a hex value like #6c757d")
+    group['target_tags'] = normalize_tags(group['target_tags'])
+    return group
+
+def _fetch_row(c, table, row_id):
+    c.execute(f"SELECT * FROM {table} WHERE id=?", (row_id,))
+    row = c.fetchone()
+    return dict(row) if row else None
+
+def _require_row(c, table, row_id, label):
+    row = _fetch_row(c, table, row_id) if isinstance(row_id, int) or str(row_id).isdigit() else None
+    if row is None:
+        raise ApiError(f"{label} {row_id} not found", 404)
+    return row
+
+def _check_group(c, group_id):
+    if group_id is not None:
+        _require_row(c, 'rule_groups', group_id, 'Group')
+
+def _op_create_rule(c, operation):
+    rule = validate_rule_payload(operation.get('data') or {})
+    _check_group(c, rule['group_id'])
+    c.execute(f"INSERT INTO rules ({', '.join(RULE_FIELDS)}) VALUES ({', '.join('?' * len(RULE_FIELDS))})",
+              [rule[field] for field in RULE_FIELDS])
+    return {'rule': _fetch_row(c, 'rules', c.lastrowid)}
+
+def _op_update_rule(c, operation):
+    current = _require_row(c, 'rules', operation.get('id'), 'Rule')
+    rule = validate_rule_payload(operation.get('data') or {}, current)
+    _check_group(c, rule['group_id'])
+    c.execute(f"UPDATE rules SET {', '.join(f'{field}=?' for field in RULE_FIELDS)}, updated_at=CURRENT_TIMESTAMP "
+              "WHERE id=?", [rule[field] for field in RULE_FIELDS] + [current['id']])
+    return {'rule': _fetch_row(c, 'rules', current['id'])}
+
+def _op_toggle_rule(c, operation):
+    current = _require_row(c, 'rules', operation.get('id'), 'Rule')
+    c.execute("UPDATE rules SET enabled = NOT enabled, updated_at=CURRENT_TIMESTAMP WHERE id=?", (current['id'],))
+    return {'rule': _fetch_row(c, 'rules', current['id'])}
+
+def _op_delete_rule(c, operation):
+    current = _require_row(c, 'rules', operation.get('id'), 'Rule')
+    c.execute("DELETE FROM rules WHERE id=?", (current['id'],))
+    return {'id': current['id']}
+
+def _op_create_group(c, operation):
+    group = validate_group_payload(operation.get('data') or {})
+    c.execute(f"INSERT INTO rule_groups ({', '.join(GROUP_FIELDS)}) VALUES ({', '.join('?' * len(GROUP_FIELDS))})",
+              [group[field] for field in GROUP_FIELDS])
+    return {'group': _fetch_row(c, 'rule_groups', c.lastrowid)}
+
+def _op_update_group(c, operation):
+    current = _require_row(c, 'rule_groups', operation.get('id'), 'Group')
+    group = validate_group_payload(operation.get('data') or {}, current)
+    c.execute(f"UPDATE rule_groups SET {', '.join(f'{field}=?' for field in GROUP_FIELDS)} WHERE id=?",
+              [group[field] for field in GROUP_FIELDS] + [current['id']])
+    return {'group': _fetch_row(c, 'rule_groups', current['id'])}
+
+def _op_delete_group(c, operation):
+    current = _require_row(c, 'rule_groups', operation.get('id'), 'Group')
+    c.execute("SELECT COUNT(*) FROM rules WHERE group_id=?", (current['id'],))
+    if c.fetchone()[0]:
+        raise ApiError("Cannot delete group with associated rules", 409)
+    c.execute("DELETE FROM rule_groups WHERE id=?", (current['id'],))
+    return {'id': current['id']}
+
+API_OPERATIONS = {
+    'create_rule': _op_create_rule,
+    'update_rule': _op_update_rule,
+    'toggle_rule': _op_toggle_rule,
+    'delete_rule': _op_delete_rule,
+    'create_group': _op_create_group,
+    'update_group': _op_update_group,
+    'delete_group': _op_delete_group,
+}
+
+def run_api_operations(c, operations):
+    """Jalankan operasi berurutan pada transaksi yang sudah dibuka; kembalikan (hasil, kegagalan)
+
+    Kegagalan berupa (indeks, op, ApiError) untuk operasi pertama yang gagal; operasi sesudahnya
+    tidak dijalankan dan pemanggil yang menentukan commit atau rollback.
+    """
+    results = []
+    for index, operation in enumerate(operations):
+        op = operation.get('op') if isinstance(operation, dict) else None
+        try:
+            if op not in API_OPERATIONS:
+                raise ApiError(f"Unknown operation: {op}")
+            result = API_OPERATIONS[op](c, operation)
+        except ApiError as e:
+            return results, (index, op, e)
+        except sqlite3.IntegrityError as e:
+            return results, (index, op, ApiError(f"Constraint violation: {e}", 409))
+        results.append(dict(result, index=index, op=op, status='ok'))
+    return results, None
+
+def execute_api_batch(operations, apply=True):
+    """Jalankan operasi secara atomik dalam satu transaksi lalu terapkan ruleset sekali
+
+    Mengembalikan (status HTTP, body JSON). Jika satu operasi gagal seluruh transaksi di-rollback
+    dan hasil per operasi menandai operasi yang gagal, yang dibatalkan, dan yang dilewati.
+    """
+    if not isinstance(operations, list) or not operations:
+        return 400, {'success': False, 'message': "operations must be a non-empty list"}
+    if len(operations) > API_BATCH_MAX:
+        return 400, {'success': False, 'message': f"A batch may contain at most {API_BATCH_MAX} operations"}
+    with changeset_lock:
+        blocked = pending_changeset_message()
+        if blocked:
+            return 409, {'success': False, 'message': blocked, 'results': []}
+        conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            results, failure = run_api_operations(c, operations)
+            if failure:
+                conn.rollback()
+            else:
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    
+    if failure:
+        index, op, error = failure
+        results = [dict(index=r['index'], op=r['op'], status='rolled_back') for r in results]
+        results.append({'index': index, 'op': op, 'status': 'error', 'message': str(error)})
+        results.extend({'index': i, 'op': o.get('op') if isinstance(o, dict) else None, 'status': 'skipped'}
+                       for i, o in enumerate(operations[index + 1:], start=index + 1))
+        logging.warning(f"API batch rolled back at operation {index} ({op}): {error}")
+        return error.status, {'success': False, 'message': f"Operation {index} failed: {error}",
+                              'results': results}
+    
+    bump_generation('db')
+    logging.info(f"API batch committed {len(results)} operations")
+    body = {'success': True, 'results': results, 'applied': False, 'apply_message': "Apply skipped"}
+    if apply:
+        body['applied'], body['apply_message'] = save_rules()
+    return 200, body
+
+# Changeset: perubahan aturan dan grup dikumpulkan di staging, ditinjau lewat diff hasil kompilasi,
+# lalu diterapkan dalam satu transaksi database dan satu load nft
+CHANGESET_CONFIRM_TIMEOUTS = (0, 60, 120, 300, 600)  # pilihan timer auto-rollback (detik, 0 = tanpa konfirmasi)
+CHANGESET_HISTORY = 20  # changeset terakhir yang ditampilkan
+CHANGESET_DIFF_CONTEXT = 3  # baris konteks di diff preview
+
+changeset_lock = threading.Lock()
+_confirm_timer = None
+
+def _changeset_query(where, params=(), limit=None):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT cs.*, u.username, (SELECT COUNT(*) FROM changeset_operations o WHERE o.changeset_id = cs.id) AS operation_count
+        FROM changesets cs LEFT JOIN users u ON cs.user_id = u.id
+        WHERE {where} ORDER BY cs.id DESC {f'LIMIT {int(limit)}' if limit else ''}
+    """, params)
+    rows = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return rows
+
+def get_changeset(changeset_id):
+    rows = _changeset_query("cs.id = ?", (changeset_id,))
+    return rows[0] if rows else None
+
+def get_open_changeset():
+    """Changeset draft yang sedang dibuka (paling banyak satu)"""
+    rows = _changeset_query("cs.status = 'draft'", limit=1)
+    return rows[0] if rows else None
+
+def get_pending_changeset():
+    """Changeset yang sudah diterapkan dan menunggu konfirmasi"""
+    rows = _changeset_query("cs.status = 'pending'", limit=1)
+    return rows[0] if rows else None
+
+def pending_changeset_message():
+    """Pesan penolakan penulisan langsung aturan/grup selama ada changeset yang menunggu konfirmasi
+
+    Rollback memulihkan salinan tabel dari sebelum commit, sehingga perubahan langsung di antaranya
+    akan hilang tanpa jejak. Pemanggil memegang changeset_lock sampai penulisannya di-commit agar
+    tidak ada commit changeset yang menyelip di antara pemeriksaan dan penulisan.
+    """
+    pending = get_pending_changeset()
+    if pending:
+        return (f'Changeset "{pending["name"]}" is waiting for confirmation; '
+                f'confirm or roll it back before changing rules or groups')
+    return None
+
+def rule_writes_blocked():
+    """Pemeriksaan cepat untuk form; menunggu changeset_lock agar commit yang sedang berjalan ikut terlihat"""
+    with changeset_lock:
+        return pending_changeset_message()
+
+def get_changesets(limit=CHANGESET_HISTORY):
+    return _changeset_query("1", limit=limit)
+
+def get_changeset_operations(changeset_id):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("SELECT * FROM changeset_operations WHERE changeset_id = ? ORDER BY id", (changeset_id,))
+    rows = [dict(row, operation=json.loads(row['operation'])) for row in c.fetchall()]
+    conn.close()
+    return rows
+
+def _update_changeset(changeset_id, **fields):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    c.execute(f"UPDATE changesets SET {', '.join(f'{name}=?' for name in fields)} WHERE id=?",
+              list(fields.values()) + [changeset_id])
+    conn.commit()
+    conn.close()
+    bump_generation('db')
+
+def create_changeset(name, user_id=None):
+    """Buka changeset draft baru; ApiError jika masih ada draft lain"""
+    with changeset_lock:
+        if get_open_changeset():
+            raise ApiError("Another changeset is already open", 409)
+        conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+        c = conn.cursor()
+        c.execute("INSERT INTO changesets (name, user_id) VALUES (?, ?)",
+                  (name or datetime.now().strftime('Changes %Y-%m-%d %H:%M'), user_id))
+        conn.commit()
+        changeset_id = c.lastrowid
+        conn.close()
+    bump_generation('db')
+    logging.info(f"Opened changeset {changeset_id}")
+    return changeset_id
+
+def stage_operation(changeset_id, operation, summary=None):
+    """Tambahkan satu operasi (format batch API) ke changeset draft
+
+    Payload divalidasi terhadap database saat ini; konflik antar operasi baru terlihat di preview.
+    """
+    op = operation.get('op') if isinstance(operation, dict) else None
+    if op not in API_OPERATIONS:
+        raise ApiError(f"Unknown operation: {op}")
+    validate = validate_rule_payload if op.endswith('_rule') else validate_group_payload
+    if op.startswith('create_'):
+        validate(operation.get('data') or {})
+    else:
+        conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+        conn.row_factory = sqlite3.Row
+        try:
+            current = _require_row(conn.cursor(), 'rules' if op.endswith('_rule') else 'rule_groups',
+                                   operation.get('id'), 'Rule' if op.endswith('_rule') else 'Group')
+        finally:
+            conn.close()
+        if op.startswith('update_'):
+            validate(operation.get('data') or {}, current)
+    with changeset_lock:
+        changeset = get_changeset(changeset_id)
+        if changeset is None or changeset['status'] != 'draft':
+            raise ApiError("Changeset is not open", 409)
+        conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+        c = conn.cursor()
+        c.execute("INSERT INTO changeset_operations (changeset_id, operation, summary) VALUES (?, ?, ?)",
+                  (changeset_id, json.dumps(operation, default=str), summary or op))
+        conn.commit()
+        operation_id = c.lastrowid
+        conn.close()
+    bump_generation('db')
+    return operation_id
+
+def remove_staged_operation(changeset_id, operation_id):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    c.execute("""
+        DELETE FROM changeset_operations WHERE id = ? AND changeset_id IN
+            (SELECT id FROM changesets WHERE id = ? AND status = 'draft')
+    """, (operation_id, changeset_id))
+    removed = c.rowcount
+    conn.commit()
+    conn.close()
+    if removed:
+        bump_generation('db')
+    return removed > 0
+
+def discard_changeset(changeset_id):
+    with changeset_lock:
+        changeset = get_changeset(changeset_id)
+        if changeset is None or changeset['status'] != 'draft':
+            return False
+        _update_changeset(changeset_id, status='discarded', message="Discarded without applying")
+    logging.info(f"Discarded changeset {changeset_id}")
+    return True
+
+def staged_rules(operations):
+    """Aturan hasil operasi staging, dihitung dalam transaksi yang selalu di-rollback"""
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN")
+        _, failure = run_api_operations(c, operations)
+        if failure:
+            index, op, error = failure
+            raise ApiError(f"Staged operation {index + 1} ({op}) fails: {error}", error.status)
+        # Aturan yang expired dinonaktifkan seperti yang akan dilakukan get_rules()
+        c.execute("""
+            UPDATE rules SET enabled = 0
+            WHERE expired_at IS NOT NULL AND datetime(expired_at) <= datetime(?) AND enabled = 1
+        """, (datetime.now().isoformat(),))
+        c.execute("""
+            SELECT r.*, g.name as group_name, g.color as group_color, g.target_tags as group_target_tags 
+            FROM rules r 
+            LEFT JOIN rule_groups g ON r.group_id = g.id 
+            ORDER BY g.name, r.name
+        """)
+        return [dict(row) for row in c.fetchall()]
+    finally:
+        conn.rollback()
+        conn.close()
+
+def ruleset_lines(compiled):
+    """Baris ringkas set dan chain hasil kompilasi untuk diff preview"""
+    lines = []
+    for definition in compiled['sets']:
+        options = f"type {definition['type']}; flags {definition['flags']};"
+        if definition['timeout']:
+            options += f" timeout {definition['timeout']};"
+        lines.append(f"set {definition['name']} {{ {options} }}")
+    for chain_name, policy in BASE_CHAINS:
+        lines.append(f"chain {chain_name} policy {policy}")
+        lines.extend(f"    {entry['statement']}" for entry in compiled['chains'][chain_name])
+    return lines
+
+def preview_changeset(changeset_id):
+    """Diff ruleset hasil kompilasi saat ini terhadap ruleset setelah changeset diterapkan"""
+    operations = [item['operation'] for item in get_changeset_operations(changeset_id)]
+    live = compile_ruleset(get_rules())
+    staged = compile_ruleset(staged_rules(operations))
+    diff = list(difflib.unified_diff(ruleset_lines(live), ruleset_lines(staged), 'live', 'staged',
+                                     n=CHANGESET_DIFF_CONTEXT, lineterm=''))
+    return {
+        'diff': diff,
+        'added': sum(1 for line in diff if line.startswith('+') and not line.startswith('+++')),
+        'removed': sum(1 for line in diff if line.startswith('-') and not line.startswith('---')),
+        'entries_live': live['compaction']['entries_after'],
+        'entries_staged': staged['compaction']['entries_after'],
+        'staged_hash': hash_ruleset(normalize_compiled(staged)),
+    }
+
+def snapshot_rule_tables(c):
+    """Salinan lengkap tabel rules dan rule_groups untuk rollback"""
+    snapshot = {}
+    for table in ('rules', 'rule_groups'):
+        c.execute(f"SELECT * FROM {table}")
+        columns = [column[0] for column in c.description]
+        snapshot[table] = {'columns': columns, 'rows': [list(row) for row in c.fetchall()]}
+    return snapshot
+
+def restore_rule_tables(snapshot):
+    """Kembalikan tabel rules dan rule_groups ke snapshot dalam satu transaksi"""
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        for table in ('rules', 'rule_groups'):
+            columns = snapshot[table]['columns']
+            c.execute(f"DELETE FROM {table}")
+            c.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                          snapshot[table]['rows'])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    bump_generation('db')
+
+def commit_changeset(changeset_id, confirm_timeout=0):
+    """Terapkan semua operasi changeset dalam satu transaksi database dan satu load nft
+
+    Dengan confirm_timeout, ruleset sebelumnya dipulihkan otomatis jika changeset tidak
+    dikonfirmasi dalam batas waktu (mencegah terkunci dari SSH). Mengembalikan (sukses, pesan).
+    """
+    with changeset_lock:
+        changeset = get_changeset(changeset_id)
+        if changeset is None or changeset['status'] != 'draft':
+            return False, "Changeset is not open"
+        if get_pending_changeset():
+            return False, "Another changeset is still waiting for confirmation"
+        operations = [item['operation'] for item in get_changeset_operations(changeset_id)]
+        if not operations:
+            return False, "Changeset has no staged changes"
+        conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            snapshot = snapshot_rule_tables(c)
+            _, failure = run_api_operations(c, operations)
+            if failure:
+                conn.rollback()
+            else:
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if failure:
+            index, op, error = failure
+            return False, f"Staged operation {index + 1} ({op}) failed, nothing was applied: {error}"
+        bump_generation('db')
+        committed_at = datetime.now().isoformat()
+        success, message = save_rules()
+        if not success:
+            # Ruleset baru ditolak: kembalikan database dan ruleset sebelumnya segera
+            restore_rule_tables(snapshot)
+            save_rules()
+            _update_changeset(changeset_id, status='failed', committed_at=committed_at, message=message)
+            logging.error(f"Changeset {changeset_id} failed to apply and was reverted: {message}")
+            return False, f"Apply failed, previous ruleset restored: {message}"
+        if confirm_timeout:
+            _update_changeset(changeset_id, status='pending', committed_at=committed_at, message=message,
+                              snapshot=json.dumps(snapshot, default=str),
+                              confirm_deadline=time.time() + confirm_timeout)
+            arm_confirm_timer(changeset_id, confirm_timeout)
+            logging.info(f"Applied changeset {changeset_id} ({len(operations)} operations), "
+                         f"awaiting confirmation within {confirm_timeout}s")
+            return True, f"Changeset applied. Confirm within {confirm_timeout} seconds or it is rolled back."
+        _update_changeset(changeset_id, status='committed', committed_at=committed_at, message=message)
+    logging.info(f"Applied changeset {changeset_id} ({len(operations)} operations)")
+    return True, f"Changeset applied: {message}"
+
+def arm_confirm_timer(changeset_id, delay):
+    """Jadwalkan rollback otomatis jika changeset tidak dikonfirmasi"""
+    global _confirm_timer
+    if _confirm_timer is not None:
+        _confirm_timer.cancel()
+    _confirm_timer = threading.Timer(max(0, delay), rollback_changeset, args=(changeset_id,),
+                                     kwargs={'reason': "Confirmation timeout"})
+    _confirm_timer.daemon = True
+    _confirm_timer.start()
+
+def confirm_changeset(changeset_id):
+    """Konfirmasi changeset yang menunggu; snapshot rollback dibuang"""
+    global _confirm_timer
+    with changeset_lock:
+        changeset = get_changeset(changeset_id)
+        if changeset is None or changeset['status'] != 'pending':
+            return False
+        if _confirm_timer is not None:
+            _confirm_timer.cancel()
+            _confirm_timer = None
+        _update_changeset(changeset_id, status='committed', snapshot=None, confirm_deadline=None)
+    logging.info(f"Confirmed changeset {changeset_id}")
+    return True
+
+def rollback_changeset(changeset_id, reason="Rolled back manually"):
+    """Pulihkan aturan dan ruleset sebelum changeset yang belum dikonfirmasi"""
+    with changeset_lock:
+        changeset = get_changeset(changeset_id)
+        if changeset is None or changeset['status'] != 'pending':
+            return False, "Changeset is not waiting for confirmation"
+        # Penulisan langsung ditolak selama pending; aturan yang expired di antaranya dinonaktifkan
+        # lagi oleh snapshot aturan sebelum ruleset dikompilasi
+        restore_rule_tables(json.loads(changeset['snapshot']))
+        success, message = save_rules()
+        _update_changeset(changeset_id, status='rolled_back', snapshot=None, confirm_deadline=None,
+                          message=f"{reason}: {message}")
+    logging.warning(f"Rolled back changeset {changeset_id} ({reason}): {message}")
+    return success, message
+
+def resume_pending_changeset():
+    """Saat startup, lanjutkan timer konfirmasi; rollback langsung jika batas waktu sudah lewat"""
+    pending = get_pending_changeset()
+    if pending:
+        remaining = (pending['confirm_deadline'] or 0) - time.time()
+        logging.warning(f"Changeset {pending['id']} is awaiting confirmation ({max(0, int(remaining))}s left)")
+        arm_confirm_timer(pending['id'], remaining)
+
+# Preview restore: isi rules/rule_groups backup dibandingkan dengan database aktif per natural key
+RESTORE_GROUP_FIELDS = ('description', 'color', 'target_tags')
+RESTORE_RULE_FIELDS = ('group_name', 'chain', 'src', 'dst', 'dport', 'protocol', 'action', 'comment', 'enabled',
+                       'expired_at', 'target_tags', 'rule_type', 'limit_value', 'geo')
+
+def read_rule_tables(conn):
+    """Baca grup dan aturan dari koneksi mana pun (juga skema lama); aturan di-join ke grupnya"""
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute("SELECT * FROM rule_groups")
+    groups = [dict(dict.fromkeys(('id',) + GROUP_FIELDS), **dict(row)) for row in c.fetchall()]
+    by_id = {group['id']: group for group in groups}
+    c.execute("SELECT * FROM rules")
+    rules = []
+    now = datetime.now()
+    for row in c.fetchall():
+        rule = dict(dict.fromkeys(('id',) + RULE_FIELDS), **dict(row))
+        group = by_id.get(rule['group_id'])
+        rule['group_name'] = group['name'] if group else None
+        rule['group_color'] = group['color'] if group else None
+        rule['group_target_tags'] = group['target_tags'] if group else None
+        rule['enabled'] = bool(rule['enabled'])
+        # Aturan yang sudah expired akan dinonaktifkan get_rules() setelah restore
+        if rule['enabled'] and rule['expired_at']:
+            try:
+                rule['enabled'] = datetime.fromisoformat(str(rule['expired_at'])) > now
+            except ValueError:
+                pass
+        rules.append(rule)
+    # Urutan sama dengan get_rules(): nama grup (tanpa grup lebih dulu), lalu nama aturan
+    rules.sort(key=lambda r: (r['group_name'] is not None, r['group_name'] or '', r['name'] or ''))
+    return groups, rules
+
+def rule_natural_keys(rules):
+    """Natural key aturan: (grup, nama, chain, urutan) — urutan membedakan aturan kembar"""
+    seen = {}
+    keyed = {}
+    for rule in sorted(rules, key=lambda r: r['id']):
+        base = (rule['group_name'] or '', rule['name'] or '', (rule['chain'] or '').lower())
+        seen[base] = seen.get(base, 0) + 1
+        keyed[json.dumps(list(base) + [seen[base]])] = rule
+    return keyed
+
+def _diff_records(live, backup, fields):
+    diff = {'added': [], 'removed': [], 'changed': []}
+    for key in sorted(set(live) | set(backup)):
+        if key not in live:
+            diff['added'].append({'key': key, 'backup': backup[key]})
+        elif key not in backup:
+            diff['removed'].append({'key': key, 'live': live[key]})
+        else:
+            changes = [{'field': field, 'live': live[key].get(field), 'backup': backup[key].get(field)}
+                       for field in fields
+                       if _clean(live[key].get(field)) != _clean(backup[key].get(field))]
+            if changes:
+                diff['changed'].append({'key': key, 'live': live[key], 'backup': backup[key], 'fields': changes})
+    return diff
+
+def open_backup_database(backup_path):
+    """Buka firewall.db dari backup secara read-only"""
+    path = os.path.join(backup_path, "firewall.db")
+    if not os.path.isfile(path):
+        raise FileNotFoundError("Backup has no firewall.db")
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+def preview_restore(backup_path):
+    """Diff grup, aturan dan ruleset hasil kompilasi antara database aktif dan backup"""
+    conn = open_backup_database(backup_path)
+    try:
+        backup_groups, backup_rules = read_rule_tables(conn)
+        schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    try:
+        live_groups, live_rules = read_rule_tables(conn)
+    finally:
+        conn.close()
+    groups = _diff_records({g['name']: g for g in live_groups}, {g['name']: g for g in backup_groups},
+                           RESTORE_GROUP_FIELDS)
+    rules = _diff_records(rule_natural_keys(live_rules), rule_natural_keys(backup_rules), RESTORE_RULE_FIELDS)
+    live = compile_ruleset(live_rules)
+    restored = compile_ruleset(backup_rules)
+    diff = list(difflib.unified_diff(ruleset_lines(live), ruleset_lines(restored), 'live', 'backup',
+                                     n=CHANGESET_DIFF_CONTEXT, lineterm=''))
+    return {
+        'groups': groups,
+        'rules': rules,
+        'diff': diff,
+        'schema_version': schema_version,
+        'unchanged': not diff and not any(groups.values()) and not any(rules.values()),
+    }
+
+def _restore_rule_data(rule, group_ids):
+    data = {field: rule.get(field) for field in RULE_FIELDS}
+    data['group_id'] = group_ids.get(rule['group_name'])
+    data['enabled'] = bool(rule['enabled'])
+    data['expired_at'] = str(rule['expired_at']) if rule['expired_at'] else None
+    return data
+
+def restore_selection(backup_path, group_names=(), rule_keys=()):
+    """Pulihkan grup dan/atau aturan terpilih dari backup lewat operasi API dan apply inkremental
+
+    Grup terpilih dipulihkan beserta seluruh aturannya (aturan di grup itu yang tidak ada di backup
+    dihapus). Grup yang dibutuhkan aturan terpilih tetapi belum ada dibuat dari backup.
+    Mengembalikan (sukses, pesan).
+    """
+    conn = open_backup_database(backup_path)
+    try:
+        backup_groups, backup_rules = read_rule_tables(conn)
+    finally:
+        conn.close()
+    backup_groups = {group['name']: group for group in backup_groups}
+    backup_keyed = rule_natural_keys(backup_rules)
+    group_names = [name for name in group_names if name in backup_groups]
+    rule_keys = set(rule_keys)
+    # Baris yang dipulihkan akan terhapus oleh rollback changeset yang sedang menunggu konfirmasi
+    with changeset_lock:
+        blocked = pending_changeset_message()
+        if blocked:
+            return False, blocked
+        backup_success, backup_message = backup_config()
+        if not backup_success:
+            logging.warning(f"Backup before selective restore failed: {backup_message}")
+        conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+        conn.row_factory = sqlite3.Row
         try:
-            with open(RULES_FILE, "w") as f:
-                f.write(config)
-            os.chmod(RULES_FILE, 0o640)
-            logging.info(f"Rules saved to {RULES_FILE}")
-            success, message = reload_nft()
-            if not success:
-                return False, message
-            return True, "Rules saved successfully"
-        except Exception as e:
-            logging.error(f"Error saving rules: {e}")
-    except Exception as e:
-        logging.error(f"Unexpected error in save_rules: {e}")
-        return False, f"Unexpected error: {e}"
-    
+            c = conn.cursor()
+            c.execute("BEGIN IMMEDIATE")
+            live_groups, live_rules = read_rule_tables(conn)
+            live_keyed = rule_natural_keys(live_rules)
+            live_groups = {group['name']: group for group in live_groups}
+            selected = {key for key, rule in list(backup_keyed.items()) + list(live_keyed.items())
+                        if key in rule_keys or rule['group_name'] in group_names}
+            needed = set(group_names) | {backup_keyed[key]['group_name'] for key in selected
+                                         if key in backup_keyed and backup_keyed[key]['group_name']}
+            group_ops = []
+            for name in sorted(needed):
+                data = {field: backup_groups[name].get(field) for field in GROUP_FIELDS}
+                if name not in live_groups:
+                    group_ops.append({'op': 'create_group', 'data': data})
+                elif name in group_names:
+                    group_ops.append({'op': 'update_group', 'id': live_groups[name]['id'], 'data': data})
+            results, failure = run_api_operations(c, group_ops)
+            if not failure:
+                c.execute("SELECT name, id FROM rule_groups")
+                group_ids = {name: group_id for name, group_id in c.fetchall()}
+                rule_ops = []
+                for key in sorted(selected):
+                    if key not in backup_keyed:
+                        rule_ops.append({'op': 'delete_rule', 'id': live_keyed[key]['id']})
+                    elif key not in live_keyed:
+                        rule_ops.append({'op': 'create_rule',
+                                         'data': _restore_rule_data(backup_keyed[key], group_ids)})
+                    else:
+                        rule_ops.append({'op': 'update_rule', 'id': live_keyed[key]['id'],
+                                         'data': _restore_rule_data(backup_keyed[key], group_ids)})
+                rule_results, failure = run_api_operations(c, rule_ops)
+                results += rule_results
+            if failure:
+                conn.rollback()
+                index, op, error = failure
+                return False, f"Selective restore failed at {op}: {error}"
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+    if not results:
+        return False, "Nothing selected to restore"
+    bump_generation('db')
+    logging.info(f"Selective restore from {os.path.basename(backup_path)}: {len(results)} operations "
+                 f"({len(group_names)} groups, {len(rule_keys)} rules selected)")
+    success, message = apply_incremental()
+    return success, f"Restored {len(results)} changes from {os.path.basename(backup_path)}: {message}"
+
+def apply_incremental():
+    """Terapkan database ke file aturan dan kernel lewat resync terarah, tanpa restart service"""
+    success, message = resync_drift('files')
+    if not success:
+        return False, message
+    success, message = resync_drift('kernel')
+    if not success:
+        # Resync terarah gagal (mis. set baru dibutuhkan): kembali ke apply penuh
+        logging.warning(f"Incremental apply failed, falling back to full apply: {message}")
+        return save_rules()
+    set_app_state('applied_hash', hash_ruleset(get_expected_ruleset()[1]))
+    return True, message
+
 # Autentikasi
 def login_required(f):
     def decorated_function(*args, **kwargs):
@@ -966,6 +6083,55 @@ def login_required(f):
     decorated_function.__name__ = f.__name__
     return decorated_function
 
+def api_token_required(f):
+    @functools.wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = authenticate_api_token(request.headers.get('Authorization', ''))
+        if token is None:
+            return jsonify({'success': False, 'message': 'Invalid or missing API token'}), 401
+        g.api_token = token
+        return f(*args, **kwargs)
+    return decorated_function
+
+# Request id untuk korelasi log di seluruh pipeline apply
+@app.before_request
+def assign_request_id():
+    request_id = request.headers.get('X-Request-ID', '')
+    if not re.fullmatch(r'[A-Za-z0-9._-]{1,64}', request_id):
+        request_id = new_request_id()
+    g.request_id_token = request_id_var.set(request_id)
+
+@app.teardown_request
+def clear_request_id(exc):
+    token = g.pop('request_id_token', None)
+    if token is not None:
+        request_id_var.reset(token)
+
+# Latensi request per route untuk /metrics
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        observe('nftm_http_request_duration_seconds', time.perf_counter() - started,
+                route=endpoint, method=request.method)
+        inc_counter('nftm_http_requests_total', route=endpoint, method=request.method,
+                    status=str(response.status_code))
+    if request_id_var.get():
+        response.headers['X-Request-ID'] = request_id_var.get()
+    return response
+
+# Banner changeset (draft terbuka / menunggu konfirmasi) di semua halaman
+@app.context_processor
+def inject_changeset_state():
+    if 'user_id' not in session:
+        return {}
+    return {'open_changeset': get_open_changeset(), 'pending_changeset': get_pending_changeset()}
+
 # Routes
 @app.route('/')
 def index():
@@ -979,7 +6145,7 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
-        conn = sqlite3.connect(DB_FILE)
+        conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
         c = conn.cursor()
         c.execute("SELECT * FROM users WHERE username=?", (username,))
         user = c.fetchone()
@@ -1034,18 +6200,67 @@ def change_password_route():
 
 @app.route('/dashboard')
 @login_required
+@profiled('dashboard')
+@conditional_view('db')
 def dashboard():
     group_id = request.args.get('group_id', type=int)
-    rules = get_rules(group_id)
-    groups = get_groups()
-    selected_group = get_group(group_id) if group_id else None
+    page = max(request.args.get('page', 1, type=int), 1)
+    # Fragmen filter grup dan tabel aturan di-cache per versi aturan/grup (snapshot sudah menangani expiry)
+    token = rule_snapshot().token
+    group_filter = get_cached_fragment('group_filter', (token, group_id))
+    rule_table = get_cached_fragment('rule_table', (token, group_id, page))
+    
+    if rule_table is None:
+        rules = get_rules(group_id)
+        token = rule_snapshot().token
+        total_pages = max((len(rules) + RULES_PER_PAGE - 1) // RULES_PER_PAGE, 1)
+        page = min(page, total_pages)
+        selected_group = get_group(group_id) if group_id else None
+        rule_table = render_fragment('rule_table', (token, group_id, page), '_rule_table.html',
+                                     rules=rules[(page - 1) * RULES_PER_PAGE:page * RULES_PER_PAGE],
+                                     total_rules=len(rules),
+                                     selected_group=selected_group,
+                                     page=page,
+                                     total_pages=total_pages,
+                                     group_id=group_id)
+    if group_filter is None:
+        groups = get_groups()
+        group_filter = render_fragment('group_filter', (token, group_id), '_group_filter.html',
+                                       groups=groups, group_id=group_id)
     
     return render_template('dashboard.html', 
-                          rules=rules, 
-                          groups=groups, 
-                          selected_group=selected_group,
+                          group_filter=group_filter,
+                          rule_table=rule_table,
                           datetime=datetime)
 
+def form_rule_data(name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at,
+                   target_tags, rule_type, limit_value, geo):
+    """Payload operasi aturan (format batch API) dari field form"""
+    return {
+        'name': name, 'group_id': group_id, 'chain': chain, 'src': src, 'dst': dst, 'dport': dport,
+        'protocol': protocol, 'action': action, 'comment': comment, 'enabled': enabled,
+        'expired_at': expired_at.isoformat() if expired_at else None, 'target_tags': target_tags,
+        'rule_type': rule_type, 'limit_value': limit_value, 'geo': geo,
+    }
+
+def stage_form_change(changeset, operation, summary):
+    """Simpan perubahan dari form ke changeset draft alih-alih menerapkannya langsung"""
+    try:
+        stage_operation(changeset['id'], operation, summary)
+    except ApiError as e:
+        flash(f'Change could not be staged: {e}', 'danger')
+        return redirect(request.referrer or url_for('dashboard'))
+    flash(f'Staged in changeset "{changeset["name"]}": {summary}', 'info')
+    return redirect(url_for('changes'))
+
+def pending_changeset_redirect():
+    """Redirect ke halaman Changes jika penulisan langsung ditolak karena changeset menunggu konfirmasi"""
+    blocked = rule_writes_blocked()
+    if blocked:
+        flash(blocked, 'warning')
+        return redirect(url_for('changes'))
+    return None
+
 @app.route('/add_rule', methods=['GET', 'POST'])
 @login_required
 def add_rule_route():
@@ -1061,6 +6276,8 @@ def add_rule_route():
         protocol = request.form['protocol']
         action = request.form['action']
         comment = request.form['comment']
+        target_tags = request.form.get('target_tags', '')
+        rule_type = request.form.get('rule_type', 'static')
         enabled = 'enabled' in request.form
         
         expired_at = None
@@ -1082,9 +6299,28 @@ def add_rule_route():
             return render_template('add_rule.html', groups=groups, 
                                   form_data=request.form, datetime=datetime)
         
+        limit_value, error = validate_rule_limit(rule_type, request.form.get('limit_value'), action, protocol)
+        geo, geo_error = validate_rule_geo(request.form.get('geo'), chain, src, dst)
+        error = error or geo_error or validate_rule_families(src, dst, protocol)
+        if error:
+            flash(error, 'danger')
+            return render_template('add_rule.html', groups=groups, 
+                                  form_data=request.form, datetime=datetime)
+        
+        changeset = get_open_changeset()
+        if changeset:
+            return stage_form_change(changeset, {'op': 'create_rule', 'data': form_rule_data(
+                name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at,
+                target_tags, rule_type, limit_value, geo)}, f"Add rule {name}")
+        
+        blocked = pending_changeset_redirect()
+        if blocked:
+            return blocked
+        
         try:
-            rule_id = add_rule_to_db(name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at)
-            logging.info(f"Added rule {name} (ID: {rule_id}) to database")
+            rule_id = add_rule_to_db(name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at,
+                                     target_tags, rule_type, limit_value, geo)
+            logging.info(f"Added rule {name} (ID: {rule_id}) to database", extra={'rule_id': rule_id})
             
             success, message = save_rules()
             
@@ -1121,6 +6357,8 @@ def edit_rule(rule_id):
         protocol = request.form['protocol']
         action = request.form['action']
         comment = request.form['comment']
+        target_tags = request.form.get('target_tags', '')
+        rule_type = request.form.get('rule_type', 'static')
         enabled = 'enabled' in request.form
         
         expired_at = None
@@ -1142,9 +6380,28 @@ def edit_rule(rule_id):
             return render_template('edit_rule.html', rule=rule_dict, groups=groups, 
                                   form_data=request.form, datetime=datetime)
         
+        limit_value, error = validate_rule_limit(rule_type, request.form.get('limit_value'), action, protocol)
+        geo, geo_error = validate_rule_geo(request.form.get('geo'), chain, src, dst)
+        error = error or geo_error or validate_rule_families(src, dst, protocol)
+        if error:
+            flash(error, 'danger')
+            return render_template('edit_rule.html', rule=rule_dict, groups=groups, 
+                                  form_data=request.form, datetime=datetime)
+        
+        changeset = get_open_changeset()
+        if changeset:
+            return stage_form_change(changeset, {'op': 'update_rule', 'id': rule_id, 'data': form_rule_data(
+                name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at,
+                target_tags, rule_type, limit_value, geo)}, f"Edit rule {name}")
+        
+        blocked = pending_changeset_redirect()
+        if blocked:
+            return blocked
+        
         try:
-            update_rule_in_db(rule_id, name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at)
-            logging.info(f"Updated rule {name} (ID: {rule_id}) in database")
+            update_rule_in_db(rule_id, name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at,
+                              target_tags, rule_type, limit_value, geo)
+            logging.info(f"Updated rule {name} (ID: {rule_id}) in database", extra={'rule_id': rule_id})
             
             success, message = save_rules()
             
@@ -1180,9 +6437,15 @@ def edit_rule(rule_id):
 @app.route('/delete/<int:rule_id>')
 @login_required
 def delete_rule_route(rule_id):
+    changeset = get_open_changeset()
+    if changeset:
+        return stage_form_change(changeset, {'op': 'delete_rule', 'id': rule_id}, f"Delete rule #{rule_id}")
+    blocked = pending_changeset_redirect()
+    if blocked:
+        return blocked
     try:
         delete_rule_from_db(rule_id)
-        logging.info(f"Deleted rule ID: {rule_id} from database")
+        logging.info(f"Deleted rule ID: {rule_id} from database", extra={'rule_id': rule_id})
         
         success, message = save_rules()
         
@@ -1199,9 +6462,15 @@ def delete_rule_route(rule_id):
 @app.route('/toggle/<int:rule_id>')
 @login_required
 def toggle_rule_route(rule_id):
+    changeset = get_open_changeset()
+    if changeset:
+        return stage_form_change(changeset, {'op': 'toggle_rule', 'id': rule_id}, f"Toggle rule #{rule_id}")
+    blocked = pending_changeset_redirect()
+    if blocked:
+        return blocked
     try:
         toggle_rule_in_db(rule_id)
-        logging.info(f"Toggled rule ID: {rule_id} in database")
+        logging.info(f"Toggled rule ID: {rule_id} in database", extra={'rule_id': rule_id})
         
         success, message = save_rules()
         
@@ -1217,6 +6486,7 @@ def toggle_rule_route(rule_id):
 
 @app.route('/groups')
 @login_required
+@conditional_view('db')
 def manage_groups():
     groups = get_groups()
     return render_template('groups.html', groups=groups)
@@ -1228,13 +6498,25 @@ def add_group():
         name = request.form['name']
         description = request.form['description']
         color = request.form['color']
+        target_tags = normalize_tags(request.form.get('target_tags', ''))
+        
+        changeset = get_open_changeset()
+        if changeset:
+            return stage_form_change(changeset, {'op': 'create_group', 'data': {
+                'name': name, 'description': description, 'color': color, 'target_tags': target_tags,
+            }}, f"Add group {name}")
         
-        conn = sqlite3.connect(DB_FILE)
+        blocked = pending_changeset_redirect()
+        if blocked:
+            return blocked
+        
+        conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
         c = conn.cursor()
         try:
-            c.execute("INSERT INTO rule_groups (name, description, color) VALUES (?, ?, ?)",
-                     (name, description, color))
+            c.execute("INSERT INTO rule_groups (name, description, color, target_tags) VALUES (?, ?, ?, ?)",
+                     (name, description, color, target_tags))
             conn.commit()
+            bump_generation('db')
             flash('Group added successfully!', 'success')
             logging.info(f"Added group: {name}")
             return redirect(url_for('manage_groups'))
@@ -1257,15 +6539,27 @@ def edit_group(group_id):
         name = request.form['name']
         description = request.form['description']
         color = request.form['color']
+        target_tags = normalize_tags(request.form.get('target_tags', ''))
         
-        conn = sqlite3.connect(DB_FILE)
+        changeset = get_open_changeset()
+        if changeset:
+            return stage_form_change(changeset, {'op': 'update_group', 'id': group_id, 'data': {
+                'name': name, 'description': description, 'color': color, 'target_tags': target_tags,
+            }}, f"Edit group {name}")
+        
+        blocked = pending_changeset_redirect()
+        if blocked:
+            return blocked
+        
+        conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
         c = conn.cursor()
         try:
             c.execute("""
-                UPDATE rule_groups SET name=?, description=?, color=? 
+                UPDATE rule_groups SET name=?, description=?, color=?, target_tags=? 
                 WHERE id=?
-            """, (name, description, color, group_id))
+            """, (name, description, color, target_tags, group_id))
             conn.commit()
+            bump_generation('db')
             flash('Group updated successfully!', 'success')
             logging.info(f"Updated group: {name}")
             return redirect(url_for('manage_groups'))
@@ -1279,7 +6573,13 @@ def edit_group(group_id):
 @app.route('/delete_group/<int:group_id>')
 @login_required
 def delete_group(group_id):
-    conn = sqlite3.connect(DB_FILE)
+    changeset = get_open_changeset()
+    if changeset:
+        return stage_form_change(changeset, {'op': 'delete_group', 'id': group_id}, f"Delete group #{group_id}")
+    blocked = pending_changeset_redirect()
+    if blocked:
+        return blocked
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
     c = conn.cursor()
     c.execute("SELECT COUNT(*) FROM rules WHERE group_id=?", (group_id,))
     count = c.fetchone()[0]
@@ -1288,10 +6588,11 @@ def delete_group(group_id):
     if count > 0:
         flash('Cannot delete group with associated rules!', 'danger')
     else:
-        conn = sqlite3.connect(DB_FILE)
+        conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
         c = conn.cursor()
         c.execute("DELETE FROM rule_groups WHERE id=?", (group_id,))
         conn.commit()
+        bump_generation('db')
         conn.close()
         flash('Group deleted successfully!', 'success')
         logging.info(f"Deleted group ID: {group_id}")
@@ -1300,9 +6601,10 @@ def delete_group(group_id):
 
 @app.route('/status')
 @login_required
+@conditional_view('ruleset')
 def status():
     try:
-        result = subprocess.run([NFT, 'list', 'ruleset'], 
+        result = run_command([NFT, 'list', 'ruleset'], 
                                 capture_output=True, text=True, check=True)
         return render_template('status.html', ruleset=result.stdout)
     except subprocess.CalledProcessError as e:
@@ -1311,26 +6613,35 @@ def status():
 
 @app.route('/config')
 @login_required
+@conditional_view('db')
 def config():
+    compiled = compile_ruleset(get_rules())
     return render_template('config.html', 
                           rules_file=RULES_FILE, 
                           nft_conf=NFT_CONF,
-                          backup_dir=BACKUP_DIR)
+                          backup_dir=BACKUP_DIR,
+                          compaction=compiled['compaction'],
+                          compact_enabled=COMPACT_RULES)
 
 @app.route('/backups')
 @login_required
+@conditional_view('backups')
 def backups():
     backup_list = get_backup_list()
-    return render_template('backups.html', backups=backup_list, backup_dir=BACKUP_DIR)
+    return render_template('backups.html', backups=backup_list, backup_dir=BACKUP_DIR, archive_formats=archive_formats())
 
 @app.route('/restore/<path:backup_name>')
 @login_required
+@profiled('restore_backup')
 def restore_backup(backup_name):
     backup_path = os.path.join(BACKUP_DIR, backup_name)
     
     if not os.path.exists(backup_path):
         flash('Backup directory not found!', 'danger')
         return redirect(url_for('backups'))
+    if get_pending_changeset():
+        flash('Confirm or roll back the pending changeset before restoring.', 'warning')
+        return redirect(url_for('backups'))
     
     success, message = restore_from_backup(backup_path)
     if success:
@@ -1341,6 +6652,43 @@ def restore_backup(backup_name):
     
     return redirect(url_for('backups'))
 
+@app.route('/restore/<backup_name>/preview')
+@login_required
+def restore_preview(backup_name):
+    backup_path = resolve_backup_path(backup_name)
+    if backup_path is None:
+        flash('Backup directory not found!', 'danger')
+        return redirect(url_for('backups'))
+    try:
+        preview = preview_restore(backup_path)
+    except (sqlite3.Error, OSError) as e:
+        logging.error(f"Restore preview of {backup_name} failed: {e}")
+        flash(f"Cannot read backup database: {e}", 'danger')
+        return redirect(url_for('backups'))
+    return render_template('restore_preview.html', backup_name=backup_name, preview=preview)
+
+@app.route('/restore/<backup_name>/selective', methods=['POST'])
+@login_required
+@profiled('restore_backup')
+def restore_selective(backup_name):
+    backup_path = resolve_backup_path(backup_name)
+    if backup_path is None:
+        flash('Backup directory not found!', 'danger')
+        return redirect(url_for('backups'))
+    if get_pending_changeset():
+        flash('Confirm or roll back the pending changeset before restoring.', 'warning')
+        return redirect(url_for('restore_preview', backup_name=backup_name))
+    try:
+        success, message = restore_selection(backup_path, request.form.getlist('groups'),
+                                             request.form.getlist('rules'))
+    except (sqlite3.Error, OSError) as e:
+        logging.error(f"Selective restore from {backup_name} failed: {e}")
+        success, message = False, f"Selective restore failed: {e}"
+    flash(message, 'success' if success else 'danger')
+    if not success:
+        return redirect(url_for('restore_preview', backup_name=backup_name))
+    return redirect(url_for('dashboard'))
+
 @app.route('/delete_backup/<path:backup_name>')
 @login_required
 def delete_backup_route(backup_name):
@@ -1360,6 +6708,7 @@ def delete_backup_route(backup_name):
 
 @app.route('/apply_rules', methods=['POST'])
 @login_required
+@profiled('apply_rules')
 def apply_rules():
     success, message = save_rules()
     if success:
@@ -1368,6 +6717,78 @@ def apply_rules():
         flash(f'Failed to apply rules: {message}', 'danger')
     return redirect(url_for('dashboard'))
 
+@app.route('/changes')
+@login_required
+def changes():
+    changeset = get_open_changeset()
+    operations = get_changeset_operations(changeset['id']) if changeset else []
+    preview = None
+    preview_error = None
+    if changeset and operations:
+        try:
+            preview = preview_changeset(changeset['id'])
+        except ApiError as e:
+            preview_error = str(e)
+    return render_template('changes.html', changeset=changeset, operations=operations, preview=preview,
+                           preview_error=preview_error, history=get_changesets(),
+                           pending=get_pending_changeset(), timeouts=CHANGESET_CONFIRM_TIMEOUTS,
+                           drift=drift_state)
+
+@app.route('/changes/open', methods=['POST'])
+@login_required
+def open_changeset():
+    try:
+        create_changeset(request.form.get('name', '').strip(), session.get('user_id'))
+        flash('Changeset opened. Rule and group edits are now staged until you apply them.', 'success')
+    except ApiError as e:
+        flash(str(e), 'danger')
+    return redirect(url_for('changes'))
+
+@app.route('/changes/<int:changeset_id>/operations/<int:operation_id>/delete', methods=['POST'])
+@login_required
+def delete_staged_operation(changeset_id, operation_id):
+    if remove_staged_operation(changeset_id, operation_id):
+        flash('Staged change removed.', 'success')
+    else:
+        flash('Staged change not found.', 'danger')
+    return redirect(url_for('changes'))
+
+@app.route('/changes/<int:changeset_id>/discard', methods=['POST'])
+@login_required
+def discard_changeset_route(changeset_id):
+    if discard_changeset(changeset_id):
+        flash('Changeset discarded. Edits are applied directly again.', 'success')
+    else:
+        flash('Changeset is not open.', 'danger')
+    return redirect(url_for('changes'))
+
+@app.route('/changes/<int:changeset_id>/commit', methods=['POST'])
+@login_required
+def commit_changeset_route(changeset_id):
+    confirm_timeout = request.form.get('confirm_timeout', 0, type=int)
+    if confirm_timeout not in CHANGESET_CONFIRM_TIMEOUTS:
+        flash('Invalid confirmation timeout!', 'danger')
+        return redirect(url_for('changes'))
+    success, message = commit_changeset(changeset_id, confirm_timeout)
+    flash(message, 'success' if success else 'danger')
+    return redirect(url_for('changes'))
+
+@app.route('/changes/<int:changeset_id>/confirm', methods=['POST'])
+@login_required
+def confirm_changeset_route(changeset_id):
+    if confirm_changeset(changeset_id):
+        flash('Changeset confirmed.', 'success')
+    else:
+        flash('Changeset is not waiting for confirmation.', 'danger')
+    return redirect(url_for('changes'))
+
+@app.route('/changes/<int:changeset_id>/rollback', methods=['POST'])
+@login_required
+def rollback_changeset_route(changeset_id):
+    success, message = rollback_changeset(changeset_id)
+    flash(f'Previous ruleset restored: {message}' if success else message, 'success' if success else 'danger')
+    return redirect(url_for('changes'))
+
 @app.route('/debug/backup')
 @login_required
 def debug_backup():
@@ -1432,6 +6853,47 @@ def api_create_backup():
         'message': message
     })
 
+@app.route('/api/backups/<backup_name>/download')
+@login_required
+def download_backup(backup_name):
+    backup_path = resolve_backup_path(backup_name)
+    if backup_path is None:
+        return jsonify({'success': False, 'message': 'Backup not found'}), 404
+    compression = request.args.get('format') or archive_formats()[0]
+    if compression not in archive_formats():
+        return jsonify({'success': False, 'message': f"Format must be one of: {', '.join(archive_formats())}"}), 400
+    logging.info(f"Streaming backup archive {backup_name}.tar.{compression}")
+    response = Response(stream_with_context(stream_backup_archive(backup_path, compression)),
+                        mimetype='application/zstd' if compression == 'zst' else 'application/gzip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{backup_name}.tar.{compression}"'
+    return response
+
+@app.route('/api/backups/<backup_name>/preview')
+@login_required
+def api_restore_preview(backup_name):
+    backup_path = resolve_backup_path(backup_name)
+    if backup_path is None:
+        return jsonify({'success': False, 'message': 'Backup not found'}), 404
+    try:
+        preview = preview_restore(backup_path)
+    except (sqlite3.Error, OSError) as e:
+        return jsonify({'success': False, 'message': f"Cannot read backup database: {e}"}), 400
+    return jsonify(dict(preview, success=True))
+
+@app.route('/api/backups/upload', methods=['POST'])
+@login_required
+def upload_backup():
+    # Body mentah dibaca langsung dari socket; form multipart tetap didukung untuk klien biasa
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('archive')
+        if upload is None:
+            return jsonify({'success': False, 'message': "Missing 'archive' file field"}), 400
+        stream = upload.stream
+    else:
+        stream = request.stream
+    success, message = import_backup_archive(stream)
+    return jsonify({'success': success, 'message': message}), 200 if success else 400
+
 @app.route('/api/delete-old-backups', methods=['POST'])
 @login_required
 def api_delete_old_backups():
@@ -1448,6 +6910,7 @@ def api_delete_old_backups():
                         
                         if create_time < cutoff_date:
                             shutil.rmtree(item_path)
+                            bump_generation('backups')
                             deleted_count += 1
                             logging.info(f"Deleted old backup: {item}")
                     except Exception as e:
@@ -1481,24 +6944,696 @@ def api_check_expired_rules():
             'message': str(e)
         })
 
+@app.route('/drift')
+@login_required
+def drift():
+    report = check_drift()
+    return render_template('drift.html', drift=report)
+
+@app.route('/drift/resync', methods=['POST'])
+@login_required
+def drift_resync():
+    layer = request.form.get('layer', 'kernel')
+    success, message = resync_drift(layer)
+    if success:
+        flash(message, 'success')
+    else:
+        flash(f'Failed to re-sync: {message}', 'danger')
+    return redirect(url_for('drift'))
+
+@app.route('/api/drift')
+@login_required
+def api_drift():
+    with drift_lock:
+        report = dict(drift_state)
+    if report['checked_at'] is None or request.args.get('refresh'):
+        report = dict(check_drift())
+    report['checked_at'] = report['checked_at'].isoformat() if report['checked_at'] else None
+    return jsonify(report)
+
 @app.route('/api/nftables-status')
 @login_required
 def api_nftables_status():
     status = check_nftables_status()
     return jsonify(status)
 
+@app.route('/metrics')
+def metrics():
+    # Dengan NFTM_METRICS_TOKEN: wajib Bearer token; tanpa token: hanya localhost atau sesi login
+    if METRICS_TOKEN:
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied, f"Bearer {METRICS_TOKEN}"):
+            return "Unauthorized\n", 401
+    elif 'user_id' not in session and request.remote_addr not in ('127.0.0.1', '::1'):
+        return "Forbidden\n", 403
+    response = make_response(render_metrics())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+@app.route('/flowtable', methods=['GET', 'POST'])
+@login_required
+def flowtable():
+    interfaces = list_network_interfaces()
+    if request.method == 'POST':
+        enabled = request.form.get('enabled') == 'on'
+        devices = [name for name in request.form.getlist('devices') if name in interfaces]
+        if enabled and not devices:
+            flash('Select at least one interface to enable flowtable offload', 'danger')
+            return redirect(url_for('flowtable'))
+        save_flowtable_config(enabled, devices)
+        success, message = save_rules()
+        if success:
+            flash('Flowtable settings saved and applied', 'success')
+        else:
+            flash(f'Flowtable settings saved but apply failed: {message}', 'danger')
+        return redirect(url_for('flowtable'))
+    
+    kernel_active = False
+    if os.path.exists(NFT):
+        result = run_command([NFT, 'list', 'flowtable'] + NFT_TABLE.split() + [FLOWTABLE_NAME],
+                             capture_output=True, text=True)
+        kernel_active = result.returncode == 0
+    # Interface yang dikonfigurasi tapi sudah tidak ada tetap ditampilkan
+    all_interfaces = sorted(set(interfaces) | set(flowtable_config['devices']))
+    return render_template('flowtable.html',
+                          config=flowtable_config,
+                          interfaces=all_interfaces,
+                          present=set(interfaces),
+                          kernel_active=kernel_active,
+                          flows=count_offloaded_flows())
+
+@app.route('/feeds')
+@login_required
+def feeds():
+    geo_sources = []
+    for label, path in (('Country', GEOIP_COUNTRY_DB), ('ASN', GEOIP_ASN_DB)):
+        try:
+            stat = os.stat(path)
+            geo_sources.append({'label': label, 'path': path, 'size': stat.st_size,
+                                'modified': datetime.fromtimestamp(stat.st_mtime)})
+        except OSError:
+            geo_sources.append({'label': label, 'path': path, 'size': None, 'modified': None})
+    return render_template('feeds.html', feeds=get_feeds(), synced=set(feed_synced), chains=BASE_CHAINS,
+                          actions=FEED_ACTIONS, default_interval=FEED_DEFAULT_INTERVAL // 60,
+                          geo_sources=geo_sources, geo_sets=get_geo_sets(),
+                          geo_active={definition['name'] for definition in active_geo_sets()},
+                          geo_synced=set(geo_synced))
+
+@app.route('/feeds/geoip/sync', methods=['POST'])
+@login_required
+def sync_geoip():
+    try:
+        changes = sync_geo_sets()
+    except (OSError, ValueError, sqlite3.Error) as e:
+        logging.error(f"Error syncing GeoIP sets: {e}")
+        flash(f'Error syncing GeoIP sets: {e}', 'danger')
+        return redirect(url_for('feeds'))
+    added = sum(change['added'] for change in changes)
+    removed = sum(change['removed'] for change in changes)
+    flash(f'GeoIP sets synced: {len(changes)} set(s) updated, +{added} / -{removed} elements', 'success')
+    return redirect(url_for('feeds'))
+
+@app.route('/feeds/add', methods=['POST'])
+@login_required
+def add_feed():
+    name = request.form['name'].strip()
+    url = request.form['url'].strip()
+    chain = request.form.get('chain', 'input')
+    action = request.form.get('action', 'drop')
+    interval = max(request.form.get('interval', type=int) or FEED_DEFAULT_INTERVAL // 60, 1) * 60
+    if chain not in dict(BASE_CHAINS) or action not in FEED_ACTIONS:
+        flash('Invalid chain or action!', 'danger')
+        return redirect(url_for('feeds'))
+    if not url.startswith(('http://', 'https://')) and not os.path.isfile(url[len('file://'):] if url.startswith('file://') else url):
+        flash('Feed source must be an http(s) URL or an existing local file!', 'danger')
+        return redirect(url_for('feeds'))
+    
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    try:
+        c.execute("INSERT INTO feeds (name, url, chain, action, interval) VALUES (?, ?, ?, ?, ?)",
+                 (name, url, chain, action, interval))
+        conn.commit()
+        feed_id = c.lastrowid
+    except sqlite3.IntegrityError:
+        flash('Feed name already exists!', 'danger')
+        return redirect(url_for('feeds'))
+    finally:
+        conn.close()
+    bump_generation('db')
+    logging.info(f"Added threat feed: {name} ({url})")
+    
+    # Set dan aturan feed dibuat lewat apply penuh, isinya diisi lewat update elemen
+    success, message = save_rules()
+    if not success:
+        flash(f'Feed added but failed to apply rules: {message}', 'warning')
+        return redirect(url_for('feeds'))
+    success, message = update_feed(feed_id)
+    flash(message, 'success' if success else 'danger')
+    return redirect(url_for('feeds'))
+
+@app.route('/feeds/<int:feed_id>/refresh', methods=['POST'])
+@login_required
+def refresh_feed(feed_id):
+    success, message = update_feed(feed_id, force='force' in request.form)
+    flash(message, 'success' if success else 'danger')
+    return redirect(url_for('feeds'))
+
+@app.route('/feeds/<int:feed_id>/toggle')
+@login_required
+def toggle_feed(feed_id):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    c.execute("UPDATE feeds SET enabled = NOT enabled WHERE id=?", (feed_id,))
+    conn.commit()
+    conn.close()
+    bump_generation('db')
+    success, message = save_rules()
+    if success:
+        flash('Feed status updated!', 'success')
+    else:
+        flash(f'Feed status updated but failed to apply: {message}', 'warning')
+    return redirect(url_for('feeds'))
+
+@app.route('/feeds/<int:feed_id>/delete')
+@login_required
+def delete_feed(feed_id):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    c.execute("DELETE FROM feed_elements WHERE feed_id=?", (feed_id,))
+    c.execute("DELETE FROM feeds WHERE id=?", (feed_id,))
+    conn.commit()
+    conn.close()
+    bump_generation('db')
+    logging.info(f"Deleted threat feed ID: {feed_id}")
+    success, message = save_rules()
+    if success:
+        flash('Feed deleted successfully!', 'success')
+    else:
+        flash(f'Feed deleted but failed to apply: {message}', 'warning')
+    return redirect(url_for('feeds'))
+
+@app.route('/meters')
+@login_required
+def meters():
+    dynamic_lists = []
+    for list_name, config in DYNAMIC_LISTS.items():
+        total, entries = get_dynamic_list(list_name, METER_DISPLAY_LIMIT)
+        dynamic_lists.append(dict(config, name=list_name, total=total, entries=entries))
+    return render_template('meters.html', meters=get_meters(), rule_types=RULE_TYPES,
+                          display_limit=METER_DISPLAY_LIMIT, dynamic_lists=dynamic_lists,
+                          dynamic_state=dict(dynamic_state, queue_depth=dynamic_queue.qsize()))
+
+def conntrack_page(args):
+    """Satu halaman browser conntrack dari argumen query; ValueError untuk filter atau cursor tidak valid"""
+    filters = parse_conntrack_filters(args)
+    cursor = args.get('cursor')
+    limit = min(max(args.get('limit', CONNTRACK_PAGE_SIZE, type=int), 1), CONNTRACK_PAGE_MAX)
+    return scan_conntrack(filters, decode_conntrack_cursor(cursor) if cursor else None, limit)
+
+@app.route('/conntrack')
+@login_required
+def conntrack():
+    try:
+        page = conntrack_page(request.args)
+    except ValueError as e:
+        flash(f'Invalid conntrack filter: {e}', 'danger')
+        page = None
+    rules = get_rules()
+    # Tautan ke baris aturan di dashboard (tanpa filter grup) beserta halamannya
+    rule_links = {rule['id']: url_for('dashboard', page=position // RULES_PER_PAGE + 1, _anchor=f"rule-{rule['id']}")
+                  for position, rule in enumerate(rules)}
+    return render_template('conntrack.html', page=page, rules_by_id={rule['id']: rule for rule in rules},
+                           rule_links=rule_links, filters=request.args, page_size=CONNTRACK_PAGE_SIZE)
+
+@app.route('/logs')
+@login_required
+def logs():
+    try:
+        filters = parse_log_filters(request.args)
+    except ValueError as e:
+        flash(f'Invalid log filter: {e}', 'danger')
+        filters = {}
+    page = read_log(filters, request.args.get('before', type=int))
+    return render_template('logs.html', page=page, filters=request.args, levels=LOG_LEVELS, log_file=LOG_FILE)
+
+@app.route('/api/logs')
+@login_required
+def api_logs():
+    try:
+        filters = parse_log_filters(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    limit = min(max(request.args.get('limit', LOG_VIEW_LIMIT, type=int), 1), 5000)
+    page = read_log(filters, request.args.get('before', type=int), limit)
+    if page is None:
+        return jsonify({'success': False, 'message': 'Log file not found'}), 404
+    return jsonify(dict(page, success=True))
+
+@app.route('/api/logs/stream')
+@login_required
+def api_logs_stream():
+    """Server-Sent Events berisi baris log baru; id event adalah offset file untuk melanjutkan"""
+    try:
+        filters = parse_log_filters(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    offset = request.headers.get('Last-Event-ID', type=int)
+    if offset is None:
+        offset = request.args.get('from', type=int)
+    if offset is None:
+        try:
+            offset = os.path.getsize(LOG_FILE)
+        except OSError:
+            offset = 0
+    if not log_follow_slots.acquire(blocking=False):
+        return jsonify({'success': False, 'message': 'Too many log followers'}), 503
+    
+    def events():
+        yield "retry: 3000\n\n"
+        for position, entry in follow_log(offset, filters):
+            if entry is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"id: {position}\ndata: {json.dumps(entry, default=str)}\n\n"
+    
+    response = Response(stream_with_context(events()), mimetype='text/event-stream')
+    # Slot dilepas saat koneksi ditutup, juga jika stream tidak pernah mulai diiterasi
+    response.call_on_close(log_follow_slots.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/profiles')
+@login_required
+def profiles():
+    with profile_lock:
+        armed = set(profile_armed)
+    return render_template('profiles.html', profiles=get_profile_list(), targets=PROFILE_TARGETS,
+                           armed=armed, max_count=PROFILE_MAX_COUNT)
+
+@app.route('/profiles/arm', methods=['POST'])
+@login_required
+def profiles_arm():
+    target = request.form.get('target')
+    if target not in PROFILE_TARGETS:
+        flash('Unknown profiling target', 'danger')
+    else:
+        arm_profile(target)
+        flash(f'Profiling armed: {PROFILE_TARGETS[target]}', 'success')
+    return redirect(url_for('profiles'))
+
+@app.route('/profiles/<name>.<kind>')
+@login_required
+def profile_download(name, kind):
+    if kind not in ('pstats', 'collapsed', 'txt') or not re.fullmatch(r'[A-Za-z0-9_-]+', name):
+        abort(404)
+    return send_from_directory(PROFILE_DIR, f"{name}.{kind}", as_attachment=(kind == 'pstats'),
+                               mimetype='application/octet-stream' if kind == 'pstats' else 'text/plain')
+
+@app.route('/fleet')
+@login_required
+def fleet():
+    nodes = get_nodes()
+    profiles = compile_fleet_profiles(nodes)
+    for node in nodes:
+        node['profile_hash'] = profiles[node['profile']][1]
+    with fleet_lock:
+        last_push = fleet_state['last_push']
+    return render_template('fleet.html', nodes=nodes, last_push=last_push, agent_port=AGENT_PORT,
+                          profile_count=len(profiles), compile_stats=compile_stats)
+
+@app.route('/fleet/add_node', methods=['POST'])
+@login_required
+def add_node():
+    name = request.form['name']
+    address = request.form['address']
+    port = request.form.get('port', type=int) or AGENT_PORT
+    token = request.form['token']
+    canary = 'canary' in request.form
+    tags = normalize_tags(request.form.get('tags', ''))
+    
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    try:
+        c.execute("INSERT INTO nodes (name, address, port, token, canary, tags) VALUES (?, ?, ?, ?, ?, ?)",
+                 (name, address, port, token, canary, tags))
+        conn.commit()
+        flash('Node added successfully!', 'success')
+        logging.info(f"Added fleet node: {name} ({address}:{port})")
+    except sqlite3.IntegrityError:
+        flash('Node name already exists!', 'danger')
+    finally:
+        conn.close()
+    return redirect(url_for('fleet'))
+
+@app.route('/fleet/toggle_node/<int:node_id>')
+@login_required
+def toggle_node(node_id):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    c.execute("UPDATE nodes SET enabled = NOT enabled WHERE id=?", (node_id,))
+    conn.commit()
+    conn.close()
+    flash('Node status updated!', 'success')
+    return redirect(url_for('fleet'))
+
+@app.route('/fleet/delete_node/<int:node_id>')
+@login_required
+def delete_node(node_id):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection)
+    c = conn.cursor()
+    c.execute("DELETE FROM nodes WHERE id=?", (node_id,))
+    conn.commit()
+    conn.close()
+    flash('Node deleted successfully!', 'success')
+    logging.info(f"Deleted fleet node ID: {node_id}")
+    return redirect(url_for('fleet'))
+
+@app.route('/fleet/push', methods=['POST'])
+@login_required
+def fleet_push():
+    success, message, results = push_to_fleet(force='force' in request.form)
+    if success:
+        flash(message, 'success')
+    else:
+        flash(f'Fleet push failed: {message}', 'danger')
+    return redirect(url_for('fleet'))
+
+@app.route('/api/fleet/push', methods=['POST'])
+@login_required
+def api_fleet_push():
+    success, message, results = push_to_fleet(force=bool(request.args.get('force')))
+    return jsonify({
+        'success': success,
+        'message': message,
+        'results': results
+    })
+
+@app.route('/api/fleet/status')
+@login_required
+def api_fleet_status():
+    statuses = poll_fleet_status()
+    return jsonify({str(node_id): status for node_id, status in statuses.items()})
+
+@app.route('/simulate', methods=['GET', 'POST'])
+@login_required
+def simulate():
+    result = None
+    batch = None
+    rules_by_id = {}
+    if request.method == 'POST':
+        try:
+            simulator = get_simulator()
+            rules_by_id = {rule['id']: rule for chain in simulator.chains.values() for rule in chain['rules']}
+            upload = request.files.get('packets')
+            if upload and upload.filename:
+                chain = request.form.get('chain', 'input')
+                started = time.time()
+                if upload.filename.endswith(('.pcap', '.cap')):
+                    tuples = read_pcap_tuples(upload.stream, chain)
+                else:
+                    tuples = read_csv_tuples(io.TextIOWrapper(upload.stream, encoding='utf-8'), chain)
+                batch = summarize_simulation(simulator, tuples)
+                batch['duration'] = round(time.time() - started, 3)
+                logging.info(f"Simulated {batch['total']} packets from {upload.filename} in {batch['duration']}s")
+            else:
+                result = simulator.evaluate(request.form['chain'], request.form.get('src'), request.form.get('dst'),
+                                            request.form.get('protocol'), request.form.get('dport'))
+        except ValueError as e:
+            flash(f'Invalid simulation input: {e}', 'danger')
+    return render_template('simulate.html', result=result, batch=batch, rules_by_id=rules_by_id,
+                          form_data=request.form)
+
+@app.route('/api/simulate', methods=['POST'])
+@login_required
+def api_simulate():
+    payload = json_object_body()
+    if payload is None:
+        return jsonify(JSON_OBJECT_REQUIRED), 400
+    try:
+        simulator = get_simulator()
+        if 'packets' in payload:
+            packets = payload['packets']
+            if not isinstance(packets, list) or not all(isinstance(packet, dict) for packet in packets):
+                return jsonify({'success': False, 'message': "packets must be a list of objects"}), 400
+            results = []
+            for packet in packets:
+                results.append(simulator.evaluate(packet.get('chain', 'input'), packet.get('src'), packet.get('dst'),
+                                                  packet.get('protocol'), packet.get('dport')))
+            return jsonify({'success': True, 'results': results})
+        result = simulator.evaluate(payload.get('chain', 'input'), payload.get('src'), payload.get('dst'),
+                                    payload.get('protocol'), payload.get('dport'))
+        return jsonify(dict(result, success=True))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+@app.route('/api-tokens', methods=['GET', 'POST'])
+@login_required
+def api_tokens():
+    new_token = None
+    if request.method == 'POST':
+        name = request.form.get('name', '').strip()
+        if not name:
+            flash('Token name is required!', 'danger')
+        else:
+            # Token hanya ditampilkan sekali di halaman ini, tidak lewat flash (cookie sesi)
+            new_token = create_api_token(name, session.get('user_id'))
+            logging.info(f"Created API token: {name}")
+    return render_template('api_tokens.html', tokens=get_api_tokens(), new_token=new_token)
+
+@app.route('/api-tokens/<int:token_id>/revoke', methods=['POST'])
+@login_required
+def revoke_api_token_route(token_id):
+    revoke_api_token(token_id)
+    flash('API token revoked!', 'success')
+    logging.info(f"Revoked API token ID: {token_id}")
+    return redirect(url_for('api_tokens'))
+
+def _api_write(operation, key, status=200):
+    """Jalankan satu operasi tulis sebagai batch berisi satu operasi"""
+    code, body = execute_api_batch([operation], apply=request.args.get('apply', '1') != '0')
+    if not body['success']:
+        message = body['results'][0]['message'] if body['results'] else body['message']
+        return jsonify({'success': False, 'message': message}), code
+    result = body['results'][0]
+    return jsonify({'success': True, key: result.get(key, result.get('id')), 'applied': body['applied'],
+                    'apply_message': body['apply_message']}), status
+
+@app.route('/api/v1/rules', methods=['GET', 'POST'])
+@api_token_required
+def api_v1_rules():
+    if request.method == 'POST':
+        return _api_write({'op': 'create_rule', 'data': request.get_json(silent=True)}, 'rule', 201)
+    group_id = request.args.get('group_id', type=int)
+    chain = request.args.get('chain')
+    if chain:
+        rules = [rule for rule in get_rules_by_chain(chain.lower()) if not group_id or rule['group_id'] == group_id]
+    else:
+        rules = get_rules(group_id)
+    return jsonify({'success': True, 'rules': [dict(rule) for rule in rules]})
+
+@app.route('/api/v1/rules/<int:rule_id>', methods=['GET', 'PUT', 'PATCH', 'DELETE'])
+@api_token_required
+def api_v1_rule(rule_id):
+    if request.method in ('PUT', 'PATCH'):
+        return _api_write({'op': 'update_rule', 'id': rule_id, 'data': request.get_json(silent=True)}, 'rule')
+    if request.method == 'DELETE':
+        return _api_write({'op': 'delete_rule', 'id': rule_id}, 'id')
+    rule = get_rule(rule_id)
+    if not rule:
+        return jsonify({'success': False, 'message': f"Rule {rule_id} not found"}), 404
+    return jsonify({'success': True, 'rule': dict(rule)})
+
+@app.route('/api/v1/rules/<int:rule_id>/toggle', methods=['POST'])
+@api_token_required
+def api_v1_toggle_rule(rule_id):
+    return _api_write({'op': 'toggle_rule', 'id': rule_id}, 'rule')
+
+@app.route('/api/v1/groups', methods=['GET', 'POST'])
+@api_token_required
+def api_v1_groups():
+    if request.method == 'POST':
+        return _api_write({'op': 'create_group', 'data': request.get_json(silent=True)}, 'group', 201)
+    return jsonify({'success': True, 'groups': [dict(group) for group in get_groups()]})
+
+@app.route('/api/v1/groups/<int:group_id>', methods=['GET', 'PUT', 'PATCH', 'DELETE'])
+@api_token_required
+def api_v1_group(group_id):
+    if request.method in ('PUT', 'PATCH'):
+        return _api_write({'op': 'update_group', 'id': group_id, 'data': request.get_json(silent=True)}, 'group')
+    if request.method == 'DELETE':
+        return _api_write({'op': 'delete_group', 'id': group_id}, 'id')
+    group = get_group(group_id)
+    if not group:
+        return jsonify({'success': False, 'message': f"Group {group_id} not found"}), 404
+    return jsonify({'success': True, 'group': dict(group)})
+
+@app.route('/api/v1/lists/<list_name>', methods=['GET', 'POST', 'DELETE'])
+@api_token_required
+def api_v1_dynamic_list(list_name):
+    if list_name not in DYNAMIC_LISTS:
+        return jsonify({'success': False, 'message': f"Unknown list: {list_name}"}), 404
+    if request.method == 'GET':
+        limit = min(max(request.args.get('limit', 1000, type=int), 1), 10000)
+        total, entries = get_dynamic_list(list_name, limit, max(request.args.get('offset', 0, type=int), 0))
+        return jsonify({'success': True, 'list': list_name, 'set': DYNAMIC_LISTS[list_name]['set'],
+                        'set6': DYNAMIC_LISTS[list_name]['set6'],
+                        'total': total, 'entries': entries, 'queue_depth': dynamic_queue.qsize()})
+    payload = json_object_body()
+    if payload is None:
+        return jsonify(JSON_OBJECT_REQUIRED), 400
+    addresses = payload.get('addresses')
+    if isinstance(payload.get('address'), str):
+        addresses = [payload['address']]
+    if not isinstance(addresses, list) or not addresses:
+        return jsonify({'success': False, 'message': "addresses must be a non-empty list"}), 400
+    try:
+        queued = enqueue_dynamic(list_name, addresses, remove=request.method == 'DELETE',
+                                 timeout=payload.get('timeout'), comment=payload.get('comment'))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    # Ditulis ke kernel oleh writer dalam hitungan milidetik; 202 karena belum tentu sudah diterapkan
+    return jsonify({'success': True, 'queued': queued, 'queue_depth': dynamic_queue.qsize()}), 202
+
+@app.route('/api/v1/conntrack')
+@api_token_required
+def api_v1_conntrack():
+    try:
+        page = conntrack_page(request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    if page is None:
+        return jsonify({'success': False, 'message': "Connection tracking table is not available"}), 503
+    page['rule_counts'] = [{'rule_id': rule_id, 'count': count} for rule_id, count in
+                           sorted(page['rule_counts'].items(), key=lambda item: -item[1])]
+    return jsonify(dict(page, success=True))
+
+@app.route('/api/v1/batch', methods=['POST'])
+@api_token_required
+def api_v1_batch():
+    payload = json_object_body()
+    if payload is None:
+        return jsonify(JSON_OBJECT_REQUIRED), 400
+    code, body = execute_api_batch(payload.get('operations'), apply=payload.get('apply', True) is not False)
+    return jsonify(body), code
+
+@app.route('/api/v1/changesets', methods=['POST'])
+@api_token_required
+def api_v1_create_changeset():
+    payload = json_object_body()
+    if payload is None:
+        return jsonify(JSON_OBJECT_REQUIRED), 400
+    operations = payload.get('operations') or []
+    if not isinstance(operations, list) or len(operations) > API_BATCH_MAX:
+        return jsonify({'success': False, 'message': f"operations must be a list of at most {API_BATCH_MAX} items"}), 400
+    try:
+        changeset_id = create_changeset(_clean(payload.get('name')), g.api_token['user_id'])
+    except ApiError as e:
+        return jsonify({'success': False, 'message': str(e)}), e.status
+    try:
+        for operation in operations:
+            stage_operation(changeset_id, operation)
+    except ApiError as e:
+        discard_changeset(changeset_id)
+        return jsonify({'success': False, 'message': str(e)}), e.status
+    return jsonify({'success': True, 'changeset': get_changeset(changeset_id)}), 201
+
+@app.route('/api/v1/changesets/<int:changeset_id>', methods=['GET'])
+@api_token_required
+def api_v1_changeset(changeset_id):
+    changeset = get_changeset(changeset_id)
+    if changeset is None:
+        return jsonify({'success': False, 'message': f"Changeset {changeset_id} not found"}), 404
+    changeset.pop('snapshot', None)
+    body = {'success': True, 'changeset': changeset,
+            'operations': get_changeset_operations(changeset_id)}
+    if changeset['status'] == 'draft':
+        try:
+            body['preview'] = preview_changeset(changeset_id)
+        except ApiError as e:
+            body['preview_error'] = str(e)
+    return jsonify(body)
+
+@app.route('/api/v1/changesets/<int:changeset_id>/<action>', methods=['POST'])
+@api_token_required
+def api_v1_changeset_action(changeset_id, action):
+    payload = json_object_body()
+    if payload is None:
+        return jsonify(JSON_OBJECT_REQUIRED), 400
+    if action == 'commit':
+        confirm_timeout = payload.get('confirm_timeout', 0)
+        if not isinstance(confirm_timeout, int) or not 0 <= confirm_timeout <= max(CHANGESET_CONFIRM_TIMEOUTS):
+            return jsonify({'success': False, 'message': "confirm_timeout must be an integer number of seconds "
+                                                         f"between 0 and {max(CHANGESET_CONFIRM_TIMEOUTS)}"}), 400
+        success, message = commit_changeset(changeset_id, confirm_timeout)
+    elif action == 'confirm':
+        success = confirm_changeset(changeset_id)
+        message = "Changeset confirmed" if success else "Changeset is not waiting for confirmation"
+    elif action == 'rollback':
+        success, message = rollback_changeset(changeset_id)
+    elif action == 'discard':
+        success = discard_changeset(changeset_id)
+        message = "Changeset discarded" if success else "Changeset is not open"
+    else:
+        return jsonify({'success': False, 'message': f"Unknown changeset action: {action}"}), 404
+    return jsonify({'success': success, 'message': message}), 200 if success else 409
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="nftables Manager")
+    parser.add_argument('--agent', action='store_true',
+                        help="Jalankan sebagai agent fleet yang menerima ruleset dari controller")
+    parser.add_argument('--listen', default="0.0.0.0", help="Alamat listen agent")
+    parser.add_argument('--port', type=int, default=AGENT_PORT, help="Port listen agent")
+    parser.add_argument('--token', default=os.environ.get('NFTM_AGENT_TOKEN'),
+                        help="Token autentikasi agent (default: $NFTM_AGENT_TOKEN)")
+    parser.add_argument('--rules-file', default=RULES_FILE, help="Lokasi file aturan di node agent")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Agent hanya memvalidasi dan menyimpan ruleset tanpa reload")
+    args = parser.parse_args()
+    
+    if args.agent:
+        if not args.token:
+            parser.error("--token or NFTM_AGENT_TOKEN is required in agent mode")
+        RULES_FILE = args.rules_file
+        run_agent(args.listen, args.port, args.token, args.dry_run)
+        raise SystemExit(0)
+    
     logging.info("=== Starting nftables Manager application ===")
     init_db()
+    resume_pending_changeset()
     
-    success, message = save_rules()
-    if success:
-        logging.info("Default rules applied successfully")
+    apply_needed, reason = startup_apply_needed()
+    if not apply_needed:
+        logging.info(f"Skipping startup apply: {reason}")
     else:
-        logging.error(f"Failed to apply default rules: {message}")
+        logging.info(f"Applying rules on startup: {reason}")
+        success, message = save_rules()
+        if success:
+            logging.info("Default rules applied successfully")
+        else:
+            logging.error(f"Failed to apply default rules: {message}")
     
     checker_thread = threading.Thread(target=expired_rules_checker, daemon=True)
     checker_thread.start()
     logging.info("Started expired rules checker thread")
     
+    feed_thread = threading.Thread(target=feed_updater, daemon=True)
+    feed_thread.start()
+    logging.info("Started threat feed updater thread")
+    
+    geoip_thread = threading.Thread(target=geoip_updater, daemon=True)
+    geoip_thread.start()
+    logging.info("Started GeoIP updater thread")
+    
+    for target in (dynamic_list_writer, dynamic_list_persister):
+        threading.Thread(target=target, daemon=True).start()
+    logging.info("Started dynamic list writer and persister threads")
+    
+    drift_thread = threading.Thread(target=drift_checker, daemon=True)
+    drift_thread.start()
+    monitor_thread = threading.Thread(target=nft_monitor_watcher, daemon=True)
+    monitor_thread.start()
+    logging.info("Started drift checker and nft monitor threads")
+    
     app.run(host="0.0.0.0", port=2107, debug=False)
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+"""Benchmark nftables Manager
+
+Contoh:
+    python benchmark.py pipeline --sizes 10,1000,100000 --save-baseline
+    python benchmark.py pipeline --baseline benchmark_baseline.json
+    python benchmark.py simulate --rules 10000 --packets 1000000
+    python benchmark.py store --rules 100000
+"""
+import argparse
+import ipaddress
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import app
+
+PIPELINE_STAGES = ['get_rules', 'save_rules', 'check_expired_rules', 'get_backup_list', 'dashboard']
+
+
+def synthetic_rules(count, seed=42):
+    """Membuat aturan sintetis dengan bentuk yang sama seperti hasil get_rules()"""
+    rng = random.Random(seed)
+    rules = []
+    for rule_id in range(1, count + 1):
+        protocol = rng.choice(['tcp', 'tcp', 'tcp', 'udp', 'udp', 'icmp'])
+        dport = None
+        if protocol in ('tcp', 'udp') and rng.random() < 0.95:
+            port = rng.randint(1, 65000)
+            dport = f"{port}-{port + rng.randint(1, 20)}" if rng.random() < 0.2 else str(port)
+        src = None
+        if rng.random() < 0.6:
+            prefix = rng.choice([8, 16, 24, 32])
+            network = ipaddress.ip_network((rng.getrandbits(32), prefix), strict=False)
+            src = str(network)
+        rules.append({
+            'id': rule_id,
+            'name': f"rule-{rule_id}",
+            'group_id': None,
+            'group_name': None,
+            'group_color': None,
+            'group_target_tags': None,
+            'target_tags': None,
+            'chain': rng.choice(['input', 'input', 'forward', 'output']),
+            'src': src,
+            'dst': None,
+            'dport': dport,
+            'protocol': protocol,
+            'action': rng.choice(['accept', 'drop', 'reject']),
+            'comment': None,
+            'enabled': 1,
+            'expired_at': None,
+        })
+    return rules
+
+
+def synthetic_packets(count, distinct, seed=7):
+    """Membuat tuple paket acak; `distinct` membatasi jumlah tuple unik"""
+    rng = random.Random(seed)
+    pool = []
+    for _ in range(distinct):
+        pool.append((
+            rng.choice(['input', 'forward', 'output']),
+            str(ipaddress.IPv4Address(rng.getrandbits(32))),
+            str(ipaddress.IPv4Address(rng.getrandbits(32))),
+            rng.choice(['tcp', 'udp', 'icmp']),
+            rng.randint(1, 65535),
+        ))
+    return [pool[rng.randrange(distinct)] for _ in range(count)]
+
+
+def linear_verdict(simulator, packet):
+    """Evaluasi first-match linear sebagai pembanding kebenaran"""
+    chain, src, dst, protocol, dport = packet
+    index = simulator.chains[chain]
+    for position, match in enumerate(index['matches']):
+        if match['family'] and match['family'] != app.ADDRESS_FAMILIES[ipaddress.ip_address(src).version]:
+            continue
+        if match['protocol'] and match['protocol'] != protocol:
+            continue
+        if match['ports'] is not None:
+            if dport is None or not any(low <= dport <= high for low, high in match['ports']):
+                continue
+        if match['src'] is not None and not any(ipaddress.ip_address(src) in net for net in match['src']):
+            continue
+        if match['dst'] is not None and not any(ipaddress.ip_address(dst) in net for net in match['dst']):
+            continue
+        return index['verdicts'][position], index['rules'][position]['id']
+    return simulator.policies[chain], None
+
+
+def bench_simulate(args):
+    rules = synthetic_rules(args.rules)
+    packets = synthetic_packets(args.packets, args.distinct)
+
+    started = time.perf_counter()
+    simulator = app.PolicySimulator(rules, node_tags=frozenset())
+    build_time = time.perf_counter() - started
+
+    # Verifikasi hasil indeks terhadap evaluasi linear pada sampel
+    sample = packets[:args.verify]
+    for packet in sample:
+        expected = linear_verdict(simulator, packet)
+        actual = next(simulator.evaluate_many([packet]))
+        if expected != actual:
+            raise SystemExit(f"Mismatch for {packet}: expected {expected}, got {actual}")
+    simulator._memo.clear()
+
+    started = time.perf_counter()
+    for packet in packets[:args.single]:
+        simulator.evaluate(*packet)
+    single_time = time.perf_counter() - started
+    simulator._memo.clear()
+
+    started = time.perf_counter()
+    summary = app.summarize_simulation(simulator, packets)
+    batch_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for packet in packets[:args.single]:
+        linear_verdict(simulator, packet)
+    linear_time = time.perf_counter() - started
+
+    print(f"rules: {args.rules}, packets: {args.packets} ({args.distinct} distinct)")
+    print(f"build index:      {build_time * 1000:10.1f} ms")
+    print(f"single query:     {single_time / args.single * 1e6:10.2f} us/packet")
+    print(f"linear scan:      {linear_time / args.single * 1e6:10.2f} us/packet")
+    print(f"batch:            {batch_time:10.3f} s ({args.packets / batch_time:,.0f} packets/s)")
+    print(f"verdicts:         {summary['verdicts']}")
+    print(f"verified:         {len(sample)} packets match linear evaluation")
+
+
+class FakeExecutor:
+    """Pengganti run_command: mencatat perintah nft/systemctl/cp tanpa menjalankannya"""
+
+    def __init__(self):
+        self.calls = {}
+
+    def __call__(self, args, **kwargs):
+        name = " ".join(os.path.basename(part) for part in args[:2])
+        self.calls[name] = self.calls.get(name, 0) + 1
+        stdout = "table inet tableku\n" if args[1:3] == ['list', 'tables'] else ""
+        return subprocess.CompletedProcess(args, 0, stdout=stdout, stderr="")
+
+
+def use_workdir(workdir):
+    """Arahkan path database dan konfigurasi app ke direktori kerja benchmark"""
+    app.DB_FILE = os.path.join(workdir, "firewall.db")
+    app.RULES_FILE = os.path.join(workdir, "nftables.d", "custom.nft")
+    app.NFT_CONF = os.path.join(workdir, "nftables.conf")
+    app.BACKUP_DIR = os.path.join(workdir, "nftables.d", "backups")
+    app.init_db()
+
+
+def seed_database(workdir, size, backups, seed=11):
+    """Isi firewall.db sementara dengan grup dan aturan sintetis"""
+    use_workdir(workdir)
+
+    rng = random.Random(seed)
+    conn = sqlite3.connect(app.DB_FILE)
+    c = conn.cursor()
+    group_count = max(size // 100, 1)
+    c.executemany("INSERT INTO rule_groups (name, description, color) VALUES (?, ?, ?)",
+                  [(f"bench-{i}", "Synthetic group", "#6c757d") for i in range(group_count)])
+    c.execute("SELECT id FROM rule_groups")
+    group_ids = [row[0] for row in c.fetchall()]
+    now = datetime.now()
+    rows = []
+    for rule in synthetic_rules(size, seed):
+        # Sekitar 1% aturan sudah expired, 10% akan expired di masa depan
+        roll = rng.random()
+        expired_at = None
+        if roll < 0.01:
+            expired_at = now - timedelta(hours=1)
+        elif roll < 0.11:
+            expired_at = now + timedelta(days=rng.randint(1, 30))
+        rows.append((rule['name'], rng.choice(group_ids), rule['chain'], rule['src'], rule['dst'],
+                     rule['dport'], rule['protocol'], rule['action'], rule['comment'], True, expired_at))
+    c.executemany("""
+        INSERT INTO rules (name, group_id, chain, src, dst, dport, protocol, action, comment, enabled, expired_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    conn.commit()
+    conn.close()
+
+    for i in range(backups):
+        backup_dir = os.path.join(app.BACKUP_DIR, f"backup_20240101_{i:06d}")
+        os.makedirs(backup_dir)
+        for name in ("nftables.conf", "firewall.db", "backup_info.txt"):
+            with open(os.path.join(backup_dir, name), "w") as f:
+                f.write("x" * 1024)
+
+
+def reset_state():
+    """Aktifkan kembali aturan expired dan kosongkan cache agar setiap ulangan sebanding"""
+    conn = sqlite3.connect(app.DB_FILE)
+    conn.execute("UPDATE rules SET enabled = 1 WHERE expired_at IS NOT NULL")
+    conn.commit()
+    conn.close()
+    app._fragment_cache.clear()
+    app.data_generation['next_expiry'] = None
+
+
+def stage_callables():
+    client = app.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 1
+        sess['username'] = 'admin'
+
+    def dashboard():
+        response = client.get('/dashboard')
+        if response.status_code != 200:
+            raise RuntimeError(f"Dashboard returned {response.status_code}")
+
+    return {
+        'get_rules': app.get_rules,
+        'save_rules': app.save_rules,
+        'check_expired_rules': app.check_expired_rules,
+        'get_backup_list': app.get_backup_list,
+        'dashboard': dashboard,
+    }
+
+
+def run_pipeline_worker(args):
+    """Jalankan satu tahap pada salinan database yang sudah di-seed dan cetak hasil JSON
+
+    Dipanggil sebagai subprocess per tahap: ru_maxrss adalah high-water mark seumur proses,
+    sehingga hanya proses terpisah yang memberi peak RSS milik satu tahap.
+    """
+    if not args.log:
+        logging.getLogger().setLevel(logging.WARNING)
+    use_workdir(args.workdir)
+    executor = FakeExecutor()
+    app.run_command = executor
+    # Berkas placeholder agar cabang nft/systemctl dijalankan; eksekusinya dipalsukan
+    for tool in ('nft', 'systemctl'):
+        placeholder = os.path.join(args.workdir, tool)
+        open(placeholder, 'w').close()
+        setattr(app, tool.upper(), placeholder)
+    func = stage_callables()[args.stage]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    for _ in range(args.repeat):
+        reset_state()
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    reset_state()
+    tracemalloc.start()
+    func()
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    print(json.dumps({
+        'wall_ms': round(statistics.median(timings) * 1000, 3),
+        'wall_min_ms': round(min(timings) * 1000, 3),
+        'alloc_peak_kb': round(peak / 1024, 1),
+        'alloc_blocks': snapshot_blocks,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'base_rss_kb': rss_before,
+        'commands': executor.calls,
+    }))
+
+
+def format_delta(before, after):
+    if not before:
+        return "      n/a"
+    return f"{(after - before) / before * 100:+8.1f}%"
+
+
+def bench_pipeline(args):
+    if args.worker:
+        return run_pipeline_worker(args)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    report = {'created': datetime.now().isoformat(), 'python': sys.version.split()[0], 'sizes': {}}
+    if not args.log:
+        logging.getLogger().setLevel(logging.WARNING)
+    for size in sizes:
+        seeded = tempfile.mkdtemp(prefix="nftm-bench-")
+        try:
+            # Database di-seed sekali per ukuran; tiap tahap berjalan di proses sendiri atas salinannya
+            seed_database(seeded, size, args.backups)
+            stages = {'_commands': {}}
+            for stage in PIPELINE_STAGES:
+                workdir = tempfile.mkdtemp(prefix="nftm-bench-")
+                try:
+                    shutil.copytree(seeded, workdir, dirs_exist_ok=True)
+                    command = [sys.executable, os.path.abspath(__file__), 'pipeline', '--worker',
+                               '--workdir', workdir, '--stage', stage, '--repeat', str(args.repeat)]
+                    if args.log:
+                        command.append('--log')
+                    output = subprocess.run(command, capture_output=True, text=True)
+                finally:
+                    shutil.rmtree(workdir, ignore_errors=True)
+                if output.returncode != 0:
+                    raise SystemExit(f"Benchmark worker failed for {stage} at size {size}:\n{output.stderr}")
+                result = json.loads(output.stdout.strip().splitlines()[-1])
+                for name, count in result.pop('commands').items():
+                    stages['_commands'][name] = stages['_commands'].get(name, 0) + count
+                stages[stage] = result
+            report['sizes'][str(size)] = stages
+        finally:
+            shutil.rmtree(seeded, ignore_errors=True)
+
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = []
+    header = (f"{'size':>8} {'stage':<22} {'wall ms':>10} {'alloc KB':>10} {'blocks':>9} {'RSS KB':>9} "
+              f"{'+RSS KB':>9}")
+    if baseline:
+        header += f" {'base ms':>10} {'delta':>9}"
+    print(header)
+    for size, stages in report['sizes'].items():
+        for stage in PIPELINE_STAGES:
+            result = stages[stage]
+            line = (f"{size:>8} {stage:<22} {result['wall_ms']:>10.2f} {result['alloc_peak_kb']:>10.1f} "
+                    f"{result['alloc_blocks']:>9} {result['peak_rss_kb']:>9} "
+                    f"{result['peak_rss_kb'] - result['base_rss_kb']:>9}")
+            if baseline:
+                before = baseline['sizes'].get(size, {}).get(stage, {}).get('wall_ms')
+                line += f" {before if before is not None else 0:>10.2f} {format_delta(before, result['wall_ms'])}"
+                if before and (result['wall_ms'] - before) / before * 100 > args.threshold:
+                    regressions.append(f"{stage} @ {size}")
+            print(line)
+        print(f"{size:>8} {'commands':<22} {stages['_commands']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    if regressions:
+        print(f"Regressions over {args.threshold}%: {', '.join(regressions)}")
+        if args.fail_on_regression:
+            raise SystemExit(1)
+
+
+def bench_store(args):
+    """Ukur snapshot aturan di memori: waktu bangun, memori per aturan, dan latensi baca"""
+    logging.getLogger().setLevel(logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="nftm-bench-")
+    try:
+        seed_database(workdir, args.rules, 0)
+        started = time.perf_counter()
+        tracemalloc.start()
+        snapshot = app.rule_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        build = time.perf_counter() - started
+        stats = app.rule_store_stats(snapshot)
+        print(f"rules:            {stats['rules']} in {stats['groups']} groups")
+        print(f"build:            {build * 1000:.1f} ms (traced, peak {peak / 1048576:.1f} MB)")
+        print(f"retained:         {current / 1048576:.1f} MB, {current / max(stats['rules'], 1):.0f} B/rule (tracemalloc)")
+        print(f"estimated:        {stats['bytes_per_rule']} B/rule (records {stats['record_bytes'] // 1024} KB, "
+              f"values {stats['value_bytes'] // 1024} KB, indexes {stats['index_bytes'] // 1024} KB)")
+
+        conn = sqlite3.connect(app.DB_FILE)
+        conn.row_factory = sqlite3.Row
+        tracemalloc.start()
+        rows = [dict(row) for row in conn.execute("SELECT r.*, g.name AS group_name, g.color AS group_color, "
+                                                  "g.target_tags AS group_target_tags FROM rules r "
+                                                  "LEFT JOIN rule_groups g ON r.group_id = g.id")]
+        dict_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        conn.close()
+        print(f"dict(row) list:   {dict_bytes / max(len(rows), 1):.0f} B/rule for comparison")
+        del rows
+
+        rng = random.Random(3)
+        ids = [rng.randint(1, args.rules) for _ in range(args.reads)]
+        started = time.perf_counter()
+        for rule_id in ids:
+            app.get_rule(rule_id)
+        print(f"get_rule:         {(time.perf_counter() - started) / len(ids) * 1e6:.2f} us/call")
+        started = time.perf_counter()
+        for _ in range(20):
+            app.get_rules()
+        print(f"get_rules:        {(time.perf_counter() - started) / 20 * 1000:.2f} ms/call")
+
+        # Satu penulisan: snapshot baru memakai ulang record yang tidak berubah
+        app.toggle_rule_in_db(ids[0])
+        started = time.perf_counter()
+        fresh = app.rule_snapshot()
+        shared = sum(1 for old, new in zip(snapshot.rules, fresh.rules) if old is new)
+        print(f"rebuild:          {(time.perf_counter() - started) * 1000:.1f} ms after one write, "
+              f"{shared}/{len(fresh.rules)} records shared")
+
+        # Penulisan ke tabel lain hanya memeriksa baris versi aturan/grup
+        app.set_app_state('bench', str(time.time()))
+        started = time.perf_counter()
+        unchanged = app.rule_snapshot()
+        print(f"unrelated write:  {(time.perf_counter() - started) * 1000:.2f} ms, "
+              f"snapshot {'reused' if unchanged is fresh else 'rebuilt'}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark nftables Manager")
+    subparsers = parser.add_subparsers(dest='command')
+
+    pipeline = subparsers.add_parser('pipeline', help="Benchmark pembuatan aturan, akses DB, expiry, dan apply")
+    pipeline.add_argument('--sizes', default="10,1000,100000", help="Jumlah aturan, dipisah koma")
+    pipeline.add_argument('--repeat', type=int, default=3, help="Jumlah ulangan per tahap (median diambil)")
+    pipeline.add_argument('--backups', type=int, default=20, help="Jumlah direktori backup sintetis")
+    pipeline.add_argument('--baseline', default="benchmark_baseline.json", help="File baseline untuk perbandingan")
+    pipeline.add_argument('--save-baseline', action='store_true', help="Simpan hasil sebagai baseline baru")
+    pipeline.add_argument('--output', help="Simpan hasil lengkap ke file JSON")
+    pipeline.add_argument('--threshold', type=float, default=20.0, help="Batas regresi dalam persen")
+    pipeline.add_argument('--fail-on-regression', action='store_true', help="Exit code 1 jika ada regresi")
+    pipeline.add_argument('--log', action='store_true', help="Pertahankan logging INFO selama benchmark")
+    pipeline.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    pipeline.add_argument('--workdir', help=argparse.SUPPRESS)
+    pipeline.add_argument('--stage', choices=PIPELINE_STAGES, help=argparse.SUPPRESS)
+    pipeline.set_defaults(func=bench_pipeline)
+
+    simulate = subparsers.add_parser('simulate', help="Benchmark simulasi kebijakan")
+    simulate.add_argument('--rules', type=int, default=10000)
+    simulate.add_argument('--packets', type=int, default=1000000)
+    simulate.add_argument('--distinct', type=int, default=50000, help="Jumlah tuple paket unik")
+    simulate.add_argument('--single', type=int, default=2000, help="Jumlah query tunggal yang diukur")
+    simulate.add_argument('--verify', type=int, default=2000, help="Jumlah sampel yang diverifikasi")
+    simulate.set_defaults(func=bench_simulate)
+
+    store = subparsers.add_parser('store', help="Benchmark snapshot aturan di memori")
+    store.add_argument('--rules', type=int, default=100000)
+    store.add_argument('--reads', type=int, default=100000, help="Jumlah get_rule() yang diukur")
+    store.set_defaults(func=bench_store)
+
+    args = parser.parse_args()
+    if not getattr(args, 'func', None):
+        parser.print_help()
+        return
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as nftm  # noqa: E402
+
+
+def make_rule(rule_id, **fields):
+    """Aturan dengan bentuk yang sama seperti hasil get_rules()"""
+    rule = {
+        'id': rule_id, 'name': f"rule-{rule_id}", 'group_id': None, 'group_name': None, 'group_color': None,
+        'group_target_tags': None, 'target_tags': None, 'chain': 'input', 'src': None, 'dst': None,
+        'dport': None, 'protocol': None, 'action': 'accept', 'comment': None, 'enabled': 1,
+        'expired_at': None, 'rule_type': 'static', 'limit_value': None, 'geo': None,
+    }
+    rule.update(fields)
+    return rule
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Database dan file konfigurasi sementara; nft dan systemctl tidak tersedia"""
+    monkeypatch.setattr(nftm, 'DB_FILE', str(tmp_path / "firewall.db"))
+    monkeypatch.setattr(nftm, 'RULES_FILE', str(tmp_path / "nftables.d" / "custom.nft"))
+    monkeypatch.setattr(nftm, 'NFT_CONF', str(tmp_path / "nftables.conf"))
+    monkeypatch.setattr(nftm, 'BACKUP_DIR', str(tmp_path / "nftables.d" / "backups"))
+    monkeypatch.setattr(nftm, 'NFT', str(tmp_path / "nft"))
+    monkeypatch.setattr(nftm, 'SYSTEMCTL', str(tmp_path / "systemctl"))
+    # Cache tingkat modul milik database sebelumnya tidak boleh terbawa antar test
+    monkeypatch.setattr(nftm, '_rule_snapshot', None)
+    monkeypatch.setattr(nftm, '_rule_snapshot_checked', None)
+    nftm._simulator_cache.update(token=None, simulator=None)
+    with nftm._compile_cache_lock:
+        nftm._compile_cache.clear()
+    nftm._fragment_cache.clear()
+    nftm.init_db()
+    yield nftm
+    if nftm._confirm_timer is not None:
+        nftm._confirm_timer.cancel()
+        nftm._confirm_timer = None
+
+
+@pytest.fixture
+def applied(db, monkeypatch):
+    """save_rules() tanpa nft: catat setiap apply dan anggap berhasil"""
+    calls = []
+
+    def save_rules():
+        calls.append(len(db.get_rules()))
+        return True, "Rules saved successfully"
+
+    monkeypatch.setattr(db, 'save_rules', save_rules)
+    return calls
+
+
+@pytest.fixture
+def client(db):
+    client = db.app.test_client()
+    response = client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    assert response.status_code == 302
+    return client
@@ -0,0 +1,96 @@
+import pytest
+
+from conftest import nftm
+
+
+def create_rule(name, **fields):
+    data = {'name': name, 'chain': 'input', 'protocol': 'tcp', 'dport': '22', 'action': 'accept'}
+    data.update(fields)
+    return {'op': 'create_rule', 'data': data}
+
+
+def rule_names():
+    return sorted(rule['name'] for rule in nftm.get_rules())
+
+
+@pytest.fixture
+def token(db):
+    return {'Authorization': f"Bearer {nftm.create_api_token('ci', 1)}"}
+
+
+def test_batch_commits_all_operations(applied):
+    status, body = nftm.execute_api_batch([create_rule('ssh'), create_rule('dns', protocol='udp', dport='53')])
+    assert status == 200
+    assert body['success'] and body['applied']
+    assert [result['status'] for result in body['results']] == ['ok', 'ok']
+    assert {'ssh', 'dns'} <= set(rule_names())
+    assert len(applied) == 1
+
+
+def test_failed_operation_rolls_back_whole_batch(applied):
+    before = rule_names()
+    status, body = nftm.execute_api_batch([
+        create_rule('ssh'),
+        create_rule('broken', action='explode'),
+        create_rule('never'),
+    ])
+    assert status == 400
+    assert not body['success']
+    assert [result['status'] for result in body['results']] == ['rolled_back', 'error', 'skipped']
+    assert rule_names() == before
+    assert applied == []
+
+
+def test_missing_rule_reports_not_found(applied):
+    status, body = nftm.execute_api_batch([{'op': 'delete_rule', 'id': 999999}])
+    assert status == 404
+    assert body['results'][0]['status'] == 'error'
+
+
+@pytest.mark.parametrize('operations', [None, [], {'op': 'create_rule'}, [create_rule('x')] * 1001])
+def test_invalid_batches_are_rejected(db, operations):
+    status, body = nftm.execute_api_batch(operations)
+    assert status == 400
+    assert not body['success']
+
+
+def test_batch_writes_under_changeset_lock(applied, monkeypatch):
+    # Commit changeset tidak boleh menyelip di antara pemeriksaan pending dan transaksi batch
+    run = nftm.run_api_operations
+    held = []
+    monkeypatch.setattr(nftm, 'run_api_operations',
+                        lambda c, operations: held.append(nftm.changeset_lock.locked()) or run(c, operations))
+    status, _ = nftm.execute_api_batch([create_rule('ssh')])
+    assert status == 200
+    assert held == [True]
+
+
+@pytest.mark.parametrize('path', ['/api/v1/batch', '/api/v1/changesets', '/api/v1/lists/block'])
+def test_non_object_bodies_are_rejected(client, token, path):
+    response = client.post(path, json=[{'op': 'create_rule'}], headers=token)
+    assert response.status_code == 400
+    assert response.get_json()['message'] == "Request body must be a JSON object"
+
+
+def test_rest_create_rule(client, token, applied):
+    response = client.post('/api/v1/rules', json={'name': 'web', 'chain': 'input', 'protocol': 'tcp',
+                                                  'dport': '443', 'action': 'accept'}, headers=token)
+    assert response.status_code == 201
+    assert response.get_json()['rule']['name'] == 'web'
+    response = client.post('/api/v1/rules', json=['web'], headers=token)
+    assert response.status_code == 400
+
+
+def test_api_requires_token(client):
+    response = client.get('/api/v1/rules', headers={'Authorization': 'Bearer wrong'})
+    assert response.status_code == 401
+
+
+def test_simulate_rejects_non_object_packets(client):
+    assert client.post('/api/simulate', json=['input']).status_code == 400
+    assert client.post('/api/simulate', json={'packets': [1]}).status_code == 400
+    assert client.post('/api/simulate', json={'packets': 'tcp'}).status_code == 400
+    response = client.post('/api/simulate', json={'packets': [{'chain': 'input', 'src': '10.0.0.1',
+                                                               'protocol': 'tcp', 'dport': 2107}]})
+    assert response.status_code == 200
+    assert response.get_json()['results'][0]['verdict'] == 'accept'
@@ -0,0 +1,123 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+import pytest
+
+from conftest import nftm
+
+
+@pytest.fixture
+def backup(db):
+    """Direktori backup dengan snapshot database dan file konfigurasi"""
+    path = os.path.join(nftm.BACKUP_DIR, "backup_20240101_000000")
+    os.makedirs(path)
+    nftm.snapshot_database(os.path.join(path, "firewall.db"))
+    with open(os.path.join(path, "nftables.conf"), "w") as f:
+        f.write("flush ruleset\n")
+    with open(os.path.join(path, "backup_info.txt"), "w") as f:
+        f.write("test backup\n")
+    return path
+
+
+def archive(files, manifest_files=None, extra=()):
+    """Arsip tar.gz buatan tangan; manifest dihitung dari files kecuali manifest_files diberikan"""
+    if manifest_files is None:
+        manifest_files = {name: {'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+                          for name, data in files.items()}
+    manifest = json.dumps({'version': nftm.BACKUP_ARCHIVE_VERSION, 'name': 'handmade',
+                           'files': manifest_files}).encode()
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for name, data in [(nftm.BACKUP_MANIFEST, manifest)] + list(files.items()) + list(extra):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    buffer.seek(0)
+    return buffer
+
+
+def backup_files(path):
+    return {name: open(os.path.join(path, name), 'rb').read() for name in nftm.BACKUP_ARCHIVE_FILES}
+
+
+def imported_backups():
+    return sorted(name for name in os.listdir(nftm.BACKUP_DIR) if name.startswith('backup_'))
+
+
+@pytest.mark.parametrize('compression', nftm.archive_formats())
+def test_export_import_round_trip(backup, compression):
+    stream = io.BytesIO(b"".join(nftm.stream_backup_archive(backup, compression)))
+    success, message = nftm.import_backup_archive(stream)
+    assert success, message
+    names = imported_backups()
+    assert len(names) == 2
+    restored = os.path.join(nftm.BACKUP_DIR, names[-1])
+    assert backup_files(restored) == backup_files(backup)
+    assert not [name for name in os.listdir(nftm.BACKUP_DIR) if name.startswith('.upload_')]
+
+
+def test_manifest_without_files_is_rejected(db):
+    success, message = nftm.import_backup_archive(archive({}))
+    assert not success
+    assert "missing required files" in message
+    assert imported_backups() == []
+
+
+def test_missing_database_is_rejected(backup):
+    files = backup_files(backup)
+    del files['firewall.db']
+    success, message = nftm.import_backup_archive(archive(files))
+    assert not success
+    assert "firewall.db" in message
+
+
+def test_size_mismatch_is_rejected(backup):
+    files = backup_files(backup)
+    manifest = {name: {'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+                for name, data in files.items()}
+    manifest['nftables.conf']['size'] += 1
+    success, message = nftm.import_backup_archive(archive(files, manifest))
+    assert not success
+    assert "Size mismatch for nftables.conf" in message
+
+
+def test_checksum_mismatch_is_rejected(backup):
+    files = backup_files(backup)
+    manifest = {name: {'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+                for name, data in files.items()}
+    files['nftables.conf'] = b"flush rulesex\n"
+    success, message = nftm.import_backup_archive(archive(files, manifest))
+    assert not success
+    assert "Checksum mismatch" in message
+
+
+@pytest.mark.parametrize('name', ['../escape.txt', '/etc/passwd', 'nested/firewall.db'])
+def test_unexpected_members_are_rejected(backup, name):
+    success, message = nftm.import_backup_archive(archive(backup_files(backup), extra=[(name, b"x")]))
+    assert not success
+    assert "Unexpected archive member" in message
+    assert not os.path.exists(os.path.join(nftm.BACKUP_DIR, '..', 'escape.txt'))
+
+
+def test_corrupt_database_is_rejected(backup):
+    files = backup_files(backup)
+    files['firewall.db'] = b"SQLite format 3\0" + b"\xff" * 4096
+    success, message = nftm.import_backup_archive(archive(files))
+    assert not success
+    assert imported_backups() == [os.path.basename(backup)]
+
+
+def test_oversized_archive_is_rejected(backup, monkeypatch):
+    monkeypatch.setattr(nftm, 'BACKUP_UPLOAD_MAX_SIZE', 1024)
+    success, message = nftm.import_backup_archive(archive(backup_files(backup)))
+    assert not success
+    assert "maximum size" in message
+
+
+def test_unknown_format_is_rejected(db):
+    success, message = nftm.import_backup_archive(io.BytesIO(b"PK\x03\x04 not a tarball"))
+    assert not success
+    assert "Unsupported archive format" in message
@@ -0,0 +1,111 @@
+import pytest
+
+from conftest import nftm
+
+NEW_RULE = {'op': 'create_rule', 'data': {'name': 'web', 'chain': 'input', 'src': '10.1.0.0/16', 'dport': '443',
+                                          'protocol': 'tcp', 'action': 'accept'}}
+
+
+def rule_names():
+    return sorted(rule['name'] for rule in nftm.get_rules())
+
+
+@pytest.fixture
+def pending(applied):
+    """Changeset yang sudah diterapkan dan menunggu konfirmasi"""
+    before = rule_names()
+    changeset_id = nftm.create_changeset("web access", 1)
+    nftm.stage_operation(changeset_id, NEW_RULE)
+    nftm.stage_operation(changeset_id, {'op': 'delete_rule', 'id': nftm.get_rules()[0]['id']})
+    success, message = nftm.commit_changeset(changeset_id, confirm_timeout=600)
+    assert success, message
+    return changeset_id, before
+
+
+def test_staged_operations_are_not_applied(applied):
+    changeset_id = nftm.create_changeset("draft", 1)
+    nftm.stage_operation(changeset_id, NEW_RULE)
+    assert 'web' not in rule_names()
+    assert applied == []
+    with pytest.raises(nftm.ApiError):
+        nftm.create_changeset("second", 1)
+
+
+def test_commit_without_timeout_is_final(applied):
+    changeset_id = nftm.create_changeset("web access", 1)
+    nftm.stage_operation(changeset_id, NEW_RULE)
+    success, _ = nftm.commit_changeset(changeset_id)
+    assert success
+    assert 'web' in rule_names()
+    assert len(applied) == 1
+    assert nftm.get_changeset(changeset_id)['status'] == 'committed'
+    assert nftm.get_pending_changeset() is None
+
+
+def test_confirm_keeps_changes(pending):
+    changeset_id, _ = pending
+    assert nftm.get_changeset(changeset_id)['status'] == 'pending'
+    assert nftm.confirm_changeset(changeset_id)
+    assert nftm._confirm_timer is None
+    changeset = nftm.get_changeset(changeset_id)
+    assert changeset['status'] == 'committed'
+    assert changeset['snapshot'] is None
+    assert 'web' in rule_names()
+
+
+def test_rollback_restores_previous_rules(pending, applied):
+    changeset_id, before = pending
+    assert rule_names() != before
+    success, _ = nftm.rollback_changeset(changeset_id, reason="Confirmation timeout")
+    assert success
+    assert rule_names() == before
+    assert nftm.get_changeset(changeset_id)['status'] == 'rolled_back'
+    # Satu apply untuk commit dan satu untuk rollback
+    assert len(applied) == 2
+
+
+def test_direct_writes_refused_while_pending(pending, client):
+    changeset_id, _ = pending
+    after_commit = rule_names()
+    status, body = nftm.execute_api_batch([dict(NEW_RULE, data=dict(NEW_RULE['data'], name='direct'))])
+    assert status == 409
+    assert not body['success']
+    response = client.get(f"/toggle/{nftm.get_rules()[0]['id']}")
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/changes')
+    response = client.post('/add_group', data={'name': 'direct', 'description': '', 'color': '#000000'})
+    assert response.headers['Location'].endswith('/changes')
+    assert rule_names() == after_commit
+    assert 'direct' not in {group['name'] for group in nftm.get_groups()}
+
+    nftm.rollback_changeset(changeset_id)
+    status, _ = nftm.execute_api_batch([NEW_RULE])
+    assert status == 200
+
+
+def test_failed_operation_applies_nothing(applied):
+    before = rule_names()
+    changeset_id = nftm.create_changeset("broken", 1)
+    nftm.stage_operation(changeset_id, NEW_RULE)
+    nftm.stage_operation(changeset_id, {'op': 'create_group', 'data': {'name': 'dup'}})
+    nftm.stage_operation(changeset_id, {'op': 'create_group', 'data': {'name': 'dup'}})
+    success, message = nftm.commit_changeset(changeset_id)
+    assert not success
+    assert "Staged operation 3" in message
+    assert rule_names() == before
+    assert applied == []
+    assert nftm.get_changeset(changeset_id)['status'] == 'draft'
+
+
+def test_rejected_apply_reverts_database(applied, monkeypatch):
+    before = rule_names()
+    results = iter([(False, "nft rejected the ruleset"), (True, "Rules saved successfully")])
+    monkeypatch.setattr(nftm, 'save_rules', lambda: next(results))
+    changeset_id = nftm.create_changeset("rejected", 1)
+    nftm.stage_operation(changeset_id, NEW_RULE)
+    success, message = nftm.commit_changeset(changeset_id, confirm_timeout=600)
+    assert not success
+    assert "previous ruleset restored" in message
+    assert rule_names() == before
+    assert nftm.get_changeset(changeset_id)['status'] == 'failed'
+    assert nftm.get_pending_changeset() is None
@@ -0,0 +1,83 @@
+import random
+
+import pytest
+
+from conftest import make_rule, nftm
+
+V4_SOURCES = ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.1.2.3', '192.168.0.0/16']
+V6_SOURCES = ['2001:db8::/32', '2001:db8:1::/48', '2001:db8::5', 'fd00::/8']
+PORTS = ['22', '53', '80', '443', '8000-8009', '80,443']
+PROBE_ADDRESSES = ['10.1.2.3', '10.1.9.9', '10.9.9.9', '192.168.1.1', '8.8.8.8',
+                   '2001:db8::5', '2001:db8:1::1', '2001:db8:2::1', 'fd00::1', '2001::1']
+PROBE_SERVICES = [('tcp', 22), ('tcp', 80), ('tcp', 443), ('tcp', 8005), ('udp', 53), ('udp', 80),
+                  ('icmp', None), ('icmpv6', None)]
+
+
+def random_rules(rng, count):
+    """Aturan acak dengan banyak kandidat kompaksi; sebagian dual-stack (sumber IPv4 dan IPv6 sekaligus)"""
+    rules = []
+    for rule_id in range(1, count + 1):
+        sources = rng.sample(V4_SOURCES + V6_SOURCES, rng.choice([0, 1, 1, 2]))
+        protocol = rng.choice([None, 'tcp', 'tcp', 'udp', 'icmp'])
+        dport = rng.choice(PORTS) if protocol in ('tcp', 'udp') and rng.random() < 0.8 else None
+        rules.append(make_rule(rule_id, chain=rng.choice(['input', 'input', 'output']),
+                               src=", ".join(sources) or None, protocol=protocol, dport=dport,
+                               action=rng.choice(['accept', 'drop'])))
+    return rules
+
+
+def simulators(monkeypatch, rules):
+    monkeypatch.setattr(nftm, 'COMPACT_RULES', True)
+    compacted = nftm.PolicySimulator(rules, frozenset())
+    monkeypatch.setattr(nftm, 'COMPACT_RULES', False)
+    uncompacted = nftm.PolicySimulator(rules, frozenset())
+    return compacted, uncompacted
+
+
+@pytest.mark.parametrize('seed', range(25))
+def test_compaction_preserves_verdicts(monkeypatch, seed):
+    rng = random.Random(seed)
+    rules = random_rules(rng, 30)
+    compacted, uncompacted = simulators(monkeypatch, rules)
+    for chain in ('input', 'output'):
+        for address in PROBE_ADDRESSES:
+            for protocol, dport in PROBE_SERVICES:
+                # Aturan bisa berpindah melewati aturan beraksi sama, jadi hanya verdict yang dibandingkan
+                src, dst = (address, None) if chain == 'input' else (None, address)
+                expected = uncompacted.evaluate(chain, src, dst, protocol, dport)['verdict']
+                actual = compacted.evaluate(chain, src, dst, protocol, dport)['verdict']
+                assert actual == expected, (chain, address, protocol, dport)
+
+
+def test_random_rules_are_actually_compacted():
+    rng = random.Random(0)
+    removed = sum(nftm.compile_ruleset(random_rules(rng, 30), frozenset(), compact=True, flowtable=False,
+                                       feeds=(), dynamic_lists=False)['compaction']['removed']
+                  for _ in range(10))
+    assert removed > 0
+
+
+def test_dual_stack_entry_does_not_jump_ahead_of_ipv4_rule(monkeypatch):
+    # Entri ip6 aturan 7 bergabung ke atas dengan aturan 5, tetapi entri ip-nya tetap di belakang aturan 6
+    rules = [
+        make_rule(5, src='2001:db9::/32', protocol='icmp'),
+        make_rule(6, src='10.0.0.0/8', action='drop'),
+        make_rule(7, src='10.0.0.0/8, 2001:db8::/32', protocol='icmp'),
+    ]
+    compacted, uncompacted = simulators(monkeypatch, rules)
+    for simulator in (compacted, uncompacted):
+        assert simulator.evaluate('input', '10.2.0.1', None, 'icmp')['rule_id'] == 6
+        assert simulator.evaluate('input', '2001:db8::1', None, 'icmpv6') == \
+            {'verdict': 'accept', 'rule_id': 7, 'default_policy': False}
+
+
+def test_port_compaction_keeps_rule_attribution():
+    rules = [make_rule(rule_id, protocol='tcp', dport=str(8000 + rule_id), comment=f"svc {rule_id}")
+             for rule_id in range(10)]
+    compiled = nftm.compile_ruleset(rules, frozenset(), compact=True, flowtable=False, feeds=(),
+                                    dynamic_lists=False)
+    entries = [entry for entry in compiled['chains']['input'] if entry['rule_ids']]
+    assert len(entries) == 1
+    assert entries[0]['statement'] == "tcp dport 8000-8009 accept"
+    assert entries[0]['rule_ids'] == list(range(10))
+    assert compiled['compaction']['removed'] == 9
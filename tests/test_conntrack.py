@@ -0,0 +1,93 @@
+import base64
+import json
+
+import pytest
+
+from conftest import nftm
+
+
+def flow(src, dst, sport, dport, protocol='tcp', family='ipv4', state='ESTABLISHED', zone=None):
+    number = {'tcp': 6, 'udp': 17}[protocol]
+    fields = [family, '4' if family == 'ipv4' else '10', protocol, str(number), '431999']
+    if protocol == 'tcp':
+        fields.append(state)
+    fields += [f"src={src}", f"dst={dst}", f"sport={sport}", f"dport={dport}",
+               f"src={dst}", f"dst={src}", f"sport={dport}", f"dport={sport}", "[ASSURED]", "mark=0"]
+    if zone is not None:
+        fields.append(f"zone={zone}")
+    return " ".join(fields) + " use=1\n"
+
+
+@pytest.fixture
+def table(db, tmp_path, monkeypatch):
+    """Tabel conntrack dari file procfs buatan; alamat lokal 10.0.0.1"""
+    proc = tmp_path / "nf_conntrack"
+    fib = tmp_path / "fib_trie"
+    fib.write_text("Main:\n  +-- 10.0.0.0/8 2 0 2\n     |-- 10.0.0.1\n        /32 host LOCAL\n")
+    monkeypatch.setattr(nftm, 'CONNTRACK_PROC', str(proc))
+    monkeypatch.setattr(nftm, 'FIB_TRIE_PROC', str(fib))
+    monkeypatch.setattr(nftm, 'IF_INET6_PROC', str(tmp_path / "if_inet6"))
+    return proc
+
+
+def test_parse_conntrack_line():
+    entry = nftm.parse_conntrack_line(flow('192.0.2.5', '10.0.0.1', 51000, 22, zone=3))
+    assert (entry['src'], entry['dst'], entry['sport'], entry['dport']) == ('192.0.2.5', '10.0.0.1', 51000, 22)
+    assert (entry['reply_src'], entry['reply_dst']) == ('10.0.0.1', '192.0.2.5')
+    assert (entry['state'], entry['zone'], entry['flags']) == ('ESTABLISHED', 3, ['ASSURED'])
+    udp = nftm.parse_conntrack_line(flow('2001:db8::5', '2001:db8::1', 5353, 53, 'udp', 'ipv6'))
+    assert (udp['family'], udp['protocol'], udp['state']) == ('ipv6', 'udp', None)
+    assert nftm.parse_conntrack_line("garbage\n") is None
+
+
+def test_cursor_round_trip():
+    key = (4, 'tcp', 3221225989, 167772161, 51000, 22, 0)
+    assert nftm.decode_conntrack_cursor(nftm.encode_conntrack_cursor(key)) == key
+
+
+def encoded(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+
+@pytest.mark.parametrize('cursor', [
+    '!!!',
+    encoded({'version': 4}),
+    encoded([4, 'tcp', 1, 2, 3, 4]),
+    encoded([4, 'tcp', '1', 2, 3, 4, 0]),
+    encoded([4, None, 1, 2, 3, 4, 0]),
+    encoded([4, 'tcp', 1, 2, 3, 4, True]),
+    encoded([4.0, 'tcp', 1, 2, 3, 4, 0]),
+])
+def test_invalid_cursors_are_rejected(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        nftm.decode_conntrack_cursor(cursor)
+
+
+def test_keyset_pages_cover_every_flow_once(table):
+    table.write_text("".join(flow(f'192.0.2.{host}', '10.0.0.1', 40000 + host, 22) for host in range(1, 8)))
+    seen, cursor = [], None
+    while True:
+        page = nftm.scan_conntrack(after=nftm.decode_conntrack_cursor(cursor) if cursor else None, limit=3)
+        seen += [entry['src'] for entry in page['entries']]
+        assert page['scanned'] == page['matched'] == 7
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert seen == [f'192.0.2.{host}' for host in range(1, 8)]
+
+
+def test_filters_and_rule_counts(table):
+    table.write_text(flow('192.0.2.1', '10.0.0.1', 40001, 22) + flow('192.0.2.2', '10.0.0.1', 40002, 2107)
+                     + flow('192.0.2.3', '198.51.100.1', 40003, 53, 'udp'))
+    page = nftm.scan_conntrack({'port': 22})
+    assert [entry['src'] for entry in page['entries']] == ['192.0.2.1']
+    assert page['entries'][0]['chain'] == 'input'
+    page = nftm.scan_conntrack()
+    assert [entry['chain'] for entry in page['entries']] == ['input', 'input', 'forward']
+    assert sum(page['rule_counts'].values()) == 3
+
+
+def test_bad_cursor_in_request_is_reported(client, table):
+    table.write_text(flow('192.0.2.1', '10.0.0.1', 40001, 22))
+    response = client.get('/conntrack?cursor=' + encoded([4, 'tcp', 1, 2, 3, 4, 'zone']), follow_redirects=True)
+    assert b"Invalid conntrack filter: Invalid cursor" in response.data
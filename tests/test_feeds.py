@@ -0,0 +1,137 @@
+import os
+import sqlite3
+
+import pytest
+
+from conftest import nftm
+
+
+class Completed:
+    returncode = 0
+    stdout = stderr = ''
+
+
+def elements(lines):
+    intervals, invalid = nftm.parse_feed_lines(lines)
+    return {version: [nftm.format_interval(start, end, version) for start, end in nftm.merge_intervals(found)]
+            for version, found in intervals.items()}, invalid
+
+
+def test_parse_feed_lines_handles_both_families():
+    found, invalid = elements([
+        b"# blocklist\n",
+        b"198.51.100.7\n",
+        b"203.0.113.0/24 ; spamhaus\n",
+        b"203.0.113.128/25\n",
+        b"192.0.2.77/24,\n",
+        b"2001:db8::1  # single host\n",
+        b"2001:db8:1::/48\n",
+        b"\n",
+    ])
+    assert invalid == 0
+    assert found[4] == ['192.0.2.0/24', '198.51.100.7', '203.0.113.0/24']
+    assert found[6] == ['2001:db8::1', '2001:db8:1::/48']
+
+
+@pytest.mark.parametrize('line', ['256.1.1.1', '10.0.0.0/33', '2001:db8::/129', 'example.com', '1.2.3', '::g'])
+def test_parse_feed_lines_counts_invalid_lines(line):
+    found, invalid = elements([line, '10.0.0.1'])
+    assert invalid == 1
+    assert found == {4: ['10.0.0.1'], 6: []}
+
+
+def test_adjacent_ranges_are_merged():
+    found, _ = elements(['10.0.0.0/25', '10.0.0.128/25', '10.0.1.0', '10.0.1.2'])
+    assert found[4] == ['10.0.0.0-10.0.1.0', '10.0.1.2']
+
+
+@pytest.fixture
+def feed(db, tmp_path):
+    path = tmp_path / "blocklist.txt"
+    conn = sqlite3.connect(nftm.DB_FILE)
+    cursor = conn.execute("INSERT INTO feeds (name, url, chain, action) VALUES ('bad hosts', ?, 'input', 'drop')",
+                          (str(path),))
+    conn.commit()
+    conn.close()
+    return cursor.lastrowid, path
+
+
+@pytest.fixture
+def kernel(db, monkeypatch):
+    """nft palsu: catat batch perintah yang dikirim ke set kernel"""
+    with open(nftm.NFT, 'w') as f:
+        f.write("#!/bin/sh\n")
+    batches = []
+    monkeypatch.setattr(nftm, 'run_command',
+                        lambda args, **kwargs: batches.append(kwargs.get('input', '').splitlines()) or Completed())
+    monkeypatch.setattr(nftm, 'feed_synced', set())
+    return batches
+
+
+def write_feed(path, lines):
+    path.write_text("\n".join(lines) + "\n")
+    # Validator file lokal memakai mtime; pastikan setiap penulisan terlihat sebagai perubahan
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+
+
+def test_update_feed_applies_only_the_diff(feed, kernel):
+    feed_id, path = feed
+    write_feed(path, ['192.0.2.1', '2001:db8::1'])
+    success, message = nftm.update_feed(feed_id)
+    assert success, message
+    # Set belum sinkron setelah startup: kedua set diisi ulang penuh
+    assert kernel[-1] == [
+        f"flush set {nftm.NFT_TABLE} feed_{feed_id}",
+        f"add element {nftm.NFT_TABLE} feed_{feed_id} {{ 192.0.2.1 }}",
+        f"flush set {nftm.NFT_TABLE} feed6_{feed_id}",
+        f"add element {nftm.NFT_TABLE} feed6_{feed_id} {{ 2001:db8::1 }}",
+    ]
+    write_feed(path, ['192.0.2.1', '2001:db8::2', 'not-an-address'])
+    success, message = nftm.update_feed(feed_id)
+    assert success
+    assert "1 invalid lines skipped" in message
+    assert kernel[-1] == [
+        f"delete element {nftm.NFT_TABLE} feed6_{feed_id} {{ 2001:db8::1 }}",
+        f"add element {nftm.NFT_TABLE} feed6_{feed_id} {{ 2001:db8::2 }}",
+    ]
+    assert nftm.load_feed_elements(feed_id, 'ip') == ['192.0.2.1']
+    assert nftm.load_feed_elements(feed_id, 'ip6') == ['2001:db8::2']
+
+
+def test_unchanged_feed_sends_nothing(feed, kernel):
+    feed_id, path = feed
+    write_feed(path, ['192.0.2.1'])
+    nftm.update_feed(feed_id)
+    count = len(kernel)
+    success, message = nftm.update_feed(feed_id)
+    assert success
+    assert "not modified" in message
+    assert len(kernel) == count
+
+
+def test_failed_batch_keeps_stored_elements(feed, kernel, monkeypatch):
+    feed_id, path = feed
+    write_feed(path, ['192.0.2.1'])
+    nftm.update_feed(feed_id)
+    failed = Completed()
+    failed.returncode, failed.stderr = 1, "Error: Could not process rule"
+    monkeypatch.setattr(nftm, 'run_command', lambda args, **kwargs: failed)
+    write_feed(path, ['192.0.2.2'])
+    success, _ = nftm.update_feed(feed_id)
+    assert not success
+    assert nftm.load_feed_elements(feed_id) == ['192.0.2.1']
+    assert nftm.get_feed(feed_id)['last_status'] == 'failed'
+
+
+def test_feed_is_compiled_for_both_families(feed):
+    feed_id, path = feed
+    write_feed(path, ['192.0.2.1', '2001:db8::/32'])
+    nftm.update_feed(feed_id)
+    compiled = nftm.compile_ruleset([], frozenset(), flowtable=False, dynamic_lists=False)
+    statements = [entry['statement'] for entry in compiled['chains']['input']]
+    assert f"ip saddr @feed_{feed_id} drop" in statements
+    assert f"ip6 saddr @feed6_{feed_id} drop" in statements
+    config = nftm.render_ruleset(compiled)
+    assert f"set feed6_{feed_id} {{\n        type ipv6_addr; flags interval;\n" \
+           f"        elements = {{ 2001:db8::/32 }}" in config
@@ -0,0 +1,121 @@
+import ipaddress
+
+import pytest
+
+from conftest import nftm
+
+
+def encode(value):
+    """Enkode map/string/uint32 kecil ke format section data MaxMind DB"""
+    if isinstance(value, dict):
+        encoded = bytes([(7 << 5) | len(value)])
+        for key, item in value.items():
+            encoded += encode(key) + encode(item)
+        return encoded
+    if isinstance(value, str):
+        raw = value.encode()
+        return bytes([(2 << 5) | len(raw)]) + raw
+    raw = value.to_bytes(4, 'big').lstrip(b'\0')
+    return bytes([(6 << 5) | len(raw)]) + raw
+
+
+def write_mmdb(path, networks, record_size=24):
+    """MaxMind DB IPv6 minimal; IPv4 ditaruh di ::/96 dengan alias ::ffff:0:0/96"""
+    nodes = [[None, None]]
+
+    def child(node, bit):
+        target = nodes[node][bit]
+        if not (isinstance(target, tuple) and target[0] == 'node'):
+            nodes.append([target, target])
+            target = nodes[node][bit] = ('node', len(nodes) - 1)
+        return target[1]
+
+    def insert(bits, length, value):
+        node = 0
+        for depth in range(length - 1):
+            node = child(node, (bits >> (127 - depth)) & 1)
+        nodes[node][(bits >> (128 - length)) & 1] = value
+
+    data, offsets = b"", {}
+    for network, record in networks:
+        key = repr(record)
+        if key not in offsets:
+            offsets[key] = len(data)
+            data += encode(record)
+        network = ipaddress.ip_network(network)
+        length = network.prefixlen + (96 if network.version == 4 else 0)
+        insert(int(network.network_address), length, ('data', offsets[key]))
+    ipv4_root = 0
+    for _ in range(96):
+        ipv4_root = child(ipv4_root, 0)
+    insert(int(ipaddress.ip_address('::ffff:0:0')), 96, ('node', ipv4_root))
+
+    count = len(nodes)
+
+    def pointer(target):
+        if target is None:
+            return count
+        return target[1] if target[0] == 'node' else count + 16 + target[1]
+
+    tree = b""
+    for left, right in nodes:
+        left, right = pointer(left), pointer(right)
+        if record_size == 28:
+            middle = ((left >> 24) & 0xF) << 4 | ((right >> 24) & 0xF)
+            tree += (left & 0xFFFFFF).to_bytes(3, 'big') + bytes([middle]) + (right & 0xFFFFFF).to_bytes(3, 'big')
+        else:
+            tree += left.to_bytes(record_size // 8, 'big') + right.to_bytes(record_size // 8, 'big')
+    metadata = encode({'node_count': count, 'record_size': record_size, 'ip_version': 6,
+                       'database_type': 'Test'})
+    path.write_bytes(tree + b"\0" * 16 + data + nftm.MMDB_METADATA_MARKER + metadata)
+
+
+def country(code):
+    return {'country': {'iso_code': code}}
+
+
+def intervals(found, version):
+    return [nftm.format_interval(start, end, version) for start, end in found[version]]
+
+
+@pytest.mark.parametrize('record_size', [24, 28, 32])
+def test_country_intervals(tmp_path, record_size):
+    path = tmp_path / "country.mmdb"
+    write_mmdb(path, [
+        ('1.0.0.0/24', country('AU')),
+        ('1.0.1.0/24', country('AU')),
+        ('5.0.0.0/8', country('DE')),
+        ('2001:db8::/32', country('AU')),
+        ('2a00::/12', {'registered_country': {'iso_code': 'de'}}),
+    ], record_size)
+    found = nftm.read_mmdb_intervals(str(path), ['AU', 'DE', 'NL'])
+    # Jaringan yang bersebelahan digabung; alias ::ffff:0:0/96 tidak muncul lagi sebagai IPv6
+    assert intervals(found['AU'], 4) == ['1.0.0.0/23']
+    assert intervals(found['AU'], 6) == ['2001:db8::/32']
+    assert intervals(found['DE'], 4) == ['5.0.0.0/8']
+    assert intervals(found['DE'], 6) == ['2a00::/12']
+    assert found['NL'] == {4: [], 6: []}
+
+
+def test_asn_records(tmp_path):
+    path = tmp_path / "asn.mmdb"
+    write_mmdb(path, [('104.16.0.0/13', {'autonomous_system_number': 13335}),
+                      ('8.8.8.0/24', {'autonomous_system_number': 15169})])
+    found = nftm.read_mmdb_intervals(str(path), ['AS13335'])
+    assert intervals(found['AS13335'], 4) == ['104.16.0.0/13']
+
+
+def test_reader_metadata(tmp_path):
+    path = tmp_path / "country.mmdb"
+    write_mmdb(path, [('10.0.0.0/8', country('US'))])
+    with nftm.MmdbReader(str(path)) as reader:
+        assert (reader.ip_version, reader.record_size, reader.database_type) == (6, 24, 'Test')
+        (start, end, pointer), = reader.networks(4)
+        assert reader.record(pointer) == country('US')
+
+
+def test_non_mmdb_file_is_rejected(tmp_path):
+    path = tmp_path / "country.mmdb"
+    path.write_bytes(b"network,country\n10.0.0.0/8,US\n")
+    with pytest.raises(ValueError):
+        nftm.MmdbReader(str(path))
@@ -0,0 +1,96 @@
+import json
+import os
+
+import pytest
+
+from conftest import nftm
+
+
+def record(message, level='INFO', **fields):
+    return json.dumps(dict(ts='2024-01-01 00:00:00', level=level, msg=message, **fields)) + "\n"
+
+
+@pytest.fixture
+def log_file(tmp_path, monkeypatch):
+    path = tmp_path / "nftables_manager.log"
+    path.write_text("")
+    monkeypatch.setattr(nftm, 'LOG_FILE', str(path))
+    return path
+
+
+@pytest.mark.parametrize('block_size', [1, 3, 7, 64 * 1024])
+def test_read_lines_reverse_across_blocks(tmp_path, block_size):
+    path = tmp_path / "lines.txt"
+    data = b"first\nsecond line\n\nthird\npartial"
+    path.write_bytes(data)
+    lines = list(nftm.read_lines_reverse(str(path), block_size=block_size))
+    # Baris terakhir tanpa newline belum selesai ditulis; baris kosong dilewati
+    assert lines == [(19, b"third"), (6, b"second line"), (0, b"first")]
+    for offset, line in lines:
+        assert data[offset:offset + len(line)] == line
+    # Dengan `end` eksplisit, baris sebelum offset itu dianggap lengkap
+    assert list(nftm.read_lines_reverse(str(path), end=19, block_size=block_size)) == \
+        [(6, b"second line"), (0, b"first")]
+
+
+def test_read_log_pages_and_filters(log_file):
+    log_file.write_text("".join(record(f"message {number}", 'ERROR' if number % 3 == 0 else 'INFO',
+                                       request_id=f"req{number % 2}") for number in range(10))
+                        + "2024-01-01 00:00:00,000 - WARNING - Rule #7 expired\n")
+    page = nftm.read_log(limit=4)
+    assert [entry['msg'] for entry in page['entries']] == ['Rule #7 expired', 'message 9', 'message 8', 'message 7']
+    assert page['size'] == log_file.stat().st_size
+    older = nftm.read_log(before=page['older'], limit=4)
+    assert [entry['msg'] for entry in older['entries']] == ['message 6', 'message 5', 'message 4', 'message 3']
+    filtered = nftm.read_log(nftm.parse_log_filters({'level': 'warning', 'request_id': 'req0'}))
+    assert [entry['msg'] for entry in filtered['entries']] == ['message 6', 'message 0']
+    assert [entry['msg'] for entry in nftm.read_log(nftm.parse_log_filters({'rule_id': '7'}))['entries']] == \
+        ['Rule #7 expired']
+    with pytest.raises(ValueError):
+        nftm.parse_log_filters({'level': 'loud'})
+
+
+def test_read_log_without_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(nftm, 'LOG_FILE', str(tmp_path / "missing.log"))
+    assert nftm.read_log() is None
+
+
+def append(path, text):
+    with open(path, 'a') as f:
+        f.write(text)
+
+
+def test_follow_log_reads_only_new_lines(log_file):
+    append(log_file, record("old"))
+    # Offset di tengah baris: sisa baris itu dilewati
+    follower = nftm.follow_log(3, heartbeat=0.1)
+    append(log_file, record("new") + record("skipped", 'DEBUG') + record("half")[:10])
+    offset, entry = next(follower)
+    assert entry['msg'] == "new"
+    assert entry['offset'] == len(record("old"))
+    offset, entry = next(follower)
+    assert entry['msg'] == "skipped"
+    # Tanpa baris baru yang lengkap follower mengirim keep-alive
+    assert next(follower) == (offset, None)
+    append(log_file, record("half")[10:])
+    assert next(follower)[1]['msg'] == "half"
+    follower.close()
+
+
+def test_follow_log_applies_filters(log_file):
+    follower = nftm.follow_log(0, nftm.parse_log_filters({'level': 'error'}), heartbeat=0.1)
+    append(log_file, record("info") + record("failure", 'ERROR'))
+    assert next(follower)[1]['msg'] == "failure"
+    follower.close()
+
+
+def test_follow_log_reopens_rotated_file(log_file):
+    append(log_file, record("before rotation"))
+    follower = nftm.follow_log(log_file.stat().st_size, heartbeat=0.1)
+    assert next(follower)[1] is None
+    os.rename(log_file, str(log_file) + ".1")
+    log_file.write_text(record("after rotation"))
+    offset, entry = next(follower)
+    assert entry['msg'] == "after rotation"
+    assert offset == log_file.stat().st_size
+    follower.close()
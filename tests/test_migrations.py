@@ -0,0 +1,87 @@
+import sqlite3
+
+import pytest
+
+from conftest import nftm
+
+LATEST = nftm.SCHEMA_MIGRATIONS[-1][0]
+
+
+def connect():
+    return sqlite3.connect(nftm.DB_FILE)
+
+
+def user_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate_to(path, version):
+    """Database dengan skema persis pada versi tertentu, seperti instalasi lama"""
+    conn = sqlite3.connect(path)
+    c = conn.cursor()
+    for target, _, migration in nftm.SCHEMA_MIGRATIONS:
+        if target > version:
+            break
+        c.execute("BEGIN")
+        migration(c)
+        c.execute(f"PRAGMA user_version = {int(target)}")
+        conn.commit()
+    return conn
+
+
+def test_migrations_are_ordered():
+    versions = [target for target, _, _ in nftm.SCHEMA_MIGRATIONS]
+    assert versions == sorted(set(versions))
+    assert versions[0] == 1
+
+
+def test_fresh_database_reaches_latest_version(db):
+    conn = connect()
+    try:
+        assert user_version(conn) == LATEST
+        assert nftm.get_groups()
+    finally:
+        conn.close()
+
+
+def test_migrate_is_noop_when_current(db):
+    generation = nftm.data_generation['db']
+    conn = sqlite3.connect(nftm.DB_FILE)
+    try:
+        assert nftm.migrate_db(conn) == LATEST
+    finally:
+        conn.close()
+    assert nftm.data_generation['db'] == generation
+
+
+@pytest.mark.parametrize('version', range(1, LATEST))
+def test_older_database_is_upgraded(tmp_path, version):
+    path = str(tmp_path / "old.db")
+    conn = migrate_to(path, version)
+    try:
+        conn.execute("INSERT INTO rules (name, chain, action, enabled) VALUES ('legacy', 'input', 'accept', 1)")
+        conn.commit()
+        assert nftm.migrate_db(conn) == LATEST
+        assert user_version(conn) == LATEST
+        names = [row[0] for row in conn.execute("SELECT name FROM rules")]
+        assert 'legacy' in names
+        # Migrasi yang sama tidak dijalankan dua kali
+        assert nftm.migrate_db(conn) == LATEST
+    finally:
+        conn.close()
+
+
+def test_failed_migration_is_rolled_back(db, monkeypatch):
+    def broken(c):
+        c.execute("CREATE TABLE half_done (id INTEGER)")
+        raise sqlite3.OperationalError("boom")
+
+    monkeypatch.setattr(nftm, 'SCHEMA_MIGRATIONS', nftm.SCHEMA_MIGRATIONS + [(LATEST + 1, "Broken", broken)])
+    conn = connect()
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            nftm.migrate_db(conn)
+        assert user_version(conn) == LATEST
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
+    finally:
+        conn.close()
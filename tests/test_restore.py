@@ -0,0 +1,90 @@
+import json
+import os
+
+import pytest
+
+from conftest import nftm
+
+
+@pytest.fixture
+def backup(applied, monkeypatch):
+    """Backup dari database awal; apply inkremental tanpa nft dianggap berhasil"""
+    monkeypatch.setattr(nftm, 'apply_incremental', lambda: (True, "Rules re-synced"))
+    path = os.path.join(nftm.BACKUP_DIR, "backup_20240101_000000")
+    os.makedirs(path)
+    nftm.snapshot_database(os.path.join(path, "firewall.db"))
+    return path
+
+
+def rules_by_name():
+    return {rule['name']: rule for rule in nftm.get_rules()}
+
+
+def rule_key(group, name, chain='input', occurrence=1):
+    return json.dumps([group, name, chain, occurrence])
+
+
+def change_live_rules():
+    rules = rules_by_name()
+    status, body = nftm.execute_api_batch([
+        {'op': 'delete_rule', 'id': rules['Allow SSH']['id']},
+        {'op': 'update_rule', 'id': rules['Allow ICMP (Ping)']['id'], 'data': {'action': 'drop'}},
+        {'op': 'create_rule', 'data': {'name': 'Extra', 'group_id': rules['Allow SSH']['group_id'],
+                                       'chain': 'input', 'protocol': 'tcp', 'dport': '8080',
+                                       'action': 'accept'}},
+    ], apply=False)
+    assert status == 200, body
+
+
+def test_preview_lists_differences(backup):
+    assert nftm.preview_restore(backup)['unchanged']
+    change_live_rules()
+    preview = nftm.preview_restore(backup)
+    assert not preview['unchanged']
+    assert [item['key'] for item in preview['rules']['added']] == [rule_key('Management', 'Allow SSH')]
+    assert [item['key'] for item in preview['rules']['removed']] == [rule_key('Management', 'Extra')]
+    changed = preview['rules']['changed']
+    assert [item['key'] for item in changed] == [rule_key('Management', 'Allow ICMP (Ping)')]
+    assert preview['diff']
+
+
+def test_restore_single_rule(backup):
+    change_live_rules()
+    success, message = nftm.restore_selection(backup, rule_keys=[rule_key('Management', 'Allow SSH')])
+    assert success, message
+    rules = rules_by_name()
+    assert rules['Allow SSH']['dport'] == '22'
+    # Aturan lain yang tidak dipilih tetap seperti di database aktif
+    assert rules['Allow ICMP (Ping)']['action'] == 'drop'
+    assert 'Extra' in rules
+
+
+def test_restore_group_replaces_its_rules(backup):
+    change_live_rules()
+    success, message = nftm.restore_selection(backup, group_names=['Management'])
+    assert success, message
+    rules = rules_by_name()
+    assert 'Extra' not in rules
+    assert rules['Allow SSH']['group_name'] == 'Management'
+    assert rules['Allow ICMP (Ping)']['action'] == 'accept'
+    assert nftm.preview_restore(backup)['unchanged']
+
+
+def test_nothing_selected(backup):
+    success, message = nftm.restore_selection(backup, group_names=['Missing'], rule_keys=['[]'])
+    assert not success
+    assert message == "Nothing selected to restore"
+
+
+def test_refused_while_changeset_pending(backup):
+    change_live_rules()
+    changeset_id = nftm.create_changeset("pending", 1)
+    nftm.stage_operation(changeset_id, {'op': 'create_group', 'data': {'name': 'Staged'}})
+    assert nftm.commit_changeset(changeset_id, confirm_timeout=600)[0]
+    before = rules_by_name()
+    backups = len(os.listdir(nftm.BACKUP_DIR))
+    success, message = nftm.restore_selection(backup, group_names=['Management'])
+    assert not success
+    assert "waiting for confirmation" in message
+    assert rules_by_name().keys() == before.keys()
+    assert len(os.listdir(nftm.BACKUP_DIR)) == backups
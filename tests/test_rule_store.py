@@ -0,0 +1,38 @@
+import sqlite3
+
+from conftest import nftm
+
+
+def store_version(conn):
+    return conn.execute("SELECT version FROM rule_store_version WHERE id = 1").fetchone()[0]
+
+
+def test_rule_store_version_tracks_rules_and_groups_only(db):
+    conn = sqlite3.connect(nftm.DB_FILE)
+    try:
+        version = store_version(conn)
+        conn.execute("INSERT INTO rule_groups (name) VALUES ('tracked')")
+        conn.execute("INSERT INTO rules (name, chain, action) VALUES ('tracked', 'input', 'drop')")
+        conn.execute("UPDATE rules SET action = 'accept' WHERE name = 'tracked'")
+        conn.execute("DELETE FROM rules WHERE name = 'tracked'")
+        conn.commit()
+        assert store_version(conn) == version + 4
+        conn.execute("INSERT INTO app_state (key, value) VALUES ('other', 'table')")
+        conn.commit()
+        assert store_version(conn) == version + 4
+    finally:
+        conn.close()
+
+
+def test_snapshot_survives_unrelated_writes(db, monkeypatch):
+    builds = []
+    load = nftm.load_rule_snapshot
+    monkeypatch.setattr(nftm, 'load_rule_snapshot', lambda previous=None: builds.append(1) or load(previous))
+    snapshot = nftm.rule_snapshot()
+    nftm.set_app_state('applied_hash', 'x')
+    nftm.create_api_token('ci', 1)
+    assert nftm.rule_snapshot() is snapshot
+    nftm.execute_api_batch([{'op': 'create_group', 'data': {'name': 'new'}}], apply=False)
+    assert nftm.rule_snapshot() is not snapshot
+    assert 'new' in {group['name'] for group in nftm.get_groups()}
+    assert len(builds) == 2